@@ -13,6 +13,7 @@ class BaseSystemDiagnoser(Diagnoser):
     id_ = os.path.splitext(os.path.basename(__file__))[0].split("-")[1]
     cache_duration = 600
     dependencies = []
+    inputs = ["dpkg", "kernel"]
 
     def run(self):
 
@@ -8,7 +8,7 @@ from publicsuffix import PublicSuffixList
 
 from moulinette.utils.process import check_output
 
-from yunohost.utils.network import dig
+from yunohost.utils.network import dig, dig_many
 from yunohost.diagnosis import Diagnoser
 from yunohost.domain import domain_list, _build_dns_conf, _get_maindomain
 
@@ -22,16 +22,28 @@ class DNSRecordsDiagnoser(Diagnoser):
     id_ = os.path.splitext(os.path.basename(__file__))[0].split("-")[1]
     cache_duration = 600
     dependencies = ["ip"]
+    inputs = ["domains", "public_ips", "regenconf"]
 
     def run(self):
 
         main_domain = _get_maindomain()
 
         all_domains = domain_list()["domains"]
+        expected_configurations = {}
         for domain in all_domains:
-            self.logger_debug("Diagnosing DNS conf for %s" % domain)
             is_subdomain = domain.split(".", 1)[1] in all_domains
-            for report in self.check_domain(domain, domain == main_domain, is_subdomain=is_subdomain):
+            expected_configurations[domain] = self.get_expected_configuration(domain, is_subdomain)
+
+        # Fetch the current records of every domain all at once
+        queries = [self.record_query(domain, r["name"], r["type"])
+                   for domain, configuration in expected_configurations.items()
+                   for _, records in configuration
+                   for r in records]
+        self.current_records = dig_many(queries, resolvers="force_external")
+
+        for domain in all_domains:
+            self.logger_debug("Diagnosing DNS conf for %s" % domain)
+            for report in self.check_domain(domain, domain == main_domain, expected_configurations[domain]):
                 yield report
 
         # Check if a domain buy by the user will expire soon
@@ -42,7 +54,7 @@ class DNSRecordsDiagnoser(Diagnoser):
         for report in self.check_expiration_date(domains_from_registrar):
             yield report
 
-    def check_domain(self, domain, is_main_domain, is_subdomain):
+    def get_expected_configuration(self, domain, is_subdomain):
 
         expected_configuration = _build_dns_conf(domain, include_empty_AAAA_if_no_ipv6=True)
 
@@ -51,9 +63,12 @@ class DNSRecordsDiagnoser(Diagnoser):
         if is_subdomain:
             categories = ["basic"]
 
-        for category in categories:
+        return [(category, expected_configuration[category]) for category in categories]
+
+    def check_domain(self, domain, is_main_domain, expected_configuration):
+
+        for category, records in expected_configuration:
 
-            records = expected_configuration[category]
             discrepancies = []
             results = {}
 
@@ -104,10 +119,13 @@ class DNSRecordsDiagnoser(Diagnoser):
 
             yield output
 
+    def record_query(self, domain, name, type_):
+
+        return ("%s.%s" % (name, domain) if name != "@" else domain, type_)
+
     def get_current_record(self, domain, name, type_):
 
-        query = "%s.%s" % (name, domain) if name != "@" else domain
-        success, answers = dig(query, type_, resolvers="force_external")
+        success, answers = self.current_records[self.record_query(domain, name, type_)]
 
         if success != "ok":
             return None
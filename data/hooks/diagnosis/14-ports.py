@@ -10,7 +10,9 @@ class PortsDiagnoser(Diagnoser):
 
     id_ = os.path.splitext(os.path.basename(__file__))[0].split("-")[1]
     cache_duration = 600
-    dependencies = ["ip"]
+    dependencies = ["ip", "dnsrecords"]
+    optional_dependencies = ["dnsrecords"]
+    inputs = ["services", "public_ips", "firewall"]
 
     def run(self):
 
@@ -17,7 +17,9 @@ class WebDiagnoser(Diagnoser):
 
     id_ = os.path.splitext(os.path.basename(__file__))[0].split("-")[1]
     cache_duration = 600
-    dependencies = ["ip"]
+    dependencies = ["ip", "dnsrecords"]
+    optional_dependencies = ["dnsrecords"]
+    inputs = ["domains", "public_ips", "regenconf"]
 
     def run(self):
 
@@ -3,6 +3,8 @@
 import os
 import dns.resolver
 import re
+import time
+import threading
 
 from subprocess import CalledProcessError
 
@@ -12,10 +14,15 @@ from moulinette.utils.filesystem import read_yaml
 from yunohost.diagnosis import Diagnoser
 from yunohost.domain import _get_maindomain, domain_list
 from yunohost.settings import settings_get
-from yunohost.utils.network import dig
+from yunohost.utils.network import dig, DIG_MAX_PARALLEL
 
 DEFAULT_DNS_BLACKLIST = "/usr/share/yunohost/other/dnsbl_list.yml"
 
+# Time to wait for a blacklist to answer, unless the blacklist defines its own
+# timeout. Blacklists which timed out that many times are not queried anymore.
+DNSBL_TIMEOUT = 3
+DNSBL_MAX_TIMEOUTS = 2
+
 
 class MailDiagnoser(Diagnoser):
 
@@ -156,6 +163,7 @@ class MailDiagnoser(Diagnoser):
         """
 
         dns_blacklists = read_yaml(DEFAULT_DNS_BLACKLIST)
+        lookups = []
         for item in self.ips + self.mail_domains:
             for blacklist in dns_blacklists:
                 item_type = "domain"
@@ -174,29 +182,92 @@ class MailDiagnoser(Diagnoser):
                     subdomain = str(rev.split(3)[0])
                 query = subdomain + '.' + blacklist['dns_server']
 
+                lookups.append((item, blacklist, query))
+
+        results = self.lookup_blacklists(lookups)
+
+        for (item, blacklist, query), result in zip(lookups, results):
+            if result is None:
+                continue
+
+            # Reason given by the blacklist, if any
+            details = []
+            reason = "-"
+            if result:
+                reason = result
+                details.append("diagnosis_mail_blacklist_reason")
+
+            details.append("diagnosis_mail_blacklist_website")
+
+            yield dict(meta={"test": "mail_blacklist", "item": item,
+                             "blacklist": blacklist["dns_server"]},
+                       data={'blacklist_name': blacklist['name'],
+                             'blacklist_website': blacklist['website'],
+                             'reason': reason},
+                       status="ERROR",
+                       summary='diagnosis_mail_blacklist_listed_by',
+                       details=details)
+
+    def lookup_blacklists(self, lookups):
+        """
+        Do the DNS queries of a list of (item, blacklist, query) concurrently
+
+        Returns, for each lookup, None if the item is not listed, or else the
+        reason given by the blacklist (an empty string if none was given)
+        """
+
+        from multiprocessing.pool import ThreadPool
+
+        if not lookups:
+            return []
+
+        lock = threading.Lock()
+        stats = {blacklist["dns_server"]: {"latencies": [], "timeouts": 0, "skipped": 0}
+                 for _, blacklist, _ in lookups}
+        # Don't have more queries waiting for a blacklist than the number of
+        # timeouts after which it is skipped
+        in_flight = {dns_server: threading.Semaphore(DNSBL_MAX_TIMEOUTS) for dns_server in stats}
+
+        def lookup(lookup_):
+            item, blacklist, query = lookup_
+            timeout = blacklist.get("timeout", DNSBL_TIMEOUT)
+            stats_ = stats[blacklist["dns_server"]]
+
+            with in_flight[blacklist["dns_server"]]:
+                with lock:
+                    if stats_["timeouts"] >= DNSBL_MAX_TIMEOUTS:
+                        stats_["skipped"] += 1
+                        return None
+
                 # Do the DNS Query
-                status, _ = dig(query, 'A')
-                if status != 'ok':
-                    continue
+                start = time.time()
+                status, answers = dig(query, 'A', timeout=timeout)
+                with lock:
+                    stats_["latencies"].append(time.time() - start)
+                    if status != 'ok' and answers[0] == "Timeout":
+                        stats_["timeouts"] += 1
 
-                # Try to get the reason
-                details = []
-                status, answers = dig(query, 'TXT')
-                reason = "-"
-                if status == 'ok':
-                    reason = ', '.join(answers)
-                    details.append("diagnosis_mail_blacklist_reason")
-
-                details.append("diagnosis_mail_blacklist_website")
-
-                yield dict(meta={"test": "mail_blacklist", "item": item,
-                                 "blacklist": blacklist["dns_server"]},
-                           data={'blacklist_name': blacklist['name'],
-                                 'blacklist_website': blacklist['website'],
-                                 'reason': reason},
-                           status="ERROR",
-                           summary='diagnosis_mail_blacklist_listed_by',
-                           details=details)
+            if status != 'ok':
+                return None
+
+            # Try to get the reason
+            status, answers = dig(query, 'TXT', timeout=timeout)
+            return ', '.join(answers) if status == 'ok' else ""
+
+        pool = ThreadPool(min(len(lookups), DIG_MAX_PARALLEL))
+        try:
+            results = pool.map(lookup, lookups)
+        finally:
+            pool.close()
+
+        for dns_server, stats_ in sorted(stats.items(), key=lambda s: -sum(s[1]["latencies"])):
+            latencies = stats_["latencies"] or [0]
+            self.logger_debug("Blacklist %s: %s queries, %.0fms on average, %.0fms at most, %s timeouts, %s skipped"
+                              % (dns_server, len(stats_["latencies"]),
+                                 sum(latencies) / len(latencies) * 1000, max(latencies) * 1000,
+                                 stats_["timeouts"], stats_["skipped"]))
+
+        return results
 
     def check_queue(self):
         """
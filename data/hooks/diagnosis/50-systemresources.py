@@ -1,8 +1,16 @@
 #!/usr/bin/env python
 import os
+import time
 import psutil
 
-from yunohost.diagnosis import Diagnoser
+from yunohost.diagnosis import Diagnoser, _get_diagnosis_history
+from yunohost.utils.resources import human_size, round_
+
+# Measures are recorded at most every 10 minutes, and trends are computed on
+# those of the last week, as long as they span at least a day
+HISTORY_MIN_INTERVAL = 600
+TREND_WINDOW = 7 * 24 * 3600
+TREND_MIN_SPAN = 24 * 3600
 
 class SystemResourcesDiagnoser(Diagnoser):
 
@@ -20,6 +28,9 @@ class SystemResourcesDiagnoser(Diagnoser):
         #
 
         ram = psutil.virtual_memory()
+        swap = psutil.swap_memory()
+        ram_history = self.record("ram", ["total", "available", "swap_used"],
+                                  [ram.total, ram.available, swap.used])
         ram_available_percent = 100 * ram.available / ram.total
         item = dict(meta={"test": "ram"},
                     data={"total": human_size(ram.total),
@@ -37,11 +48,18 @@ class SystemResourcesDiagnoser(Diagnoser):
             item["summary"] = "diagnosis_ram_ok"
         yield item
 
+        # Will we run out of RAM soon ?
+        days_left, rate = projection(ram_history, "available", 100 * MB)
+        if days_left is not None and days_left < 7:
+            yield dict(meta={"test": "ram_trend"},
+                       data={"rate": human_size(rate), "days": int(days_left)},
+                       status="WARNING",
+                       summary="diagnosis_ram_trend_decreasing")
+
         #
         # Swap
         #
 
-        swap = psutil.swap_memory()
         item = dict(meta={"test": "swap"},
                     data={"total": human_size(swap.total), "recommended": "512 MiB"})
         if swap.total <= 1 * MB:
@@ -68,6 +86,8 @@ class SystemResourcesDiagnoser(Diagnoser):
             mountpoint = disk_partition.mountpoint
 
             usage = psutil.disk_usage(mountpoint)
+            disk_history = self.record("diskusage:" + mountpoint, ["total", "free"],
+                                       [usage.used + usage.free, usage.free])
             free_percent = 100 - round_(usage.percent)
 
             item = dict(meta={"test": "diskusage", "mountpoint": mountpoint},
@@ -95,23 +115,58 @@ class SystemResourcesDiagnoser(Diagnoser):
 
             yield item
 
+            # Will the disk be full soon ?
+            days_left, rate = projection(disk_history, "free", 0)
+            if days_left is not None and days_left < 30:
+                yield dict(meta={"test": "diskusage_trend", "mountpoint": mountpoint},
+                           data={"rate": human_size(rate), "days": int(days_left)},
+                           status="WARNING" if days_left < 7 else "INFO",
+                           summary="diagnosis_diskusage_trend_full_soon")
+
+    def record(self, series, fields, values):
+        """
+        Record the current measures of a series, and return the measures
+        recorded during the last days
+        """
+
+        now = time.time()
+        history = _get_diagnosis_history(series, fields)
+        records = history.read()
+
+        if not records or now - records[-1][0] >= HISTORY_MIN_INTERVAL:
+            history.append(now, values)
+            records.append(tuple([now] + [float(v) for v in values]))
+
+        return [dict(zip(["time"] + fields, r)) for r in records if now - r[0] <= TREND_WINDOW]
+
+
+def projection(history, field, limit):
+    """
+    Estimate, using a linear regression, in how many days a decreasing
+    measure will reach a limit, and how much it decreases per day
+
+    Returns (None, None) if there is not enough history, or if the measure
+    is not decreasing
+    """
+
+    if len(history) < 3 or history[-1]["time"] - history[0]["time"] < TREND_MIN_SPAN:
+        return None, None
+
+    times = [h["time"] for h in history]
+    values = [h[field] for h in history]
+    mean_time = sum(times) / len(times)
+    mean_value = sum(values) / len(values)
+
+    variance = sum((t - mean_time) ** 2 for t in times)
+    covariance = sum((t - mean_time) * (v - mean_value) for t, v in zip(times, values))
+    slope = covariance / variance
 
-def human_size(bytes_):
-    # Adapted from https://stackoverflow.com/a/1094933
-    for unit in ['','ki','Mi','Gi','Ti','Pi','Ei','Zi']:
-        if abs(bytes_) < 1024.0:
-            return "%s %sB" % (round_(bytes_), unit)
-        bytes_ /= 1024.0
-    return "%s %sB" % (round_(bytes_), 'Yi')
+    if slope >= 0:
+        return None, None
 
+    seconds_left = max(0, values[-1] - limit) / -slope
+    return seconds_left / (24 * 3600), -slope * 24 * 3600
 
-def round_(n):
-    # round_(22.124) -> 22
-    # round_(9.45) -> 9.4
-    n = round(n, 1)
-    if n > 10:
-        n = int(round(n))
-    return n
 
 def main(args, env, loggers):
     return SystemResourcesDiagnoser(args, env, loggers).diagnose()
@@ -0,0 +1,52 @@
+#!/usr/bin/env python
+import os
+
+from yunohost.diagnosis import Diagnoser
+from yunohost.utils.resources import apps_resources_usage, human_size
+
+
+class AppResourcesDiagnoser(Diagnoser):
+
+    id_ = os.path.splitext(os.path.basename(__file__))[0].split("-")[1]
+    cache_duration = 3600
+    dependencies = []
+
+    def run(self):
+
+        usages = apps_resources_usage()
+
+        if not usages:
+            yield dict(meta={"test": "app_resources"},
+                       status="INFO",
+                       summary="diagnosis_appresources_no_apps")
+            return
+
+        # Apps are sorted from the one using the most RAM to the one using the least
+        for usage in usages:
+
+            details = []
+            for service, memory in sorted(usage["services"].items()):
+                details.append(("diagnosis_appresources_service",
+                                {"service": service, "size": human_size(memory)}))
+            if usage["php-fpm"]:
+                details.append(("diagnosis_appresources_phpfpm",
+                                {"size": human_size(usage["php-fpm"])}))
+            for path, size in sorted(usage["dirs"].items()):
+                details.append(("diagnosis_appresources_dir",
+                                {"path": path, "size": human_size(size)}))
+            for database, size in sorted(usage["databases"].items()):
+                details.append(("diagnosis_appresources_database",
+                                {"database": database, "size": human_size(size)}))
+
+            yield dict(meta={"test": "app_resources", "app": usage["app"]},
+                       data={"memory": human_size(usage["memory"]),
+                             "disk": human_size(usage["disk"]),
+                             "memory_bytes": usage["memory"],
+                             "disk_bytes": usage["disk"]},
+                       status="INFO",
+                       summary="diagnosis_appresources_app",
+                       details=details)
+
+
+def main(args, env, loggers):
+    return AppResourcesDiagnoser(args, env, loggers).diagnose()
@@ -4,7 +4,7 @@ import os
 
 import subprocess
 from yunohost.diagnosis import Diagnoser
-from yunohost.regenconf import _get_regenconf_infos, _calculate_hash
+from yunohost.regenconf import _get_regenconf_infos, _file_matches_hash, _save_hash_cache
 
 
 class RegenconfDiagnoser(Diagnoser):
@@ -12,6 +12,7 @@ class RegenconfDiagnoser(Diagnoser):
     id_ = os.path.splitext(os.path.basename(__file__))[0].split("-")[1]
     cache_duration = 300
     dependencies = []
+    inputs = ["regenconf", "conffiles"]
 
     def run(self):
 
@@ -34,9 +35,11 @@ class RegenconfDiagnoser(Diagnoser):
 
         for category, infos in _get_regenconf_infos().items():
             for path, hash_ in infos["conffiles"].items():
-                if hash_ != _calculate_hash(path):
+                if not _file_matches_hash(path, hash_):
                     yield {"path": path, "category": category}
 
+        _save_hash_cache()
+
 
 def main(args, env, loggers):
     return RegenconfDiagnoser(args, env, loggers).diagnose()
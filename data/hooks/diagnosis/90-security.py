@@ -13,6 +13,7 @@ class SecurityDiagnoser(Diagnoser):
     id_ = os.path.splitext(os.path.basename(__file__))[0].split("-")[1]
     cache_duration = 3600
     dependencies = []
+    inputs = ["dpkg", "kernel"]
 
     def run(self):
 
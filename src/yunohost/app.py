@@ -40,7 +40,8 @@ from datetime import datetime
 from moulinette import msignals, m18n, msettings
 from moulinette.utils.log import getActionLogger
 from moulinette.utils.network import download_json
-from moulinette.utils.filesystem import read_file, read_json, read_toml, read_yaml, write_to_file, write_to_json, write_to_yaml, chmod, chown, mkdir
+from moulinette.utils.filesystem import read_file, read_json, read_toml, write_to_file, write_to_json, write_to_yaml, chmod, chown, mkdir
+from yunohost.utils.filesystem import read_yaml, SafeLoader
 
 from yunohost.service import service_log, service_status, _run_service_command
 from yunohost.utils import packages
@@ -182,6 +183,25 @@ def app_info(app, full=False):
     return ret
 
 
+def app_resources(app=[]):
+    """
+    Show the RAM and disk space used by installed apps, from the most
+    demanding to the least
+
+    Keyword argument:
+        app -- Specific apps to look at
+
+    """
+
+    from yunohost.utils.resources import apps_resources_usage
+
+    for app_id in app:
+        if not _is_installed(app_id):
+            raise YunohostError('app_not_installed', app=app_id, all_apps=_get_all_installed_apps_id())
+
+    return {'apps': apps_resources_usage(app or None)}
+
+
 def _app_upgradable(app_infos):
 
     # Determine upgradability
@@ -1865,7 +1885,7 @@ def _get_app_settings(app_id):
     try:
         with open(os.path.join(
                 APPS_SETTING_PATH, app_id, 'settings.yml')) as f:
-            settings = yaml.load(f)
+            settings = yaml.load(f, Loader=SafeLoader)
         if app_id == settings['id']:
             return settings
     except (IOError, TypeError, KeyError):
@@ -2839,7 +2859,11 @@ def _assert_system_is_sane_for_app(manifest, when):
         services.append("fail2ban")
 
     # List services currently down and raise an exception if any are found
-    faulty_services = [s for s in services if service_status(s)["status"] != "running"]
+    # (fetching all the statuses at once is much faster than one by one)
+    statuses = service_status(services)
+    if len(services) == 1:
+        statuses = {services[0]: statuses}
+    faulty_services = [s for s in services if statuses[s]["status"] != "running"]
     if faulty_services:
         if when == "pre":
             raise YunohostError('app_action_cannot_be_ran_because_required_services_down',
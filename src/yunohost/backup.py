@@ -25,8 +25,10 @@
 """
 import os
 import re
+import copy
 import json
 import time
+import hashlib
 import tarfile
 import shutil
 import subprocess
@@ -35,12 +37,12 @@ import tempfile
 from datetime import datetime
 from glob import glob
 from collections import OrderedDict
-from functools import reduce
 
 from moulinette import msignals, m18n, msettings
 from moulinette.utils import filesystem
 from moulinette.utils.log import getActionLogger
-from moulinette.utils.filesystem import read_file, mkdir, write_to_yaml, read_yaml
+from moulinette.utils.filesystem import read_file, mkdir, write_to_yaml, write_to_json
+from yunohost.utils.filesystem import read_yaml, disk_usage, scan_disk_usage
 
 from yunohost.app import (
     app_info, _is_installed, _parse_app_instance_name, _patch_php5, dump_app_log_extract_for_debugging, _patch_legacy_helpers
@@ -53,15 +55,24 @@ from yunohost.regenconf import regen_conf
 from yunohost.log import OperationLogger
 from yunohost.utils.error import YunohostError
 from yunohost.utils.packages import ynh_packages_version
+from yunohost.utils.archive import (
+    COMPRESSIONS, STREAM_BUFFER_SIZE, open_archive, extract_members, extract_indexed_members,
+    detect_compression, split_archive_extension
+)
 
 BACKUP_PATH = '/home/yunohost.backup'
 ARCHIVES_PATH = '%s/archives' % BACKUP_PATH
+BACKUP_CATALOG_FILE = '%s/catalog.json' % ARCHIVES_PATH
 APP_MARGIN_SPACE_SIZE = 100  # In MB
 CONF_MARGIN_SPACE_SIZE = 10  # IN MB
 POSTINSTALL_ESTIMATE_SPACE_SIZE = 5  # In MB
 MB_ALLOWED_TO_ORGANIZE = 10
 logger = getActionLogger('yunohost.backup')
 
+# Lazy dev caching of the backup catalog, along with the stat signature of the
+# catalog file it was loaded from, c.f. _get_backup_catalog
+backup_catalog_ = None
+
 
 class BackupRestoreTargetsManager(object):
 
@@ -253,6 +264,8 @@ class BackupManager():
         self.system_return = {}
         self.methods = []
         self.paths_to_backup = []
+        # Size of each source path, as computed by _compute_backup_size()
+        self.paths_size = {}
         self.size_details = {
             'system': {},
             'apps': {}
@@ -780,26 +793,37 @@ class BackupManager():
         for app_key in self.apps_return:
             self.size_details['apps'][app_key] = 0
 
-        for row in self.paths_to_backup:
-            if row['dest'] != "info.json":
-                size = disk_usage(row['source'])
-
-                # Add size to apps details
-                splitted_dest = row['dest'].split('/')
-                category = splitted_dest[0]
-                if category == 'apps':
-                    for app_key in self.apps_return:
-                        if row['dest'].startswith('apps/' + app_key):
-                            self.size_details['apps'][app_key] += size
-                            break
-                # OR Add size to the correct system element
-                elif category == 'data' or category == 'conf':
-                    for system_key in self.system_return:
-                        if row['dest'].startswith(system_key.replace('_', '/')):
-                            self.size_details['system'][system_key] += size
-                            break
-
-                self.size += size
+        # Walk all the paths at once. Files hardlinked from several paths are
+        # only counted for the first one.
+        rows = [row for row in self.paths_to_backup if row['dest'] != "info.json"]
+        usages = scan_disk_usage([row['source'] for row in rows])
+        self.paths_size = {path: size + sum(linked.values())
+                           for path, (size, linked) in usages.items()}
+        counted = set()
+
+        for row in rows:
+            size, linked = usages[row['source']]
+            for inode, inode_size in linked.items():
+                if inode not in counted:
+                    counted.add(inode)
+                    size += inode_size
+
+            # Add size to apps details
+            splitted_dest = row['dest'].split('/')
+            category = splitted_dest[0]
+            if category == 'apps':
+                for app_key in self.apps_return:
+                    if row['dest'].startswith('apps/' + app_key):
+                        self.size_details['apps'][app_key] += size
+                        break
+            # OR Add size to the correct system element
+            elif category == 'data' or category == 'conf':
+                for system_key in self.system_return:
+                    if row['dest'].startswith(system_key.replace('_', '/')):
+                        self.size_details['system'][system_key] += size
+                        break
+
+            self.size += size
 
         return self.size
 
@@ -809,7 +833,8 @@ class RestoreManager():
     """
     RestoreManager allow to restore a past backup archive
 
-    Currently it's a tar.gz file, but it could be another kind of archive
+    Currently it's a tar file (possibly compressed), but it could be another
+    kind of archive
 
     Public properties:
         info (getter)i # FIXME
@@ -1486,8 +1511,9 @@ class BackupMethod(object):
 
     TarBackupMethod
     ---------------
-    This method compresses all files to backup in a .tar.gz archive. When
-    restoring, it untars the required parts.
+    This method puts all files to backup in a .tar archive, compressed with gzip
+    (.tar.gz), zstd (.tar.zst) or not at all. When restoring, it untars the
+    required parts.
 
     CustomBackupMethod
     ------------------
@@ -1718,8 +1744,11 @@ class BackupMethod(object):
         # It could be just for some small files on different filesystems or due
         # to mounting error
 
-        # Compute size to copy
-        size = sum(disk_usage(path['source']) for path in paths_needed_to_be_copied)
+        # Compute size to copy (already known for the paths to backup)
+        sources = [path['source'] for path in paths_needed_to_be_copied]
+        sizes = dict(self.manager.paths_size)
+        sizes.update(disk_usage([source for source in sources if source not in sizes]))
+        size = sum(sizes[source] for source in sources)
         size /= (1024 * 1024)  # Convert bytes to megabytes
 
         # Ask confirmation for copying
@@ -1843,8 +1872,10 @@ class TarBackupMethod(BackupMethod):
     This class compress all files to backup in archive.
     """
 
-    def __init__(self, repo=None):
+    def __init__(self, repo=None, compression="gz", compression_level=None):
         super(TarBackupMethod, self).__init__(repo)
+        self.compression = compression
+        self.compression_level = compression_level
 
     @property
     def method_name(self):
@@ -1853,7 +1884,9 @@ class TarBackupMethod(BackupMethod):
     @property
     def _archive_file(self):
         """Return the compress archive path"""
-        return os.path.join(self.repo, self.name + '.tar.gz')
+        if isinstance(self.manager, RestoreManager):
+            return self.manager.archive_path
+        return os.path.join(self.repo, self.name + COMPRESSIONS[self.compression]["extension"])
 
     def backup(self):
         """
@@ -1876,7 +1909,8 @@ class TarBackupMethod(BackupMethod):
 
         # Open archive file for writing
         try:
-            tar = tarfile.open(self._archive_file, "w:gz")
+            tar = open_archive(self._archive_file, "w", self.compression,
+                               self.compression_level)
         except:
             logger.debug("unable to open '%s' for writing",
                          self._archive_file, exc_info=1)
@@ -1885,6 +1919,9 @@ class TarBackupMethod(BackupMethod):
         # Add files to the archive
         try:
             for path in self.manager.paths_to_backup:
+                # Start each path in a new block when possible, so that
+                # restoring a single part doesn't decompress the previous ones
+                tar.new_block()
                 # Add the "source" into the archive and transform the path into
                 # "dest"
                 tar.add(path['source'], arcname=path['dest'])
@@ -1892,15 +1929,23 @@ class TarBackupMethod(BackupMethod):
             logger.error(m18n.n('backup_archive_writing_error', source=path['source'], archive=self._archive_file, dest=path['dest']), exc_info=1)
             raise YunohostError('backup_creation_failed')
         finally:
-            tar.close()
+            try:
+                tar.close()
+            except IOError:
+                logger.debug("unable to finish writing '%s'",
+                             self._archive_file, exc_info=1)
+                raise YunohostError('backup_creation_failed')
 
         # Move info file
         shutil.copy(os.path.join(self.work_dir, 'info.json'),
                     os.path.join(ARCHIVES_PATH, self.name + '.info.json'))
 
+        # Save the index of the members of the archive
+        write_to_json(os.path.join(ARCHIVES_PATH, self.name + '.index.json'), tar.index)
+
         # If backuped to a non-default location, keep a symlink of the archive
         # to that location
-        link = os.path.join(ARCHIVES_PATH, self.name + '.tar.gz')
+        link = os.path.join(ARCHIVES_PATH, os.path.basename(self._archive_file))
         if not os.path.isfile(link):
             os.symlink(self._archive_file, link)
 
@@ -1916,49 +1961,20 @@ class TarBackupMethod(BackupMethod):
         """
         super(TarBackupMethod, self).mount(restore_manager)
 
-        # Check the archive can be open
-        try:
-            tar = tarfile.open(self._archive_file, "r:gz")
-        except:
-            logger.debug("cannot open backup archive '%s'",
-                         self._archive_file, exc_info=1)
-            raise YunohostError('backup_archive_open_failed')
-
-        try:
-            files_in_archive = tar.getnames()
-        except IOError as e:
-            raise YunohostError("backup_archive_corrupted", archive=self._archive_file, error=str(e))
-
-        # FIXME : Is this really useful to close the archive just to
-        # reopen it right after this with the same options ...?
-        tar.close()
+        index = _get_archive_index(self.name, self._archive_file)
 
-        # Mount the tarball
-        logger.debug(m18n.n("restore_extracting"))
-        tar = tarfile.open(self._archive_file, "r:gz")
-
-        if "info.json" in files_in_archive:
-            leading_dot = ""
-            tar.extract('info.json', path=self.work_dir)
-        elif "./info.json" in files_in_archive:
-            leading_dot = "./"
-            tar.extract('./info.json', path=self.work_dir)
-        else:
-            logger.debug("unable to retrieve 'info.json' inside the archive",
-                         exc_info=1)
-            tar.close()
-            raise YunohostError('backup_archive_cant_retrieve_info_json', archive=self._archive_file)
-
-        if "backup.csv" in files_in_archive:
-            tar.extract('backup.csv', path=self.work_dir)
-        elif "./backup.csv" in files_in_archive:
-            tar.extract('./backup.csv', path=self.work_dir)
-        else:
-            # Old backup archive have no backup.csv file
-            pass
+        # Check the archive can be open
+        if index is None:
+            try:
+                tar = open_archive(self._archive_file)
+            except:
+                logger.debug("cannot open backup archive '%s'",
+                             self._archive_file, exc_info=1)
+                raise YunohostError('backup_archive_open_failed')
 
-        # Extract system parts backup
-        conf_extracted = False
+        # Paths to extract: info files, restore hooks, and the system parts /
+        # apps to restore
+        paths = ["info.json", "backup.csv", "hooks/restore"]
 
         system_targets = self.manager.targets.list("system", exclude=["Skipped"])
         apps_targets = self.manager.targets.list("apps", exclude=["Skipped"])
@@ -1967,32 +1983,37 @@ class TarBackupMethod(BackupMethod):
             # Caution: conf_ynh_currenthost helpers put its files in
             # conf/ynh
             if system_part.startswith("conf_"):
-                if conf_extracted:
-                    continue
-                system_part = "conf/"
-                conf_extracted = True
+                paths.append("conf")
             else:
-                system_part = system_part.replace("_", "/") + "/"
-            subdir_and_files = [
-                tarinfo for tarinfo in tar.getmembers()
-                if tarinfo.name.startswith(leading_dot+system_part)
-            ]
-            tar.extractall(members=subdir_and_files, path=self.work_dir)
-        subdir_and_files = [
-            tarinfo for tarinfo in tar.getmembers()
-            if tarinfo.name.startswith(leading_dot+"hooks/restore/")
-        ]
-        tar.extractall(members=subdir_and_files, path=self.work_dir)
-
-        # Extract apps backup
+                paths.append(system_part.replace("_", "/"))
         for app in apps_targets:
-            subdir_and_files = [
-                tarinfo for tarinfo in tar.getmembers()
-                if tarinfo.name.startswith(leading_dot+"apps/" + app)
-            ]
-            tar.extractall(members=subdir_and_files, path=self.work_dir)
+            paths.append("apps/" + app)
 
-        # FIXME : Don't we want to close the tar archive here or at some point ?
+        def wanted(name):
+            # Some archives have paths starting with './'
+            if name.startswith("./"):
+                name = name[2:]
+            return any(name == path or name.startswith(path + "/") for path in paths)
+
+        # Mount the tarball. Using its index, we only decompress the parts
+        # holding what we need. Otherwise, it is done in a single pass as it is
+        # streamed from the decompressor.
+        logger.debug(m18n.n("restore_extracting"))
+        try:
+            if index is not None:
+                extracted = extract_indexed_members(self._archive_file, index, self.work_dir, wanted)
+            else:
+                try:
+                    extracted = extract_members(tar, self.work_dir, wanted)
+                finally:
+                    tar.close()
+        except (IOError, OSError, KeyError, tarfile.TarError) as e:
+            raise YunohostError("backup_archive_corrupted", archive=self._archive_file, error=str(e))
+
+        if "info.json" not in extracted and "./info.json" not in extracted:
+            logger.debug("unable to retrieve 'info.json' inside the archive",
+                         exc_info=1)
+            raise YunohostError('backup_archive_cant_retrieve_info_json', archive=self._archive_file)
 
 
 class BorgBackupMethod(BackupMethod):
@@ -2090,6 +2111,7 @@ class CustomBackupMethod(BackupMethod):
 
 def backup_create(name=None, description=None, methods=[],
                   output_directory=None, no_compress=False,
+                  compression="gz", compression_level=None,
                   system=[], apps=[]):
     """
     Create a backup local archive
@@ -2100,6 +2122,8 @@ def backup_create(name=None, description=None, methods=[],
         method -- Method of backup to use
         output_directory -- Output directory for the backup
         no_compress -- Do not create an archive file
+        compression -- Compression of the archive (gz, zstd or none)
+        compression_level -- Compression level of the archive
         system -- List of system elements to backup
         apps -- List of application names to backup
     """
@@ -2132,6 +2156,16 @@ def backup_create(name=None, description=None, methods=[],
     elif no_compress:
         raise YunohostError('backup_output_directory_required')
 
+    # Validate compression options
+    if compression not in COMPRESSIONS:
+        raise YunohostError('backup_compression_unknown', compression=compression,
+                            compressions=", ".join(COMPRESSIONS.keys()))
+    if compression_level is not None:
+        levels = COMPRESSIONS[compression]["levels"]
+        if levels is None or not levels[0] <= compression_level <= levels[1]:
+            raise YunohostError('backup_compression_level_invalid', compression=compression,
+                                levels="%s-%s" % levels if levels else "-")
+
     # Define methods (retro-compat)
     if not methods:
         if no_compress:
@@ -2165,6 +2199,9 @@ def backup_create(name=None, description=None, methods=[],
         methods = BackupMethod.create(methods)
 
     for method in methods:
+        if isinstance(method, TarBackupMethod):
+            method.compression = compression
+            method.compression_level = compression_level
         backup_manager.add(method)
 
     # Add backup targets (system and apps)
@@ -2182,6 +2219,14 @@ def backup_create(name=None, description=None, methods=[],
     logger.info(m18n.n("backup_actually_backuping"))
     backup_manager.backup()
 
+    # Add the archive to the catalog while its info.json and index are at
+    # hand, such that listing the backups never has to open it
+    if _get_archive_file(backup_manager.name) is not None:
+        try:
+            backup_info(backup_manager.name)
+        except YunohostError as e:
+            logger.warning(str(e))
+
     logger.success(m18n.n('backup_created'))
 
     return {
@@ -2271,9 +2316,11 @@ def backup_list(with_info=False, human_readable=False):
 
     """
     # Get local archives sorted according to last modification time
-    archives = sorted(glob("%s/*.tar.gz" % ARCHIVES_PATH), key=lambda x: os.path.getctime(x))
+    archives = [f for f in glob("%s/*.tar*" % ARCHIVES_PATH)
+                if split_archive_extension(f)[1]]
+    archives = sorted(archives, key=lambda x: os.path.getctime(x))
     # Extract only filename without the extension
-    archives = [os.path.basename(f)[:-len(".tar.gz")] for f in archives]
+    archives = [split_archive_extension(os.path.basename(f))[0] for f in archives]
 
     if with_info:
         d = OrderedDict()
@@ -2301,10 +2348,10 @@ def backup_info(name, with_details=False, human_readable=False):
         human_readable -- Print sizes in human readable format
 
     """
-    archive_file = '%s/%s.tar.gz' % (ARCHIVES_PATH, name)
+    archive_file = _get_archive_file(name)
 
     # Check file exist (even if it's a broken symlink)
-    if not os.path.lexists(archive_file):
+    if archive_file is None:
         raise YunohostError('backup_archive_name_unknown', name=name)
 
     # If symlink, retrieve the real path
@@ -2316,66 +2363,26 @@ def backup_info(name, with_details=False, human_readable=False):
             raise YunohostError('backup_archive_broken_link',
                                 path=archive_file)
 
-    info_file = "%s/%s.info.json" % (ARCHIVES_PATH, name)
+    entry = _get_backup_catalog_entry(name, archive_file)
 
-    if not os.path.exists(info_file):
-        tar = tarfile.open(archive_file, "r:gz")
-        info_dir = info_file + '.d'
-
-        try:
-            files_in_archive = tar.getnames()
-        except IOError as e:
-            raise YunohostError("backup_archive_corrupted", archive=archive_file, error=str(e))
-
-        try:
-            if "info.json" in files_in_archive:
-                tar.extract('info.json', path=info_dir)
-            elif "./info.json" in files_in_archive:
-                tar.extract('./info.json', path=info_dir)
-            else:
-                raise KeyError
-        except KeyError:
-            logger.debug("unable to retrieve '%s' inside the archive",
-                         info_file, exc_info=1)
-            raise YunohostError('backup_archive_cant_retrieve_info_json', archive=archive_file)
-        else:
-            shutil.move(os.path.join(info_dir, 'info.json'), info_file)
-        finally:
-            tar.close()
-        os.rmdir(info_dir)
-
-    try:
-        with open(info_file) as f:
-            # Retrieve backup info
-            info = json.load(f)
-    except:
-        logger.debug("unable to load '%s'", info_file, exc_info=1)
-        raise YunohostError('backup_archive_cant_retrieve_info_json', archive=archive_file)
-
-    # Retrieve backup size
-    size = info.get('size', 0)
-    if not size:
-        tar = tarfile.open(archive_file, "r:gz")
-        size = reduce(lambda x, y: getattr(x, 'size', x) + getattr(y, 'size', y),
-                      tar.getmembers())
-        tar.close()
+    size = entry['size']
     if human_readable:
         size = binary_to_human(size) + 'B'
 
     result = {
         'path': archive_file,
-        'created_at': datetime.utcfromtimestamp(info['created_at']),
-        'description': info['description'],
+        'created_at': datetime.utcfromtimestamp(entry['created_at']),
+        'description': entry['description'],
         'size': size,
+        'compression': entry['compression'],
+        'checksum': entry['checksum'],
     }
 
     if with_details:
-        system_key = "system"
-        # Historically 'system' was 'hooks'
-        if "hooks" in info.keys():
-            system_key = "hooks"
+        # The entry is shared with the catalog cache, don't alter it
+        info = copy.deepcopy(entry)
 
-        if "size_details" in info.keys():
+        if info["size_details"] is not None:
             for category in ["apps", "system"]:
                 for name, key_info in info[category].items():
 
@@ -2397,10 +2404,54 @@ def backup_info(name, with_details=False, human_readable=False):
                             key_info["size"] = "?"
 
         result["apps"] = info["apps"]
-        result["system"] = info[system_key]
+        result["system"] = info["system"]
     return result
 
 
+def backup_refresh_catalog():
+    """
+    Add the archives missing from the backup catalog (e.g. the ones created
+    by an older version or copied by hand), compute the missing checksums
+    and forget about the archives which don't exist anymore
+
+    """
+    archives = backup_list()["archives"]
+
+    catalog = _get_backup_catalog()
+    for name in list(catalog.keys()):
+        if name not in archives:
+            del catalog[name]
+    _save_backup_catalog()
+
+    checksummed = 0
+    for name in archives:
+        try:
+            archive_file = backup_info(name)["path"]
+        except YunohostError as e:
+            logger.warning(str(e))
+            continue
+
+        entry = _get_backup_catalog().get(name)
+        if entry is None or entry["checksum"]:
+            continue
+
+        try:
+            checksum = _hash_archive(archive_file)
+        except IOError as e:
+            logger.warning(m18n.n('backup_archive_checksum_failed', archive=archive_file, error=str(e)))
+            continue
+
+        # Computing the checksum of a big archive takes a while, so make
+        # sure it was not modified or deleted in the meantime
+        entry = _get_backup_catalog().get(name)
+        if entry is not None and entry["signature"] == _stat_signature(archive_file):
+            entry["checksum"] = checksum
+            _save_backup_catalog()
+            checksummed += 1
+
+    logger.success(m18n.n('backup_catalog_refreshed', archives=len(archives), checksummed=checksummed))
+
+
 def backup_delete(name):
     """
     Delete a backup
@@ -2415,10 +2466,13 @@ def backup_delete(name):
 
     hook_callback('pre_backup_delete', args=[name])
 
-    archive_file = '%s/%s.tar.gz' % (ARCHIVES_PATH, name)
+    archive_file = _get_archive_file(name)
     info_file = "%s/%s.info.json" % (ARCHIVES_PATH, name)
+    index_file = "%s/%s.index.json" % (ARCHIVES_PATH, name)
 
     files_to_delete = [archive_file, info_file]
+    if os.path.exists(index_file):
+        files_to_delete.append(index_file)
 
     # To handle the case where archive_file is in fact a symlink
     if os.path.islink(archive_file):
@@ -2432,6 +2486,9 @@ def backup_delete(name):
             logger.debug("unable to delete '%s'", backup_file, exc_info=1)
             logger.warning(m18n.n('backup_delete_error', path=backup_file))
 
+    _get_backup_catalog().pop(name, None)
+    _save_backup_catalog()
+
     hook_callback('post_backup_delete', args=[name])
 
     logger.success(m18n.n('backup_deleted'))
@@ -2452,6 +2509,199 @@ def _create_archive_dir():
         mkdir(ARCHIVES_PATH, mode=0o750, parents=True, uid="admin", gid="root")
 
 
+def _get_archive_file(name):
+    """
+    Return the path of a local archive (whatever its compression), or None if
+    there is no such archive. The path may be a symlink to the actual archive.
+    """
+    for compression in COMPRESSIONS.values():
+        archive_file = os.path.join(ARCHIVES_PATH, name + compression["extension"])
+        # Check file exist (even if it's a broken symlink)
+        if os.path.lexists(archive_file):
+            return archive_file
+    return None
+
+
+def _get_archive_index(name, archive_file):
+    """
+    Load the index of the members of a local archive (c.f.
+    yunohost.utils.archive.IndexedTarFile)
+
+    Returns None if the archive has no index, e.g. because it was created by
+    an older version, or if the index doesn't match the archive anymore
+    """
+    index_file = "%s/%s.index.json" % (ARCHIVES_PATH, name)
+    if not os.path.exists(index_file):
+        return None
+
+    try:
+        with open(index_file) as f:
+            index = json.load(f)
+    except:
+        logger.debug("unable to load '%s'", index_file, exc_info=1)
+        return None
+
+    if index.get("archive_size") != os.path.getsize(archive_file):
+        logger.debug("ignoring '%s' which doesn't match the archive", index_file)
+        return None
+
+    return index
+
+
+def _read_archive_metadata(name, archive_file):
+    """
+    Retrieve the metadata of an archive from its info.json and its index,
+    opening the archive only for legacy archives lacking those
+
+    """
+    info_file = "%s/%s.info.json" % (ARCHIVES_PATH, name)
+    index = _get_archive_index(name, archive_file)
+
+    if not os.path.exists(info_file):
+        info_dir = info_file + '.d'
+
+        def is_info_json(member_name):
+            return member_name in ["info.json", "./info.json"]
+
+        try:
+            if index is not None:
+                found = extract_indexed_members(archive_file, index, info_dir, is_info_json)
+            else:
+                tar = open_archive(archive_file)
+                try:
+                    found = False
+                    for member in tar:
+                        if is_info_json(member.name):
+                            tar.extract(member, path=info_dir)
+                            found = True
+                            break
+                finally:
+                    tar.close()
+            if not found:
+                raise KeyError
+        except (IOError, tarfile.TarError) as e:
+            raise YunohostError("backup_archive_corrupted", archive=archive_file, error=str(e))
+        except KeyError:
+            logger.debug("unable to retrieve '%s' inside the archive",
+                         info_file, exc_info=1)
+            raise YunohostError('backup_archive_cant_retrieve_info_json', archive=archive_file)
+        else:
+            shutil.move(os.path.join(info_dir, 'info.json'), info_file)
+        os.rmdir(info_dir)
+
+    try:
+        with open(info_file) as f:
+            # Retrieve backup info
+            info = json.load(f)
+    except:
+        logger.debug("unable to load '%s'", info_file, exc_info=1)
+        raise YunohostError('backup_archive_cant_retrieve_info_json', archive=archive_file)
+
+    # Retrieve backup size
+    size = info.get('size', 0)
+    if not size and index is not None:
+        size = sum(member_size for _, _, member_size in index["members"])
+    elif not size:
+        tar = open_archive(archive_file)
+        try:
+            size = sum(member.size for member in tar)
+        finally:
+            tar.close()
+
+    system_key = "system"
+    # Historically 'system' was 'hooks'
+    if "hooks" in info.keys():
+        system_key = "hooks"
+
+    return {
+        'path': archive_file,
+        'created_at': info['created_at'],
+        'description': info['description'],
+        'size': size,
+        'compression': index["compression"] if index else detect_compression(archive_file),
+        'apps': info["apps"],
+        'system': info[system_key],
+        'size_details': info.get("size_details"),
+    }
+
+
+def _stat_signature(path):
+    """What has to change for a catalog entry to be computed again"""
+
+    stat = os.stat(path)
+    return [stat.st_size, int(stat.st_mtime * 10**9)]
+
+
+def _get_backup_catalog():
+    """Load the backup catalog, again if it was modified by another process"""
+
+    global backup_catalog_
+    try:
+        signature = _stat_signature(BACKUP_CATALOG_FILE)
+    except OSError:
+        signature = None
+
+    if backup_catalog_ is None or backup_catalog_[0] != signature:
+        catalog = {}
+        if signature is not None:
+            try:
+                with open(BACKUP_CATALOG_FILE) as f:
+                    catalog = json.load(f)
+            except Exception as e:
+                logger.warning("Error while loading the backup catalog: %s", e)
+        backup_catalog_ = [signature, catalog]
+
+    return backup_catalog_[1]
+
+
+def _save_backup_catalog():
+
+    global backup_catalog_
+    if not os.path.isdir(ARCHIVES_PATH):
+        return
+
+    try:
+        # Write then rename, such that the catalog is never half-written
+        tmp_file = BACKUP_CATALOG_FILE + ".tmp"
+        with open(tmp_file, 'w') as f:
+            json.dump(backup_catalog_[1], f)
+        os.rename(tmp_file, BACKUP_CATALOG_FILE)
+        backup_catalog_[0] = _stat_signature(BACKUP_CATALOG_FILE)
+    except Exception as e:
+        logger.warning("Error while saving the backup catalog: %s", e)
+
+
+def _get_backup_catalog_entry(name, archive_file):
+    """
+    Get the catalog entry of an archive, adding or updating it if the archive
+    is not in the catalog yet or changed since
+
+    """
+    catalog = _get_backup_catalog()
+    signature = _stat_signature(archive_file)
+
+    entry = catalog.get(name)
+    if entry and entry["path"] == archive_file and entry["signature"] == signature:
+        return entry
+
+    entry = _read_archive_metadata(name, archive_file)
+    entry["signature"] = signature
+    entry["checksum"] = None
+    catalog[name] = entry
+    _save_backup_catalog()
+
+    return entry
+
+
+def _hash_archive(archive_file):
+
+    hasher = hashlib.sha256()
+    with open(archive_file, 'rb') as f:
+        for chunk in iter(lambda: f.read(STREAM_BUFFER_SIZE), b''):
+            hasher.update(chunk)
+    return "sha256:%s" % hasher.hexdigest()
+
+
 def _call_for_each_path(self, callback, csv_path=None):
     """ Call a callback for each path in csv """
     if csv_path is None:
@@ -2491,14 +2741,6 @@ def free_space_in_directory(dirpath):
     return stat.f_frsize * stat.f_bavail
 
 
-def disk_usage(path):
-    # We don't do this in python with os.stat because we don't want
-    # to follow symlinks
-
-    du_output = subprocess.check_output(['du', '-sb', path])
-    return int(du_output.split()[0].decode('utf-8'))
-
-
 def binary_to_human(n, customary=False):
     """
     Convert bytes or bits into human readable format with binary prefix
@@ -6,7 +6,7 @@ from moulinette.utils.log import getActionLogger
 from moulinette.utils.filesystem import chown
 
 from yunohost.tools import Migration
-from yunohost.regenconf import _get_conf_hashes, _calculate_hash
+from yunohost.regenconf import _get_conf_hashes, _file_matches_hash
 from yunohost.regenconf import regen_conf
 from yunohost.settings import settings_set, settings_get
 from yunohost.utils.error import YunohostError
@@ -52,9 +52,8 @@ class MyMigration(Migration):
         # and the migration can be done automatically
         # (basically nothing shall change)
         ynh_hash = _get_conf_hashes('ssh').get(SSHD_CONF, None)
-        current_hash = _calculate_hash(SSHD_CONF)
         dsa = settings_get("service.ssh.allow_deprecated_dsa_hostkey")
-        if ynh_hash == current_hash and not dsa:
+        if ynh_hash and _file_matches_hash(SSHD_CONF, ynh_hash) and not dsa:
             return "auto"
 
         return "manual"
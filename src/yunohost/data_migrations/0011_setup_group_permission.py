@@ -4,7 +4,7 @@ import os
 from moulinette import m18n
 from yunohost.utils.error import YunohostError
 from moulinette.utils.log import getActionLogger
-from moulinette.utils.filesystem import read_yaml
+from yunohost.utils.filesystem import read_yaml
 
 from yunohost.tools import Migration
 from yunohost.user import user_list, user_group_create, user_group_update
@@ -0,0 +1,40 @@
+import os
+
+from moulinette import m18n
+from moulinette.utils.log import getActionLogger
+
+from yunohost.tools import Migration
+from yunohost.regenconf import _get_regenconf_infos, _save_regenconf_infos, \
+    _calculate_hash, _hash_algorithm, _save_hash_cache, HASH_ALGORITHM, REGEN_CONF_FILE
+
+logger = getActionLogger('yunohost.migration')
+
+
+class MyMigration(Migration):
+
+    """
+    Convert the md5 hashes of regenconf.yml to the faster digest now used to
+    track the state of the configuration files
+    """
+
+    def run(self):
+
+        if HASH_ALGORITHM == "md5" or not os.path.exists(REGEN_CONF_FILE):
+            logger.warning(m18n.n("migration_0015_not_needed"))
+            return
+
+        categories = _get_regenconf_infos()
+        for category, infos in categories.items():
+            conffiles = (infos or {}).get("conffiles") or {}
+            for path, hash_ in conffiles.items():
+                if not hash_ or _hash_algorithm(hash_) == HASH_ALGORITHM:
+                    continue
+                # The hash is the one of the conf we generated : we can only
+                # compute the new one if the file wasn't modified since then.
+                # Otherwise, the md5 is kept (and still handled by regen-conf)
+                # until the file is regenerated.
+                if _calculate_hash(path, _hash_algorithm(hash_)) == hash_:
+                    conffiles[path] = _calculate_hash(path)
+
+        _save_regenconf_infos(categories)
+        _save_hash_cache()
@@ -26,20 +26,46 @@
 
 import re
 import os
+import sys
+import json
 import time
+import urllib
+import hashlib
+import logging
+import threading
+
+from datetime import datetime
 
 from moulinette import m18n, msettings
 from moulinette.utils import log
-from moulinette.utils.filesystem import read_json, write_to_json, read_yaml, write_to_yaml
+from moulinette.utils.filesystem import read_json, write_to_json, write_to_yaml
+from yunohost.utils.filesystem import read_yaml
 
 from yunohost.utils.error import YunohostError
+from yunohost.utils.ringbuffer import RingBufferFile
 from yunohost.hook import hook_list, hook_exec
 
 logger = log.getActionLogger('yunohost.diagnosis')
 
 DIAGNOSIS_CACHE = "/var/cache/yunohost/diagnosis/"
+DIAGNOSIS_HISTORY_DIR = os.path.join(DIAGNOSIS_CACHE, "history")
 DIAGNOSIS_CONFIG_FILE = '/etc/yunohost/diagnosis.yml'
 DIAGNOSIS_SERVER = "diagnosis.yunohost.org"
+DIAGNOSIS_SERVER_URL = "https://%s" % DIAGNOSIS_SERVER
+DIAGNOSIS_MAX_PARALLEL = 4
+# Maximum time during which a cached report is reused, as long as the inputs
+# of its category did not change, c.f. Diagnoser.inputs
+DIAGNOSIS_MAX_CACHE_DURATION = 24 * 3600
+
+# Lazy dev caching of the HTTP sessions used to talk to the diagnosis server,
+# one per IP version, such that connections are reused across requests and
+# categories, c.f. _get_remote_diagnosis_session
+remote_diagnosis_sessions_ = {}
+remote_diagnosis_sessions_lock_ = threading.Lock()
+
+# Cached reports loaded during the ongoing diagnosis run, shared by all the
+# categories being diagnosed, c.f. DiagnosisReportStore
+diagnosis_reports_ = None
 
 def diagnosis_list():
     all_categories_names = [h for h, _ in _list_diagnosis_categories()]
@@ -99,6 +125,7 @@ def diagnosis_show(categories=[], issues=False, full=False, share=False):
         if not full:
             del report["timestamp"]
             del report["cached_for"]
+            report.pop("fingerprint", None)
             report["items"] = [item for item in report["items"] if not item["ignored"]]
             for item in report["items"]:
                 del item["meta"]
@@ -161,22 +188,42 @@ def diagnosis_run(categories=[], force=False, except_if_never_ran_yet=False):
         if unknown_categories:
             raise YunohostError('diagnosis_unknown_categories', categories=", ".join(unknown_categories))
 
-    issues = []
-    # Call the hook ...
-    diagnosed_categories = []
-    for category in categories:
-        logger.debug("Running diagnosis for %s ..." % category)
-        path = [p for n, p in all_categories if n == category][0]
+    paths = dict(all_categories)
+    dependencies = {category: [d for d in _get_diagnoser_dependencies(paths[category])
+                               if d in categories]
+                    for category in categories}
 
+    def run(category):
+        logger.debug("Running diagnosis for %s ..." % category)
         try:
-            code, report = hook_exec(path, args={"force": force}, env=None)
+            code, report = hook_exec(paths[category], args={"force": force}, env=None)
         except Exception as e:
             import traceback
             logger.error(m18n.n("diagnosis_failed_for_category", category=category, error='\n'+traceback.format_exc()))
-        else:
-            diagnosed_categories.append(category)
-            if report != {}:
-                issues.extend([item for item in report["items"] if item["status"] in ["WARNING", "ERROR"]])
+            return None
+        return report
+
+    global diagnosis_reports_
+    diagnosis_reports_ = DiagnosisReportStore()
+
+    start = time.time()
+    try:
+        results = _run_diagnosis_categories(categories, dependencies, run)
+    finally:
+        diagnosis_reports_ = None
+
+    issues = []
+    diagnosed_categories = []
+    for category, report, duration in results:
+        logger.debug("Diagnosis for %s took %.1fs" % (category, duration))
+        if report is None:
+            continue
+        diagnosed_categories.append(category)
+        if report != {}:
+            issues.extend([item for item in report["items"] if item["status"] in ["WARNING", "ERROR"]])
+
+    logger.debug("Diagnosis took %.1fs, for %.1fs spent diagnosing the categories one by one"
+                 % (time.time() - start, sum(duration for _, _, duration in results)))
 
     if issues and msettings.get("interface") == "cli":
         logger.warning(m18n.n("diagnosis_display_tip"))
@@ -184,6 +231,39 @@ def diagnosis_run(categories=[], force=False, except_if_never_ran_yet=False):
     return
 
 
+def diagnosis_history(series=[], number=20):
+    """
+    Show the measures recorded over time by the diagnosis
+
+    Keyword argument:
+        series -- Series of measures to display (all by default)
+        number -- Number of measures to display per series
+    """
+
+    all_series = _list_diagnosis_history_series()
+
+    if series == []:
+        series = all_series
+    else:
+        unknown_series = [s for s in series if s not in all_series]
+        if unknown_series:
+            raise YunohostError('diagnosis_history_unknown_series', series=", ".join(unknown_series))
+
+    history = {}
+    for name in series:
+        try:
+            buffer_ = RingBufferFile.load(_diagnosis_history_file(name))
+        except (IOError, ValueError) as e:
+            logger.debug("Unable to load history series '%s': %s", name, e)
+            logger.warning(m18n.n('diagnosis_history_corrupted_series', series=name))
+            continue
+        history[name] = [dict(zip(["time"] + buffer_.fields,
+                                  [datetime.fromtimestamp(r[0])] + [int(v) for v in r[1:]]))
+                         for r in buffer_.read()[-number:]]
+
+    return {"history": history}
+
+
 def diagnosis_ignore(add_filter=None, remove_filter=None, list=False):
     """
     This action is meant for the admin to ignore issues reported by the
@@ -344,6 +424,14 @@ def add_ignore_flag_to_issues(report):
 
 class Diagnoser():
 
+    # Dependencies whose report is only read for some of the checks. They are
+    # diagnosed first, but their issues don't prevent the diagnosis to run.
+    optional_dependencies = []
+
+    # Inputs of the diagnosis (c.f. _get_diagnosis_input). As long as they don't
+    # change, the cached report is reused, even past cache_duration.
+    inputs = []
+
     def __init__(self, args, env, loggers):
 
         # FIXME ? That stuff with custom loggers is weird ... (mainly inherited from the bash hooks, idk)
@@ -362,16 +450,47 @@ class Diagnoser():
     def write_cache(self, report):
         if not os.path.exists(DIAGNOSIS_CACHE):
             os.makedirs(DIAGNOSIS_CACHE)
-        return write_to_json(self.cache_file, report)
+        write_to_json(self.cache_file, report)
+        if diagnosis_reports_ is not None:
+            diagnosis_reports_.forget(self.id_)
+
+    def fingerprint(self):
+        """
+        Fingerprint of the inputs of the diagnosis, or None if it does not
+        declare any
+        """
+
+        if not self.inputs:
+            return None
+
+        inputs = {name: _get_diagnosis_input(name) for name in self.inputs}
+        return hashlib.sha1(json.dumps(inputs, sort_keys=True)).hexdigest()
+
+    def cache_still_valid(self, fingerprint):
+
+        cached_time_ago = self.cached_time_ago()
+
+        if fingerprint is None:
+            return cached_time_ago < self.cache_duration
+
+        if cached_time_ago >= max(self.cache_duration, DIAGNOSIS_MAX_CACHE_DURATION):
+            return False
+
+        return Diagnoser.get_cached_report(self.id_).get("fingerprint") == fingerprint
 
     def diagnose(self):
 
-        if not self.args.get("force", False) and self.cached_time_ago() < self.cache_duration:
+        fingerprint = self.fingerprint()
+
+        if not self.args.get("force", False) and self.cache_still_valid(fingerprint):
             self.logger_debug("Cache still valid : %s" % self.cache_file)
             logger.info(m18n.n("diagnosis_cache_still_valid", category=self.description))
             return 0, {}
 
         for dependency in self.dependencies:
+            if dependency in self.optional_dependencies:
+                continue
+
             dep_report = Diagnoser.get_cached_report(dependency)
 
             if dep_report["timestamp"] == -1:  # No cache yet for this dep
@@ -392,6 +511,8 @@ class Diagnoser():
         new_report = {"id": self.id_,
                       "cached_for": self.cache_duration,
                       "items": items}
+        if fingerprint is not None:
+            new_report["fingerprint"] = fingerprint
 
         self.logger_debug("Updating cache %s" % self.cache_file)
         self.write_cache(new_report)
@@ -421,22 +542,18 @@ class Diagnoser():
 
     @staticmethod
     def get_cached_report(id_, item=None):
-        cache_file = Diagnoser.cache_file(id_)
-        if not os.path.exists(cache_file):
-            logger.warning(m18n.n("diagnosis_no_cache", category=id_))
-            report = {"id": id_,
-                      "cached_for": -1,
-                      "timestamp": -1,
-                      "items": []}
-        else:
-            report = read_json(cache_file)
-            report["timestamp"] = int(os.path.getmtime(cache_file))
+        """
+        Get the cached report of a category, or only one of its items, given
+        its meta. During a diagnosis run, the returned report is shared with
+        the other categories and should not be modified.
+        """
+
+        # Outside of a diagnosis run, always read the cache file again
+        store = diagnosis_reports_ if diagnosis_reports_ is not None else DiagnosisReportStore()
+        report, items_by_meta = store.get(id_)
 
         if item:
-            for report_item in report["items"]:
-                if report_item.get("meta") == item:
-                    return report_item
-            return {}
+            return items_by_meta.get(DiagnosisReportStore.meta_key(item), {})
         else:
             return report
 
@@ -494,37 +611,8 @@ class Diagnoser():
     @staticmethod
     def remote_diagnosis(uri, data, ipversion, timeout=30):
 
-        # Lazy loading for performance
-        import requests
-        import socket
-
-        # Monkey patch socket.getaddrinfo to force request() to happen in ipv4
-        # or 6 ...
-        # Inspired by https://stackoverflow.com/a/50044152
-        old_getaddrinfo = socket.getaddrinfo
-
-        def getaddrinfo_ipv4_only(*args, **kwargs):
-            responses = old_getaddrinfo(*args, **kwargs)
-            return [response
-                    for response in responses
-                    if response[0] == socket.AF_INET]
-
-        def getaddrinfo_ipv6_only(*args, **kwargs):
-            responses = old_getaddrinfo(*args, **kwargs)
-            return [response
-                    for response in responses
-                    if response[0] == socket.AF_INET6]
-
-        if ipversion == 4:
-            socket.getaddrinfo = getaddrinfo_ipv4_only
-        elif ipversion == 6:
-            socket.getaddrinfo = getaddrinfo_ipv6_only
-
-        url = 'https://%s/%s' % (DIAGNOSIS_SERVER, uri)
-        try:
-            r = requests.post(url, json=data, timeout=timeout)
-        finally:
-            socket.getaddrinfo = old_getaddrinfo
+        url = '%s/%s' % (DIAGNOSIS_SERVER_URL, uri)
+        r = _get_remote_diagnosis_session(ipversion).post(url, json=data, timeout=timeout)
 
         if r.status_code not in [200, 400]:
             raise Exception("The remote diagnosis server failed miserably while trying to diagnose your server. This is most likely an error on Yunohost's infrastructure and not on your side. Please contact the YunoHost team an provide them with the following information.<br>URL: <code>%s</code><br>Status code: <code>%s</code>" % (url, r.status_code))
@@ -539,6 +627,57 @@ class Diagnoser():
         return r
 
 
+class DiagnosisReportStore(object):
+
+    """
+    Cached reports of the diagnosis categories, each of them being loaded only
+    once, along with an index of their items by meta
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reports = {}
+
+    def get(self, id_):
+        """Get the (report, items indexed by meta) of a category"""
+
+        with self.lock:
+            if id_ not in self.reports:
+                self.reports[id_] = self._load(id_)
+            return self.reports[id_]
+
+    def forget(self, id_):
+        """Forget about the report of a category, whose cache got updated"""
+
+        with self.lock:
+            self.reports.pop(id_, None)
+
+    @staticmethod
+    def meta_key(meta):
+        return json.dumps(meta, sort_keys=True)
+
+    @staticmethod
+    def _load(id_):
+
+        cache_file = Diagnoser.cache_file(id_)
+        if not os.path.exists(cache_file):
+            logger.warning(m18n.n("diagnosis_no_cache", category=id_))
+            report = {"id": id_,
+                      "cached_for": -1,
+                      "timestamp": -1,
+                      "items": []}
+        else:
+            report = read_json(cache_file)
+            report["timestamp"] = int(os.path.getmtime(cache_file))
+
+        # Like a linear search would, keep the first item having a given meta
+        items_by_meta = {}
+        for item in report["items"]:
+            items_by_meta.setdefault(DiagnosisReportStore.meta_key(item.get("meta")), item)
+
+        return report, items_by_meta
+
+
 def _list_diagnosis_categories():
     hooks_raw = hook_list("diagnosis", list_by="priority", show_info=True)["hooks"]
     hooks = []
@@ -547,3 +686,239 @@ def _list_diagnosis_categories():
             hooks.append((name, info["path"]))
 
     return hooks
+
+
+def _diagnosis_history_file(series):
+    return os.path.join(DIAGNOSIS_HISTORY_DIR, urllib.quote(series, safe=""))
+
+
+def _list_diagnosis_history_series():
+
+    if not os.path.isdir(DIAGNOSIS_HISTORY_DIR):
+        return []
+
+    return sorted(urllib.unquote(f) for f in os.listdir(DIAGNOSIS_HISTORY_DIR))
+
+
+def _get_diagnosis_history(series, fields, capacity=1024):
+    """
+    Get the ring buffer where measures of a series are recorded over time,
+    e.g. 'ram' or 'diskusage:/var'
+    """
+
+    if not os.path.isdir(DIAGNOSIS_HISTORY_DIR):
+        os.makedirs(DIAGNOSIS_HISTORY_DIR)
+
+    return RingBufferFile(_diagnosis_history_file(series), fields, capacity)
+
+
+def _get_diagnosis_input(name):
+    """
+    Get a cheap to compute value, which changes whenever the given input of
+    the diagnosis changes
+    """
+
+    if name == "domains":
+        from yunohost.domain import domain_list, _get_maindomain
+        return [sorted(domain_list()["domains"]), _get_maindomain()]
+    elif name == "public_ips":
+        return [Diagnoser.get_cached_report("ip", item={"test": "ipv%s" % v}).get("data", {}).get("global")
+                for v in [4, 6]]
+    elif name == "regenconf":
+        from yunohost.regenconf import REGEN_CONF_FILE
+        return _stat_signature(REGEN_CONF_FILE)
+    elif name == "conffiles":
+        from yunohost.regenconf import _get_regenconf_infos
+        return {path: _stat_signature(path)
+                for infos in _get_regenconf_infos().values()
+                for path in infos["conffiles"]}
+    elif name == "services":
+        return _stat_signature("/etc/yunohost/services.yml")
+    elif name == "firewall":
+        return _stat_signature("/etc/yunohost/firewall.yml")
+    elif name == "dpkg":
+        return _stat_signature("/var/lib/dpkg/status")
+    elif name == "kernel":
+        return list(os.uname())
+    else:
+        raise ValueError("Unknown diagnosis input '%s'" % name)
+
+
+def _stat_signature(path):
+
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return [stat.st_mtime, stat.st_size, stat.st_ino]
+
+
+def _get_remote_diagnosis_session(ipversion):
+    """
+    Get the HTTP session used to talk to the diagnosis server in ipv4 or 6
+    """
+
+    with remote_diagnosis_sessions_lock_:
+        if ipversion not in remote_diagnosis_sessions_:
+
+            # Lazy loading for performance
+            import requests
+            from requests.adapters import HTTPAdapter
+
+            # Binding the connections to the 'any' address of an IP version
+            # makes them fail for the addresses of the other version, such
+            # that only addresses of the requested version are tried
+            source_address = {4: ("0.0.0.0", 0), 6: ("::", 0)}.get(ipversion)
+
+            class IPVersionAdapter(HTTPAdapter):
+
+                def init_poolmanager(self, *args, **kwargs):
+                    if source_address:
+                        kwargs["source_address"] = source_address
+                    return HTTPAdapter.init_poolmanager(self, *args, **kwargs)
+
+            # Several categories may talk to the diagnosis server at once
+            adapter = IPVersionAdapter(pool_maxsize=DIAGNOSIS_MAX_PARALLEL)
+            session = requests.Session()
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+            remote_diagnosis_sessions_[ipversion] = session
+
+        return remote_diagnosis_sessions_[ipversion]
+
+
+def _get_diagnoser_dependencies(path):
+    """
+    Get the categories that the Diagnoser of a diagnosis hook depends on,
+    without running it
+    """
+
+    # Only python hooks may declare dependencies
+    if not path.endswith(".py"):
+        return []
+
+    import inspect
+    from importlib import import_module
+
+    # Load the hook module the same way hook_exec does
+    dir_ = os.path.dirname(path)
+    if dir_ not in sys.path:
+        sys.path = [dir_] + sys.path
+    try:
+        module = import_module(os.path.splitext(os.path.basename(path))[0])
+    except Exception as e:
+        logger.debug("Could not load diagnosis hook %s: %s" % (path, e))
+        return []
+
+    for attribute in vars(module).values():
+        if inspect.isclass(attribute) and issubclass(attribute, Diagnoser) \
+                and attribute is not Diagnoser:
+            return list(getattr(attribute, "dependencies", []))
+
+    return []
+
+
+def _run_diagnosis_categories(categories, dependencies, run, max_parallel=DIAGNOSIS_MAX_PARALLEL):
+    """
+    Run the diagnosis of several categories in a pool of threads, a category
+    being run only once the categories it depends on are done
+
+    Keyword argument:
+        categories -- Categories to diagnose
+        dependencies -- A dict {category: [categories it depends on]}
+        run -- Function diagnosing a category and returning its result
+        max_parallel -- Number of categories diagnosed at the same time
+
+    Returns a list of (category, result, duration), in the order in which the
+    categories got diagnosed
+    """
+
+    import Queue
+    from multiprocessing.pool import ThreadPool
+
+    pending = list(categories)
+    running = set()
+    done = Queue.Queue()
+    results = []
+    log_buffer = _ThreadLogBuffer()
+
+    def worker(category):
+        log_buffer.capture()
+        start = time.time()
+        result = None
+        try:
+            result = run(category)
+        finally:
+            done.put((category, result, time.time() - start, log_buffer.release()))
+
+    pool = ThreadPool(max(1, min(len(categories), max_parallel)))
+    log_buffer.install()
+    try:
+        while pending or running:
+            ready = [c for c in pending
+                     if not set(dependencies.get(c, [])) & (set(pending) | running)]
+            # Don't get stuck on dependency cycles
+            if not ready and not running:
+                ready = pending[:1]
+
+            for category in ready:
+                pending.remove(category)
+                running.add(category)
+                pool.apply_async(worker, (category,))
+
+            # N.B. : a timeout is needed for the wait to be interruptible
+            category, result, duration, records = done.get(True, 24 * 3600)
+            running.remove(category)
+
+            # Display the logs of the category all at once, such that
+            # they are not interleaved with the ones of other categories
+            for record in records:
+                logging.getLogger(record.name).handle(record)
+
+            results.append((category, result, duration))
+    finally:
+        log_buffer.uninstall()
+        pool.close()
+
+    pool.join()
+
+    return results
+
+
+class _ThreadLogBuffer(logging.Filter):
+
+    """
+    Hold back the log records emitted by the threads which asked for it,
+    until they are released
+    """
+
+    def __init__(self):
+        logging.Filter.__init__(self)
+        self.buffers = {}
+        self.handlers = []
+
+    def install(self):
+        loggers = [logging.getLogger()] + [l for l in logging.Logger.manager.loggerDict.values()
+                                           if isinstance(l, logging.Logger)]
+        self.handlers = list(set(h for l in loggers for h in l.handlers))
+        for handler in self.handlers:
+            handler.addFilter(self)
+
+    def uninstall(self):
+        for handler in self.handlers:
+            handler.removeFilter(self)
+
+    def capture(self):
+        self.buffers[threading.current_thread().ident] = []
+
+    def release(self):
+        return self.buffers.pop(threading.current_thread().ident, [])
+
+    def filter(self, record):
+        buffer_ = self.buffers.get(threading.current_thread().ident)
+        if buffer_ is None:
+            return True
+        # The same record goes through every handler
+        if not buffer_ or buffer_[-1] is not record:
+            buffer_.append(record)
+        return False
@@ -34,6 +34,7 @@ except ImportError:
 
 from moulinette import m18n
 from yunohost.utils.error import YunohostError
+from yunohost.utils.filesystem import SafeLoader
 from moulinette.utils import process
 from moulinette.utils.log import getActionLogger
 from moulinette.utils.text import prependlines
@@ -162,7 +163,7 @@ def firewall_list(raw=False, by_ip_version=False, list_forwarded=False):
 
     """
     with open(FIREWALL_FILE) as f:
-        firewall = yaml.load(f)
+        firewall = yaml.load(f, Loader=SafeLoader)
     if raw:
         return firewall
 
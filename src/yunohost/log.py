@@ -26,6 +26,10 @@
 
 import os
 import re
+import sys
+import time
+import gzip
+import shutil
 import yaml
 import collections
 
@@ -36,7 +40,8 @@ from moulinette import m18n, msettings
 from moulinette.core import MoulinetteError
 from yunohost.utils.error import YunohostError
 from moulinette.utils.log import getActionLogger
-from moulinette.utils.filesystem import read_file, read_yaml
+from moulinette.utils.filesystem import read_file
+from yunohost.utils.filesystem import read_yaml
 
 CATEGORIES_PATH = '/var/log/yunohost/categories/'
 OPERATIONS_PATH = '/var/log/yunohost/categories/operation/'
@@ -44,6 +49,7 @@ CATEGORIES = ['operation', 'history', 'package', 'system', 'access', 'service',
               'app']
 METADATA_FILE_EXT = '.yml'
 LOG_FILE_EXT = '.log'
+COMPRESSED_LOG_FILE_EXT = '.log.gz'
 RELATED_CATEGORIES = ['app', 'domain', 'group', 'service', 'user']
 
 logger = getActionLogger('yunohost.log')
@@ -122,7 +128,8 @@ def log_list(category=[], limit=None, with_details=False):
     return result
 
 
-def log_display(path, number=None, share=False, filter_irrelevant=False):
+def log_display(path, number=None, share=False, filter_irrelevant=False,
+                offset=None, follow=False):
     """
     Display a log file enriched with metadata if any.
 
@@ -133,8 +140,14 @@ def log_display(path, number=None, share=False, filter_irrelevant=False):
         file_name
         number
         share
+        offset -- Byte offset (as returned in 'next_offset') from which to read the next page of lines
+        follow -- Keep displaying the new lines of the log until the operation ends
     """
 
+    is_api = msettings.get('interface') == 'api'
+    if follow and is_api:
+        raise YunohostError('log_follow_not_available_in_api')
+
     # Normalize log/metadata paths and filenames
     abs_path = path
     log_path = None
@@ -147,7 +160,9 @@ def log_display(path, number=None, share=False, filter_irrelevant=False):
     if os.path.exists(abs_path) and not path.endswith(METADATA_FILE_EXT):
         log_path = abs_path
 
-    if abs_path.endswith(METADATA_FILE_EXT) or abs_path.endswith(LOG_FILE_EXT):
+    if abs_path.endswith(COMPRESSED_LOG_FILE_EXT):
+        base_path = abs_path[:-len(COMPRESSED_LOG_FILE_EXT)]
+    elif abs_path.endswith(METADATA_FILE_EXT) or abs_path.endswith(LOG_FILE_EXT):
         base_path = ''.join(os.path.splitext(abs_path)[:-1])
     else:
         base_path = abs_path
@@ -155,6 +170,7 @@ def log_display(path, number=None, share=False, filter_irrelevant=False):
     md_path = base_path + METADATA_FILE_EXT
     if log_path is None:
         log_path = base_path + LOG_FILE_EXT
+    log_path = _find_log_file(log_path)
 
     if not os.path.exists(md_path) and not os.path.exists(log_path):
         raise YunohostError('log_does_exists', log=path)
@@ -173,7 +189,7 @@ def log_display(path, number=None, share=False, filter_irrelevant=False):
             content += read_file(md_path)
             content += "\n============\n\n"
         if os.path.exists(log_path):
-            content += read_file(log_path)
+            content += _read_log_file(log_path)
 
         url = yunopaste(content)
 
@@ -198,7 +214,7 @@ def log_display(path, number=None, share=False, filter_irrelevant=False):
             infos['metadata'] = metadata
 
             if 'log_path' in metadata:
-                log_path = metadata['log_path']
+                log_path = _find_log_file(metadata['log_path'])
 
     # Display logs if exist
     if os.path.exists(log_path):
@@ -218,17 +234,121 @@ def log_display(path, number=None, share=False, filter_irrelevant=False):
         else:
             filters = []
 
+        # Logs which are not the one of an operation still running won't get
+        # new lines (or at least, we can't know it)
+        metadata = infos.get('metadata') or {}
+        finished = 'started_at' not in metadata or 'ended_at' in metadata
+
         from yunohost.service import _tail
-        if number:
-            logs = _tail(log_path, int(number), filters=filters)
+        if offset is not None or not number:
+            # Paginated mode : only read the requested page from the offset
+            # (the first page if no number of lines is given), such that the
+            # memory used doesn't depend on the log size
+            logs, next_offset, has_more = _read_log_lines(log_path, int(offset or 0),
+                                                          int(number) if number else 50,
+                                                          filters=filters, finished=finished)
+            infos['next_offset'] = next_offset
+            infos['has_more'] = has_more
         else:
-            logs = read_file(log_path)
+            # Make it possible to fetch the lines written after this call
+            # (compressed logs are finished anyway)
+            if not log_path.endswith(".gz"):
+                infos['next_offset'] = os.path.getsize(log_path)
+            logs = _tail(log_path, int(number), filters=filters)
         infos['log_path'] = log_path
         infos['logs'] = logs
 
+        if follow:
+            _follow_log(infos, md_path, log_path, filters)
+            return
+
     return infos
 
 
+def _follow_log(infos, md_path, log_path, filters):
+    """
+    Print the log as it gets written, until the operation ends
+    """
+
+    logs = infos["logs"]
+    if logs:
+        print("\n".join(logs) if isinstance(logs, list) else logs)
+
+    offset = infos.get("next_offset")
+    if offset is None:
+        return
+
+    try:
+        for line in _follow_log_lines(md_path, log_path, offset, filters):
+            print(line)
+            sys.stdout.flush()
+    except KeyboardInterrupt:
+        pass
+
+
+def log_compact(keep=10, compress_after=7, max_age=365):
+    """
+    Compress old operation logs and remove the ones out of the retention window
+
+    Keyword argument:
+        keep -- Number of most recent logs to always keep for each entity
+        compress_after -- Compress logs older than this number of days
+        max_age -- Remove logs older than this number of days, unless they are among the most recent ones of their entity
+
+    """
+
+    result = {"compressed": 0, "removed": 0, "reclaimed": 0}
+
+    if not os.path.isdir(OPERATIONS_PATH):
+        return result
+
+    # Group logs by entity (e.g. 'app_install-nextcloud') so that we always
+    # keep the last few logs of each of them, no matter how old they are
+    logs_by_entity = collections.defaultdict(list)
+    for md_filename in os.listdir(OPERATIONS_PATH):
+        if not md_filename.endswith(METADATA_FILE_EXT):
+            continue
+        base_filename = md_filename[:-len(METADATA_FILE_EXT)]
+        logs_by_entity[_get_entity_from_name(base_filename)].append(base_filename)
+
+    now = time.time()
+    for entity, base_filenames in logs_by_entity.items():
+
+        # Filenames start with the date, so this puts the most recent first
+        for index, base_filename in enumerate(sorted(base_filenames, reverse=True)):
+            base_path = os.path.join(OPERATIONS_PATH, base_filename)
+            md_path = base_path + METADATA_FILE_EXT
+            log_path = base_path + LOG_FILE_EXT
+            paths = [md_path, log_path, base_path + COMPRESSED_LOG_FILE_EXT]
+
+            last_modified = max(os.path.getmtime(path) for path in paths if os.path.exists(path))
+            age = (now - last_modified) / 86400
+
+            if index >= keep and age > max_age:
+                logger.debug("Removing old operation log %s" % base_filename)
+                for path in paths:
+                    if os.path.exists(path):
+                        result["reclaimed"] += os.path.getsize(path)
+                        os.remove(path)
+                result["removed"] += 1
+
+            elif age > compress_after and os.path.exists(log_path):
+                logger.debug("Compressing operation log %s" % base_filename)
+                try:
+                    result["reclaimed"] += _compress_log_file(log_path)
+                except (IOError, OSError) as e:
+                    logger.warning("Failed to compress log file '%s': %s" % (log_path, e))
+                    continue
+                result["compressed"] += 1
+
+    from yunohost.backup import binary_to_human
+    logger.success(m18n.n('log_compacted', compressed=result["compressed"],
+                          removed=result["removed"],
+                          size=binary_to_human(result["reclaimed"]) + 'B'))
+
+    return result
+
+
 def is_unit_operation(entities=['app', 'domain', 'group', 'service', 'user'],
                       exclude=['password'], operation_key=None):
     """
@@ -311,18 +431,45 @@ def is_unit_operation(entities=['app', 'domain', 'group', 'service', 'user'],
     return decorate
 
 
+class DataRedactor(object):
+
+    """
+    Replace every occurence of the secrets listed in data_to_redact in a
+    single pass.
+
+    All secrets are merged into one compiled alternation regex, which is only
+    rebuilt when new secrets got appended to the list (this list is shared
+    and only ever extended, so its length is enough to detect changes).
+    """
+
+    def __init__(self, data_to_redact):
+        self.data_to_redact = data_to_redact
+        self._pattern = None
+        self._pattern_size = 0
+
+    def redact(self, text, replacement="**********"):
+
+        if len(self.data_to_redact) != self._pattern_size:
+            self._pattern = _compile_redaction_pattern(self.data_to_redact)
+            self._pattern_size = len(self.data_to_redact)
+
+        if self._pattern is None:
+            return text
+
+        return self._pattern.sub(replacement, text)
+
+
 class RedactingFormatter(Formatter):
 
     def __init__(self, format_string, data_to_redact):
         super(RedactingFormatter, self).__init__(format_string)
         self.data_to_redact = data_to_redact
+        self.redactor = DataRedactor(data_to_redact)
 
     def format(self, record):
         msg = super(RedactingFormatter, self).format(record)
         self.identify_data_to_redact(msg)
-        for data in self.data_to_redact:
-            msg = msg.replace(data, "**********")
-        return msg
+        return self.redactor.redact(msg)
 
     def identify_data_to_redact(self, record):
 
@@ -359,11 +506,8 @@ class OperationLogger(object):
         self.ended_at = None
         self.logger = None
         self._name = None
-        self.data_to_redact = []
-
-        for filename in ["/etc/yunohost/mysql", "/etc/yunohost/psql"]:
-            if os.path.exists(filename):
-                self.data_to_redact.append(read_file(filename).strip())
+        self.data_to_redact = list(_get_system_secrets())
+        self.redactor = DataRedactor(self.data_to_redact)
 
         self.path = OPERATIONS_PATH
 
@@ -417,9 +561,8 @@ class OperationLogger(object):
         """
 
         dump = yaml.safe_dump(self.metadata, default_flow_style=False)
-        for data in self.data_to_redact:
-            # N.B. : we need quotes here, otherwise yaml isn't happy about loading the yml later
-            dump = dump.replace(data, "'**********'")
+        # N.B. : we need quotes here, otherwise yaml isn't happy about loading the yml later
+        dump = self.redactor.redact(dump, replacement="'**********'")
         with open(self.md_path, 'w') as outfile:
             outfile.write(dump)
 
@@ -525,6 +668,39 @@ class OperationLogger(object):
             self.error(m18n.n('log_operation_unit_unclosed_properly'))
 
 
+# Lazy dev caching to avoid re-reading the secrets files each time an
+# OperationLogger gets created during the same yunohost operation
+system_secrets_ = None
+
+
+def _get_system_secrets():
+
+    global system_secrets_
+
+    if system_secrets_ is None:
+        system_secrets_ = []
+        for filename in ["/etc/yunohost/mysql", "/etc/yunohost/psql"]:
+            if os.path.exists(filename):
+                system_secrets_.append(read_file(filename).strip())
+
+    return system_secrets_
+
+
+def _compile_redaction_pattern(data_to_redact):
+    """
+    Build a single regex matching any of the given secrets, or None if there's
+    nothing to redact
+    """
+
+    # Longest secrets first, such that a secret containing another one gets
+    # fully redacted. Empty strings would match everywhere, skip them.
+    secrets = sorted(set(data for data in data_to_redact if data), key=len, reverse=True)
+    if not secrets:
+        return None
+
+    return re.compile("|".join(re.escape(data) for data in secrets))
+
+
 def _get_description_from_name(name):
     """
     Return the translated description from the filename
@@ -543,3 +719,151 @@ def _get_description_from_name(name):
         return m18n.n(key, *args)
     except IndexError:
         return name
+
+
+def _get_entity_from_name(name):
+    """
+    Return the operation and related entity part of a log filename, that is
+    without the date (e.g. 'app_install-nextcloud')
+    """
+
+    parts = name.split("-", 2)
+    try:
+        datetime.strptime(" ".join(parts[:2]), "%Y%m%d %H%M%S")
+    except ValueError:
+        return name
+    return parts[2] if len(parts) > 2 else name
+
+
+def _find_log_file(log_path):
+    """
+    Return the path of the compressed log if the plain one got compacted
+    """
+
+    if not os.path.exists(log_path) and log_path.endswith(LOG_FILE_EXT) \
+       and os.path.exists(log_path + ".gz"):
+        return log_path + ".gz"
+    return log_path
+
+
+def _read_log_file(log_path):
+    """
+    Read a log file, transparently decompressing it if needed
+    """
+
+    if log_path.endswith(".gz"):
+        with gzip.open(log_path, 'rb') as f:
+            return f.read()
+    return read_file(log_path)
+
+
+def _compress_log_file(log_path):
+    """
+    Replace a log file with its gzip-compressed version, and return the number
+    of bytes reclaimed
+    """
+
+    compressed_path = log_path + ".gz"
+    tmp_path = compressed_path + ".tmp"
+
+    with open(log_path, 'rb') as f_in:
+        f_out = gzip.open(tmp_path, 'wb')
+        try:
+            shutil.copyfileobj(f_in, f_out)
+        finally:
+            f_out.close()
+
+    # Keep the original date, which is used for retention
+    stat = os.stat(log_path)
+    os.utime(tmp_path, (stat.st_atime, stat.st_mtime))
+    os.rename(tmp_path, compressed_path)
+    os.remove(log_path)
+
+    return stat.st_size - os.path.getsize(compressed_path)
+
+
+def _read_log_lines(log_path, offset=0, number=50, filters=[], finished=False):
+    """
+    Read at most 'number' lines from 'offset' (in bytes) in a log file,
+    skipping the lines matching any of the filters.
+
+    Lines are streamed from the file so that memory usage doesn't depend on
+    the size of the log. An incomplete last line (still being written) is left
+    for the next call, unless the log is finished, i.e. compressed or the one
+    of an operation which ended.
+
+    Returns a tuple (lines, next_offset, has_more)
+    """
+
+    filters = [re.compile(f) for f in filters]
+    finished = finished or log_path.endswith(".gz")
+
+    lines = []
+    f = gzip.open(log_path, 'rb') if log_path.endswith(".gz") else open(log_path, 'rb')
+    try:
+        f.seek(offset)
+        next_offset = f.tell()
+        while len(lines) < number:
+            line = f.readline()
+            if not line or (not line.endswith("\n") and not finished):
+                break
+            next_offset = f.tell()
+            line = line.rstrip("\n")
+            if not any(filter_.search(line) for filter_ in filters):
+                lines.append(line)
+
+        has_more = bool(f.readline())
+    finally:
+        f.close()
+
+    return lines, next_offset, has_more
+
+
+def _follow_log_lines(md_path, log_path, offset, filters=[]):
+    """
+    Yield the new lines of a log as they are written, until the operation
+    is over (i.e. its metadata got an 'ended_at' date)
+    """
+
+    wait_for_update = _log_update_waiter(log_path)
+
+    while True:
+        # Check the end of the operation *before* reading, such that we don't
+        # miss the last lines written right before the end
+        ended = not os.path.exists(md_path) or "ended_at" in (read_yaml(md_path) or {})
+
+        has_more = True
+        while has_more:
+            lines, offset, has_more = _read_log_lines(log_path, offset, filters=filters,
+                                                      finished=ended)
+            for line in lines:
+                yield line
+
+        if ended:
+            return
+
+        wait_for_update()
+
+
+def _log_update_waiter(log_path, timeout=1):
+    """
+    Return a function blocking until the log file gets modified (or until the
+    timeout, to regularly check that the operation isn't over)
+    """
+
+    try:
+        import pyinotify
+    except ImportError:
+        logger.debug("pyinotify is not available, falling back to polling the log file")
+        return lambda: time.sleep(timeout)
+
+    watch_manager = pyinotify.WatchManager()
+    watch_manager.add_watch(log_path, pyinotify.IN_MODIFY | pyinotify.IN_CLOSE_WRITE)
+    notifier = pyinotify.Notifier(watch_manager, timeout=timeout * 1000)
+
+    def wait_for_update():
+        if notifier.check_events():
+            notifier.read_events()
+            notifier.process_events()
+
+    return wait_for_update
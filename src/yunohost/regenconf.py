@@ -22,7 +22,7 @@
 import os
 import yaml
 import json
-import subprocess
+import time
 import shutil
 import hashlib
 
@@ -31,9 +31,15 @@ from datetime import datetime
 
 from moulinette import m18n
 from moulinette.utils import log, filesystem
-from moulinette.utils.filesystem import read_file
+from moulinette.utils.filesystem import read_file, read_json
+
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
 
 from yunohost.utils.error import YunohostError
+from yunohost.utils.filesystem import SafeLoader, read_yaml
 from yunohost.log import is_unit_operation
 from yunohost.hook import hook_callback, hook_list
 
@@ -41,24 +47,50 @@ BASE_CONF_PATH = '/home/yunohost.conf'
 BACKUP_CONF_DIR = os.path.join(BASE_CONF_PATH, 'backup')
 PENDING_CONF_DIR = os.path.join(BASE_CONF_PATH, 'pending')
 REGEN_CONF_FILE = '/etc/yunohost/regenconf.yml'
+HASH_CACHE_FILE = '/var/cache/yunohost/regenconf/hashes.json'
+REGEN_CONF_INPUTS_FILE = '/usr/share/yunohost/other/regenconf_inputs.yml'
+TEMPLATES_DIR = '/usr/share/yunohost/templates'
+DPKG_STATUS_FILE = '/var/lib/dpkg/status'
+
+# Number of regen-conf run snapshots kept in BACKUP_CONF_DIR, i.e. of the
+# most recent runs which can be rolled back
+REGEN_CONF_SNAPSHOTS_KEEP = 20
+
+# Digest used to track the state of the managed files. Hashes are stored as
+# '<algorithm>:<hexdigest>', except md5 ones which are stored as bare
+# hexdigests for compatibility with older regenconf.yml files
+HASH_ALGORITHM = "xxh64" if xxhash is not None else "md5"
 
 logger = log.getActionLogger('yunohost.regenconf')
 
+# Lazy dev caching of the file hashes, indexed by path, c.f. _calculate_hash
+hash_cache_ = None
+hash_cache_dirty_ = False
+
+# Lazy dev caching of the conffiles declared in dpkg's status file, along with
+# the stat signature of the status file they were parsed from
+dpkg_conffiles_ = None
+
 
 # FIXME : those ain't just services anymore ... what are we supposed to do with this ...
 # FIXME : check for all reference of 'service' close to operation_logger stuff
 @is_unit_operation([('names', 'configuration')])
 def regen_conf(operation_logger, names=[], with_diff=False, force=False, dry_run=False,
-                       list_pending=False):
+                       list_pending=False, domain_scope=None, rollback=None):
     """
     Regenerate the configuration file(s)
 
     Keyword argument:
         names -- Categories to regenerate configuration of
         with_diff -- Show differences in case of configuration changes
-        force -- Override all manual modifications in configuration files
+        force -- Override all manual modifications in configuration files,
+            and regenerate categories whose inputs did not change
         dry_run -- Show what would have been regenerated
         list_pending -- List pending configuration files and exit
+        domain_scope -- Only regenerate the configuration specific to this
+            domain (typically, because it was just added or removed)
+        rollback -- Restore the configuration files replaced by a previous
+            regen-conf run (identified by the name of its operation log)
 
     """
 
@@ -92,6 +124,13 @@ def regen_conf(operation_logger, names=[], with_diff=False, force=False, dry_run
 
         return pending_conf
 
+    if rollback:
+        operation_logger.name_parameter_override = 'rollback'
+        operation_logger.start()
+        result = _rollback_regen_conf(rollback)
+        operation_logger.success()
+        return result
+
     if not dry_run:
         operation_logger.related_to = [('configuration', x) for x in names]
         if not names:
@@ -100,16 +139,17 @@ def regen_conf(operation_logger, names=[], with_diff=False, force=False, dry_run
             operation_logger.name_parameter_override = str(len(operation_logger.related_to)) + '_categories'
         operation_logger.start()
 
-    # Clean pending conf directory
-    if os.path.isdir(PENDING_CONF_DIR):
-        if not names:
-            shutil.rmtree(PENDING_CONF_DIR, ignore_errors=True)
-        else:
-            for name in names:
-                shutil.rmtree(os.path.join(PENDING_CONF_DIR, name),
-                              ignore_errors=True)
-    else:
-        filesystem.mkdir(PENDING_CONF_DIR, 0o755, True)
+        # Restore the files of a previous run which didn't go to the end
+        # (e.g. the process got killed), such that they are consistent with
+        # the registered hashes again
+        _recover_interrupted_regen_conf()
+
+    timings = {}
+    started_at = time.time()
+
+    # Make sure the cached hashes can be trusted before overriding anything
+    if force:
+        _check_hash_cache()
 
     # Format common hooks arguments
     common_args = [1 if force else 0, 1 if dry_run else 0]
@@ -125,6 +165,8 @@ def regen_conf(operation_logger, names=[], with_diff=False, force=False, dry_run
         # return the arguments to pass to the script
         return pre_args + [category_pending_path, ]
 
+    all_categories = not names
+
     # Don't regen SSH if not specifically specified
     if not names:
         names = hook_list('conf_regen', list_by='name',
@@ -150,26 +192,151 @@ def regen_conf(operation_logger, names=[], with_diff=False, force=False, dry_run
     # ... but hooks that effectively need the domain list are only
     # called only after the 'installed' flag is set so that's all good,
     # though kinda tight-coupled to the postinstall logic :s
+    domains = []
     if os.path.exists("/etc/yunohost/installed"):
-        env["YNH_DOMAINS"] = " ".join(domain_list()["domains"])
+        domains = domain_list()["domains"]
+        env["YNH_DOMAINS"] = " ".join(domains)
+
+    # [Optimization] When a single domain is added or removed, the hooks only
+    # render (or remove) the conf files of this domain and update the files
+    # listing all domains, instead of regenerating everything
+    if domain_scope:
+        env["YNH_DOMAIN_SCOPE"] = domain_scope
+
+    # [Optimization] Skip the categories whose inputs (templates, settings,
+    # domains...) did not change since they were last regenerated. This
+    # doesn't apply to domain-scoped regens, which don't regenerate the
+    # whole categories. Their post hooks are still ran (with no regenerated
+    # file), as some of them enforce permissions or create missing files.
+    regenconf_infos = _get_regenconf_infos()
+    fingerprints = {}
+    up_to_date = []
+    if not dry_run and not domain_scope:
+        fingerprints = _get_inputs_fingerprints(names, domains)
+        if not force:
+            up_to_date = [name for name in names
+                          if _is_up_to_date(regenconf_infos.get(name), fingerprints.get(name))]
+            for name in up_to_date:
+                logger.debug(m18n.n('regenconf_up_to_date', category=name))
+            names = [name for name in names if name not in up_to_date]
+
+    # Clean pending conf directory
+    if os.path.isdir(PENDING_CONF_DIR):
+        if all_categories:
+            shutil.rmtree(PENDING_CONF_DIR, ignore_errors=True)
+        else:
+            for name in names:
+                shutil.rmtree(os.path.join(PENDING_CONF_DIR, name),
+                              ignore_errors=True)
+    else:
+        filesystem.mkdir(PENDING_CONF_DIR, 0o755, True)
 
-    pre_result = hook_callback('conf_regen', names, pre_callback=_pre_call, env=env)
+    if not names and not up_to_date:
+        _save_hash_cache()
+        operation_logger.success()
+        return result
 
-    # Keep only the hook names with at least one success
-    names = [hook for hook, infos in pre_result.items()
-             if any(result["state"] == "succeed" for result in infos.values())]
+    # N.B. : hook_callback and _get_pending_conf handle all the categories
+    # when given an empty list
+    pre_result = {}
+    if names:
+        pre_result = hook_callback('conf_regen', names, pre_callback=_pre_call, env=env)
+        timings["pre_regen"] = time.time() - started_at
 
-    # FIXME : what do in case of partial success/failure ...
-    if not names:
-        ret_failed = [hook for hook, infos in pre_result.items()
-                      if any(result["state"] == "failed" for result in infos.values())]
-        raise YunohostError('regenconf_failed',
-                            categories=', '.join(ret_failed))
+        # Keep only the hook names with at least one success
+        names = [hook for hook, infos in pre_result.items()
+                 if any(result["state"] == "succeed" for result in infos.values())]
+
+        # FIXME : what do in case of partial success/failure ...
+        if not names:
+            ret_failed = [hook for hook, infos in pre_result.items()
+                          if any(result["state"] == "failed" for result in infos.values())]
+            raise YunohostError('regenconf_failed',
+                                categories=', '.join(ret_failed))
+
+    # The replaced/removed files are backed up in a snapshot of the run, such
+    # that it can be rolled back
+    snapshot = RegenConfSnapshot(operation_logger.name) if not dry_run else None
 
     # Set the processing method
-    _regen = _process_regen_conf if not dry_run else lambda *a, **k: True
+    def _regen(category, system_conf, new_conf=None):
+        if dry_run:
+            return True
+        snapshot.backup(category, system_conf)
+        return _process_regen_conf(system_conf, new_conf, save=False)
 
     operation_logger.related_to = []
+    applying_started_at = time.time()
+
+    if dry_run:
+        result = _apply_pending_conf(names, regenconf_infos, _regen, with_diff, force, dry_run,
+                                     operation_logger)
+        _save_hash_cache()
+        return result
+
+    try:
+        if names:
+            result = _apply_pending_conf(names, regenconf_infos, _regen, with_diff, force, dry_run,
+                                         operation_logger)
+        _save_hash_cache()
+        timings["apply"] = time.time() - applying_started_at
+        post_regen_started_at = time.time()
+
+        # Execute hooks for post-regen
+        post_args = ['post', ] + common_args
+
+        def _pre_call(name, priority, path, args):
+            # append coma-separated applied changes for the category
+            if name in result and result[name]['applied']:
+                regen_conf_files = ','.join(result[name]['applied'].keys())
+            else:
+                regen_conf_files = ''
+            return post_args + [regen_conf_files, ]
+
+        post_result = hook_callback('conf_regen', names + up_to_date, pre_callback=_pre_call, env=env)
+        timings["post_regen"] = time.time() - post_regen_started_at
+
+        # Remember the inputs of the categories which are now fully up to date
+        for name in names + up_to_date:
+            hook_results = pre_result.get(name, {}).values() + post_result.get(name, {}).values()
+            if name not in fingerprints \
+               or (name in result and result[name]['pending']) \
+               or any(infos["state"] != "succeed" for infos in hook_results):
+                # Fully regenerate it next time
+                (regenconf_infos.get(name) or {}).pop("inputs_fingerprint", None)
+                continue
+            regenconf_infos[name] = regenconf_infos.get(name) or {"conffiles": {}}
+            regenconf_infos[name]["inputs_fingerprint"] = fingerprints[name]
+
+        # Commit all the new hashes at once : until then, the run can still be
+        # rolled back to a state consistent with the previously saved hashes
+        _save_regenconf_infos(regenconf_infos)
+        snapshot.commit()
+    except Exception:
+        if snapshot.started:
+            logger.warning(m18n.n('regenconf_rolling_back'))
+            _restore_regen_conf_snapshot(snapshot)
+        raise
+
+    timings["total"] = time.time() - started_at
+    operation_logger.extra["timings"] = dict((step, round(duration, 3))
+                                             for step, duration in timings.items())
+    if snapshot.started:
+        operation_logger.extra["snapshot"] = snapshot.run
+
+    operation_logger.success()
+
+    return result
+
+
+def _apply_pending_conf(names, regenconf_infos, _regen, with_diff, force, dry_run,
+                        operation_logger):
+    """Process the pending conf of the given categories
+
+    The registered hashes are updated in regenconf_infos, but not saved.
+    """
+
+    result = {}
 
     # Iterate over categories and process pending conf
     for category, conf_files in _get_pending_conf(names).items():
@@ -181,7 +348,8 @@ def regen_conf(operation_logger, names=[], with_diff=False, force=False, dry_run
         else:
             logger.debug(m18n.n('regenconf_dry_pending_applying', category=category))
 
-        conf_hashes = _get_conf_hashes(category)
+        category_infos = regenconf_infos.get(category) or {}
+        conf_hashes = dict(category_infos.get('conffiles') or {})
         succeed_regen = {}
         failed_regen = {}
 
@@ -201,7 +369,13 @@ def regen_conf(operation_logger, names=[], with_diff=False, force=False, dry_run
             # Retrieve and calculate hashes
             system_hash = _calculate_hash(system_path)
             saved_hash = conf_hashes.get(system_path, None)
-            new_hash = None if to_remove else _calculate_hash(pending_path)
+            new_hash = None if to_remove else _calculate_hash(pending_path, cache=False)
+
+            # saved_hash may have been computed with another digest algorithm
+            if saved_hash and system_hash and _hash_algorithm(saved_hash) != HASH_ALGORITHM:
+                system_matches_saved = _file_matches_hash(system_path, saved_hash)
+            else:
+                system_matches_saved = system_hash == saved_hash
 
             # -> system conf does not exists
             if not system_hash:
@@ -216,8 +390,7 @@ def regen_conf(operation_logger, names=[], with_diff=False, force=False, dry_run
                     else:
                         logger.debug("> system conf does not exist yet")
                         conf_status = 'created'
-                    regenerated = _regen(
-                        system_path, pending_path, save=False)
+                    regenerated = _regen(category, system_path, pending_path)
                 else:
                     logger.info(m18n.n(
                         'regenconf_file_manually_removed',
@@ -238,10 +411,10 @@ def regen_conf(operation_logger, names=[], with_diff=False, force=False, dry_run
                     # appropriately.
                     logger.info(m18n.n('regenconf_now_managed_by_yunohost',
                                        conf=system_path, category=category))
-                    regenerated = _regen(system_path, pending_path)
+                    regenerated = _regen(category, system_path, pending_path)
                     conf_status = 'new'
                 elif force:
-                    regenerated = _regen(system_path)
+                    regenerated = _regen(category, system_path)
                     conf_status = 'force-removed'
                 else:
                     logger.info(m18n.n('regenconf_file_kept_back',
@@ -249,12 +422,12 @@ def regen_conf(operation_logger, names=[], with_diff=False, force=False, dry_run
                     conf_status = 'unmanaged'
 
             # -> system conf has not been manually modified
-            elif system_hash == saved_hash:
+            elif system_matches_saved:
                 if to_remove:
-                    regenerated = _regen(system_path)
+                    regenerated = _regen(category, system_path)
                     conf_status = 'removed'
                 elif system_hash != new_hash:
-                    regenerated = _regen(system_path, pending_path)
+                    regenerated = _regen(category, system_path, pending_path)
                     conf_status = 'updated'
                 else:
                     logger.debug("> system conf is already up-to-date")
@@ -268,7 +441,7 @@ def regen_conf(operation_logger, names=[], with_diff=False, force=False, dry_run
                     conf_status = 'managed'
                     regenerated = True
                 elif force:
-                    regenerated = _regen(system_path, pending_path)
+                    regenerated = _regen(category, system_path, pending_path)
                     conf_status = 'force-updated'
                 else:
                     logger.warning(m18n.n(
@@ -299,7 +472,8 @@ def regen_conf(operation_logger, names=[], with_diff=False, force=False, dry_run
                 logger.success(m18n.n('regenconf_would_be_updated', category=category))
 
         if succeed_regen and not dry_run:
-            _update_conf_hashes(category, conf_hashes)
+            category_infos['conffiles'] = conf_hashes
+            regenconf_infos[category] = category_infos
 
         # Append the category results
         result[category] = {
@@ -307,25 +481,6 @@ def regen_conf(operation_logger, names=[], with_diff=False, force=False, dry_run
             'pending': failed_regen
         }
 
-    # Return in case of dry run
-    if dry_run:
-        return result
-
-    # Execute hooks for post-regen
-    post_args = ['post', ] + common_args
-
-    def _pre_call(name, priority, path, args):
-        # append coma-separated applied changes for the category
-        if name in result and result[name]['applied']:
-            regen_conf_files = ','.join(result[name]['applied'].keys())
-        else:
-            regen_conf_files = ''
-        return post_args + [regen_conf_files, ]
-
-    hook_callback('conf_regen', names, pre_callback=_pre_call, env=env)
-
-    operation_logger.success()
-
     return result
 
 
@@ -335,7 +490,7 @@ def _get_regenconf_infos():
     """
     try:
         with open(REGEN_CONF_FILE, 'r') as f:
-            return yaml.load(f)
+            return yaml.load(f, Loader=SafeLoader)
     except:
         return {}
 
@@ -347,13 +502,102 @@ def _save_regenconf_infos(infos):
         categories -- A dict containing the regenconf infos
     """
     try:
-        with open(REGEN_CONF_FILE, 'w') as f:
+        # Write then rename, such that the file is replaced atomically
+        with open(REGEN_CONF_FILE + '.tmp', 'w') as f:
             yaml.safe_dump(infos, f, default_flow_style=False)
+        os.rename(REGEN_CONF_FILE + '.tmp', REGEN_CONF_FILE)
     except Exception as e:
         logger.warning('Error while saving regenconf infos, exception: %s', e, exc_info=1)
         raise
 
 
+def _get_inputs_fingerprints(names, domains):
+    """Compute the fingerprint of the inputs of the given categories
+
+    The inputs of each category are declared in REGEN_CONF_INPUTS_FILE.
+    Categories which don't declare their inputs have no fingerprint, and are
+    thus always regenerated.
+
+    Keyword argument:
+        names -- Categories to compute the fingerprint of
+        domains -- The domain list
+
+    Returns a dict of category => fingerprint
+    """
+
+    try:
+        declared_inputs = read_yaml(REGEN_CONF_INPUTS_FILE) or {}
+    except Exception as e:
+        logger.warning("Could not read the regen conf inputs: %s", e)
+        return {}
+
+    hooks = hook_list('conf_regen', list_by='name', show_info=True)['hooks']
+
+    fingerprints = {}
+    for name in names:
+        if name not in declared_inputs:
+            continue
+        inputs = declared_inputs[name] or {}
+        fingerprint = {}
+
+        # Hooks with the same name or a name like <name>_foo are ran as well
+        fingerprint["hooks"] = dict((h["path"], _calculate_hash(h["path"]))
+                                    for hook_name, infos in hooks.items()
+                                    if hook_name == name or hook_name.startswith(name + "_")
+                                    for h in infos)
+
+        fingerprint["templates"] = {}
+        for template_dir in inputs.get("templates", []):
+            for root, dirs, files in os.walk(os.path.join(TEMPLATES_DIR, template_dir)):
+                for filename in files:
+                    path = os.path.join(root, filename)
+                    fingerprint["templates"][path] = _calculate_hash(path)
+
+        if inputs.get("settings"):
+            from yunohost.settings import settings_get
+            fingerprint["settings"] = dict((key, settings_get(key))
+                                           for key in inputs["settings"])
+
+        if inputs.get("domains"):
+            fingerprint["domains"] = sorted(domains)
+            from yunohost.domain import _get_maindomain
+            fingerprint["main_domain"] = _get_maindomain() if domains else None
+
+        if inputs.get("certs"):
+            fingerprint["certs"] = dict((domain, _calculate_hash("/etc/yunohost/certs/%s/crt.pem" % domain))
+                                        for domain in domains)
+
+        fingerprint["files"] = dict((path, _calculate_hash(path))
+                                    for path in inputs.get("files", []))
+        fingerprint["exists"] = dict((path, os.path.exists(path))
+                                     for path in inputs.get("exists", []))
+
+        fingerprints[name] = hashlib.sha1(json.dumps(fingerprint, sort_keys=True)).hexdigest()
+
+    return fingerprints
+
+
+def _is_up_to_date(infos, fingerprint):
+    """Check if a category can be skipped : its inputs did not change since it
+    was last regenerated, and its configuration files were not modified (such
+    that manual modifications are still reported)
+
+    Keyword argument:
+        infos -- The regen conf infos of the category
+        fingerprint -- The current fingerprint of its inputs
+
+    """
+
+    if fingerprint is None or not infos:
+        return False
+
+    if infos.get("inputs_fingerprint") != fingerprint:
+        return False
+
+    return all(_file_matches_hash(path, hash_)
+               for path, hash_ in (infos.get("conffiles") or {}).items())
+
+
 def _get_files_diff(orig_file, new_file, as_string=False, skip_header=True):
     """Compare two files and return the differences
 
@@ -391,22 +635,184 @@ def _get_files_diff(orig_file, new_file, as_string=False, skip_header=True):
     return diff
 
 
-def _calculate_hash(path):
-    """Calculate the MD5 hash of a file"""
+def _calculate_hash(path, algorithm=None, cache=True):
+    """Calculate the hash of a file
 
-    if not os.path.exists(path):
-        return None
+    Keyword argument:
+        path -- Path of the file to hash
+        algorithm -- Digest algorithm to use, HASH_ALGORITHM by default
+        cache -- Use the hash cache, such that files which did not change
+            since the last time they were hashed are not read again
 
-    hasher = hashlib.md5()
+    """
+
+    algorithm = algorithm or HASH_ALGORITHM
 
     try:
-        with open(path, 'rb') as f:
-            hasher.update(f.read())
-        return hasher.hexdigest()
+        stat = os.stat(path)
+    except OSError:
+        _drop_cached_hash(path)
+        return None
 
+    signature = _stat_signature(stat)
+    if cache:
+        cached = _get_hash_cache().get(path)
+        if cached and cached[0] == signature and algorithm in cached[1]:
+            return cached[1][algorithm]
+
+    try:
+        hash_ = _hash_file(path, algorithm)
     except IOError as e:
         logger.warning("Error while calculating file '%s' hash: %s", path, e, exc_info=1)
         return None
+    except ValueError as e:
+        # e.g. a xxh64 hash saved while python-xxhash was installed: the file
+        # can't be checked against it, so it is considered as not matching
+        logger.debug("Unable to calculate file '%s' hash: %s", path, e)
+        return None
+
+    # Files modified within the last seconds may be modified again without
+    # their mtime changing (the filesystem timestamps being not that
+    # precise), so we only cache hashes of files which are settled
+    if cache and time.time() - stat.st_mtime > 2:
+        _cache_hash(path, signature, algorithm, hash_)
+
+    return hash_
+
+
+def _hash_file(path, algorithm):
+
+    if algorithm == "xxh64":
+        if xxhash is None:
+            raise ValueError("unsupported hash type %s (python-xxhash is not installed)" % algorithm)
+        hasher = xxhash.xxh64()
+    else:
+        hasher = hashlib.new(algorithm)
+
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            hasher.update(chunk)
+
+    if algorithm == "md5":
+        return hasher.hexdigest()
+    return "%s:%s" % (algorithm, hasher.hexdigest())
+
+
+def _hash_algorithm(hash_):
+    """Return the digest algorithm used to compute a stored hash"""
+
+    return hash_.split(":", 1)[0] if ":" in hash_ else "md5"
+
+
+def _file_matches_hash(path, hash_):
+    """Check if a file content matches a stored hash, whatever its algorithm"""
+
+    # Removed configuration files are registered with a null hash
+    if hash_ is None:
+        return not os.path.exists(path)
+
+    return hash_ == _calculate_hash(path, _hash_algorithm(hash_))
+
+
+def _stat_signature(stat):
+    """What has to change for a file to be hashed again"""
+
+    mtime_ns = getattr(stat, "st_mtime_ns", None) or int(stat.st_mtime * 10**9)
+    ctime_ns = getattr(stat, "st_ctime_ns", None) or int(stat.st_ctime * 10**9)
+    return [stat.st_ino, stat.st_size, mtime_ns, ctime_ns]
+
+
+def _get_hash_cache():
+
+    global hash_cache_
+    if hash_cache_ is None:
+        try:
+            hash_cache_ = read_json(HASH_CACHE_FILE)
+        except Exception:
+            hash_cache_ = {}
+    return hash_cache_
+
+
+def _cache_hash(path, signature, algorithm, hash_):
+
+    global hash_cache_dirty_
+    cache = _get_hash_cache()
+    cached = cache.get(path)
+    if not cached or cached[0] != signature:
+        cached = cache[path] = [signature, {}]
+    cached[1][algorithm] = hash_
+    hash_cache_dirty_ = True
+
+
+def _drop_cached_hash(path):
+
+    global hash_cache_dirty_
+    if _get_hash_cache().pop(path, None) is not None:
+        hash_cache_dirty_ = True
+
+
+def _save_hash_cache():
+    """Persist the hash cache, if it changed since it was loaded"""
+
+    global hash_cache_dirty_
+    if not hash_cache_dirty_:
+        return
+
+    try:
+        if not os.path.isdir(os.path.dirname(HASH_CACHE_FILE)):
+            filesystem.mkdir(os.path.dirname(HASH_CACHE_FILE), 0o700, True)
+        # Write then rename, such that the cache is never half-written
+        tmp_file = HASH_CACHE_FILE + ".tmp"
+        with open(tmp_file, 'w') as f:
+            json.dump(_get_hash_cache(), f)
+        os.rename(tmp_file, HASH_CACHE_FILE)
+    except Exception as e:
+        logger.warning("Error while saving the regen conf hash cache: %s", e)
+    else:
+        hash_cache_dirty_ = False
+
+
+def _check_hash_cache():
+    """Check the consistency of the hash cache
+
+    Every cached hash whose file did not change according to its stat is
+    computed again and compared to the cached one. Inconsistent entries
+    (files modified without their mtime/ctime changing, or a corrupted
+    cache) are removed from the cache.
+
+    Returns the list of paths whose cached hashes were inconsistent
+    """
+
+    global hash_cache_dirty_
+    cache = _get_hash_cache()
+    inconsistent = []
+
+    for path, (signature, hashes) in cache.items():
+        try:
+            stat = os.stat(path)
+        except OSError:
+            del cache[path]
+            hash_cache_dirty_ = True
+            continue
+
+        if _stat_signature(stat) != signature:
+            continue
+
+        for algorithm, hash_ in hashes.items():
+            try:
+                if _hash_file(path, algorithm) == hash_:
+                    continue
+            except (IOError, ValueError):
+                pass
+            logger.warning("Inconsistent cached hash for '%s', removing it from the cache", path)
+            inconsistent.append(path)
+            del cache[path]
+            hash_cache_dirty_ = True
+            break
+
+    _save_hash_cache()
+
+    return inconsistent
 
 
 def _get_pending_conf(categories=[]):
@@ -497,6 +903,174 @@ def _force_clear_hashes(paths):
     _save_regenconf_infos(categories)
 
 
+class RegenConfSnapshot(object):
+
+    """
+    Backup of the configuration files replaced, created or removed by a
+    regen-conf run, along with the regen conf infos from before the run.
+
+    Snapshots are stored in BACKUP_CONF_DIR/<name of the run's operation log>
+    and are only created once a first file gets actually modified. Until the
+    run commits it (after saving the new hashes), a snapshot is considered
+    as interrupted and gets automatically restored by the next run.
+    """
+
+    def __init__(self, run):
+        self.run = run
+        self.path = os.path.join(BACKUP_CONF_DIR, run)
+        self.manifest = {"files": {}, "committed": False}
+        self.started = False
+
+    @classmethod
+    def load(cls, run):
+        snapshot = cls(run)
+        snapshot.manifest = read_yaml(os.path.join(snapshot.path, "manifest.yml"))
+        snapshot.started = True
+        return snapshot
+
+    def backup(self, category, system_conf):
+        """Backup a file before it gets replaced, created or removed"""
+
+        # Only the state from before the run matters
+        if system_conf in self.manifest["files"]:
+            return
+
+        if not self.started:
+            if not os.path.isdir(self.path):
+                filesystem.mkdir(self.path, 0o750, True)
+            if os.path.exists(REGEN_CONF_FILE):
+                shutil.copy2(REGEN_CONF_FILE, os.path.join(self.path, "regenconf.yml"))
+            self.started = True
+
+        existed = os.path.exists(system_conf)
+        if existed:
+            backup_path = self.backup_path(system_conf)
+            if not os.path.isdir(os.path.dirname(backup_path)):
+                filesystem.mkdir(os.path.dirname(backup_path), 0o750, True)
+            shutil.copy2(system_conf, backup_path)
+            logger.debug(m18n.n('regenconf_file_backed_up',
+                                conf=system_conf, backup=backup_path))
+
+        self.manifest["files"][system_conf] = {"category": category, "existed": existed}
+        self._save_manifest()
+
+    def backup_path(self, system_conf):
+        return os.path.join(self.path, "files", system_conf.lstrip('/'))
+
+    def commit(self):
+        if self.started:
+            self.manifest["committed"] = True
+            self._save_manifest()
+
+    def _save_manifest(self):
+        manifest_path = os.path.join(self.path, "manifest.yml")
+        with open(manifest_path + ".tmp", 'w') as f:
+            yaml.safe_dump(self.manifest, f, default_flow_style=False)
+        os.rename(manifest_path + ".tmp", manifest_path)
+
+
+def _restore_regen_conf_snapshot(snapshot):
+    """Restore the files of a regen-conf run snapshot, and their hashes
+
+    Returns a dict of category => restored files
+    """
+
+    saved_infos_path = os.path.join(snapshot.path, "regenconf.yml")
+    if os.path.exists(saved_infos_path):
+        with open(saved_infos_path) as f:
+            saved_infos = yaml.load(f, Loader=SafeLoader) or {}
+    else:
+        saved_infos = {}
+
+    regenconf_infos = _get_regenconf_infos()
+    restored = {}
+
+    for system_conf, infos in snapshot.manifest["files"].items():
+        category = infos["category"]
+        if infos["existed"]:
+            system_dir = os.path.dirname(system_conf)
+            if not os.path.isdir(system_dir):
+                filesystem.mkdir(system_dir, 0o755, True)
+            shutil.copy2(snapshot.backup_path(system_conf), system_conf)
+        elif os.path.exists(system_conf):
+            os.remove(system_conf)
+        restored.setdefault(category, []).append(system_conf)
+
+        # Restore the hash registered before the run
+        saved_hashes = (saved_infos.get(category) or {}).get("conffiles") or {}
+        category_infos = regenconf_infos.get(category) or {}
+        conf_hashes = category_infos.setdefault("conffiles", {})
+        if system_conf in saved_hashes:
+            conf_hashes[system_conf] = saved_hashes[system_conf]
+        else:
+            conf_hashes.pop(system_conf, None)
+        # The category has to be regenerated next time
+        category_infos.pop("inputs_fingerprint", None)
+        regenconf_infos[category] = category_infos
+
+    _save_regenconf_infos(regenconf_infos)
+
+    snapshot.manifest["restored"] = True
+    snapshot._save_manifest()
+
+    return restored
+
+
+def _recover_interrupted_regen_conf():
+    """Restore the snapshots of the runs which did not commit their hashes,
+    and remove the snapshots of the runs which are too old to be rolled back"""
+
+    if not os.path.isdir(BACKUP_CONF_DIR):
+        return
+
+    kept = 0
+    for run in sorted(os.listdir(BACKUP_CONF_DIR), reverse=True):
+        if not os.path.exists(os.path.join(BACKUP_CONF_DIR, run, "manifest.yml")):
+            continue
+        try:
+            snapshot = RegenConfSnapshot.load(run)
+        except Exception as e:
+            logger.warning("Could not read the regen conf snapshot %s: %s", run, e)
+            continue
+        if snapshot.manifest.get("committed") or snapshot.manifest.get("restored"):
+            kept += 1
+            if kept > REGEN_CONF_SNAPSHOTS_KEEP:
+                logger.debug("Removing the old regen conf snapshot %s", run)
+                shutil.rmtree(snapshot.path, ignore_errors=True)
+            continue
+
+        logger.warning(m18n.n('regenconf_recovering_interrupted_run', run=run))
+        _restore_regen_conf_snapshot(snapshot)
+
+
+def _rollback_regen_conf(run):
+    """Restore the files replaced by a regen-conf run, and reload the related
+    services through the post-regen hooks"""
+
+    if not os.path.exists(os.path.join(BACKUP_CONF_DIR, run, "manifest.yml")):
+        raise YunohostError('regenconf_rollback_unknown_run', run=run)
+
+    snapshot = RegenConfSnapshot.load(run)
+    restored = _restore_regen_conf_snapshot(snapshot)
+
+    env = {}
+    if os.path.exists("/etc/yunohost/installed"):
+        from yunohost.domain import domain_list
+        env["YNH_DOMAINS"] = " ".join(domain_list()["domains"])
+
+    def _pre_call(name, priority, path, args):
+        return ['post', 0, 0, ','.join(restored.get(name, []))]
+
+    if restored:
+        hook_callback('conf_regen', restored.keys(), pre_callback=_pre_call, env=env)
+
+    logger.success(m18n.n('regenconf_rolled_back', run=run))
+
+    return dict((category, {'applied': dict((path, {'status': 'restored'}) for path in paths),
+                            'pending': {}})
+                for category, paths in restored.items())
+
+
 def _process_regen_conf(system_conf, new_conf=None, save=True):
     """Regenerate a given system configuration file
 
@@ -564,20 +1138,26 @@ def manually_modified_files():
     for category, infos in regenconf_categories.items():
         conffiles = infos["conffiles"]
         for path, hash_ in conffiles.items():
-            if hash_ != _calculate_hash(path):
+            if not _file_matches_hash(path, hash_):
                 output.append(path)
 
+    _save_hash_cache()
+
     return output
 
 
 def manually_modified_files_compared_to_debian_default(ignore_handled_by_regenconf=False):
+    """List the conffiles of the Debian packages which differ from the
+    version shipped by their package
+
+    Conffiles are only hashed again when their stat changed since the last
+    time they were checked, c.f. _calculate_hash
+    """
 
-    # from https://serverfault.com/a/90401
-    files = subprocess.check_output("dpkg-query -W -f='${Conffiles}\n' '*' \
-                                   | awk 'OFS=\"  \"{print $2,$1}' \
-                                   | md5sum -c 2>/dev/null \
-                                   | awk -F': ' '$2 !~ /OK/{print $1}'", shell=True)
-    files = files.strip().split("\n")
+    files = [path for path, md5 in _get_dpkg_conffiles()
+             if _calculate_hash(path, "md5") != md5]
+
+    _save_hash_cache()
 
     if ignore_handled_by_regenconf:
         regenconf_categories = _get_regenconf_infos()
@@ -588,3 +1168,43 @@ def manually_modified_files_compared_to_debian_default(ignore_handled_by_regenco
         files = [f for f in files if f not in regenconf_files]
 
     return files
+
+
+def _get_dpkg_conffiles():
+    """Get the (path, md5) of the conffiles of every package known to dpkg
+
+    The status file is only parsed again when it changed, i.e. when packages
+    got installed, upgraded or removed
+    """
+
+    global dpkg_conffiles_
+
+    signature = _stat_signature(os.stat(DPKG_STATUS_FILE))
+    if dpkg_conffiles_ is None or dpkg_conffiles_[0] != signature:
+        dpkg_conffiles_ = (signature, _parse_dpkg_conffiles(DPKG_STATUS_FILE))
+
+    return dpkg_conffiles_[1]
+
+
+def _parse_dpkg_conffiles(status_file):
+    """Parse the Conffiles fields of a dpkg status file
+
+    Each conffile is declared on its own continuation line, as
+    ' <path> <md5> [obsolete]'. Conffiles not yet installed have 'newconffile'
+    instead of a md5 and are ignored, as 'md5sum -c' used to do.
+    """
+
+    conffiles = []
+    in_conffiles = False
+
+    with open(status_file) as f:
+        for line in f:
+            if line.startswith((" ", "\t")):
+                if in_conffiles:
+                    fields = line.split()
+                    if len(fields) >= 2 and len(fields[1]) == 32:
+                        conffiles.append((fields[0], fields[1]))
+            else:
+                in_conffiles = line.startswith("Conffiles:")
+
+    return conffiles
@@ -26,23 +26,45 @@
 
 import re
 import os
-import re
 import time
+import copy
 import yaml
+import zlib
+import mmap
+import signal
+import itertools
+import threading
 import subprocess
 
-from glob import glob
 from datetime import datetime
 
-from moulinette import m18n
+from moulinette import m18n, msettings
 from yunohost.utils.error import YunohostError
 from moulinette.utils.log import getActionLogger
 from moulinette.utils.filesystem import read_file, append_to_file, write_to_file
+from yunohost.utils.filesystem import SafeLoader
 
 MOULINETTE_LOCK = "/var/run/moulinette_yunohost.lock"
+SERVICES_CONF = "/etc/yunohost/services.yml"
+SSHD_CONFIG = "/etc/ssh/sshd_config"
+TEST_COMMAND_TIMEOUT = 20
+TEST_COMMANDS_MAX_PARALLEL = 8
+TEST_RESULT_CACHE_DURATION = 60
+GZIP_INDEX_BLOCK_SIZE = 4 * 1024 * 1024
+GZIP_INDEX_CACHE_SIZE = 16
+JOURNAL_PRIORITIES = ["emerg", "alert", "crit", "err", "warning", "notice", "info", "debug"]
 
 logger = getActionLogger('yunohost.service')
 
+# Lazy dev caching to reuse the same dbus connection to systemd for the whole
+# process (e.g. when checking services before and after app operations)
+systemd_manager_ = None
+service_status_cache_ = None
+service_registry_ = None
+
+# Seek indexes of the rotated gzip logs, c.f. _get_gzip_seek_index
+gzip_seek_indexes_ = {}
+
 
 def service_add(name, description=None, log=None, log_type="file", test_status=None, test_conf=None, needs_exposed_ports=None, need_lock=False, status=None):
     """
@@ -288,19 +310,40 @@ def service_status(names=[]):
         if check_names and name not in services.keys():
             raise YunohostError('service_unknown', service=name)
 
-        # this "service" isn't a service actually so we skip it
-        #
-        # the historical reason is because regenconf has been hacked into the
-        # service part of YunoHost will in some situation we need to regenconf
-        # for things that aren't services
-        # the hack was to add fake services...
-        # we need to extract regenconf from service at some point, also because
-        # some app would really like to use it
-        if services[name].get("status", "") is None:
-            continue
+    # this "service" isn't a service actually so we skip it
+    #
+    # the historical reason is because regenconf has been hacked into the
+    # service part of YunoHost will in some situation we need to regenconf
+    # for things that aren't services
+    # the hack was to add fake services...
+    # we need to extract regenconf from service at some point, also because
+    # some app would really like to use it
+    names_to_check = [name for name in names if services[name].get("status", "") is not None]
+
+    # In the API, the statuses are kept in memory and refreshed from systemd's
+    # signals instead of re-querying systemd each time the webadmin polls them
+    cache = _get_service_status_cache()
+
+    # Fetch the status of all the services at once from systemd
+    systemd_services = {name: services[name].get("actual_systemd_service", name) for name in names_to_check}
+    if cache is not None:
+        statuses = cache.get_services_information(set(systemd_services.values()))
+    else:
+        statuses = _get_services_information_from_systemd(set(systemd_services.values()))
+
+    # Fun stuff™ : to obtain the enabled/disabled status for sysv services,
+    # gotta do this ... cf code of /lib/systemd/systemd-sysv-install
+    sysv_enabled = set()
+    for rc_dir in ["/etc/rcS.d", "/etc/rc5.d"]:
+        if os.path.isdir(rc_dir):
+            sysv_enabled.update(f[3:] for f in os.listdir(rc_dir) if f.startswith("S"))
+
+    test_commands = {}
 
-        systemd_service = services[name].get("actual_systemd_service", name)
-        status = _get_service_information_from_systemd(systemd_service)
+    for name in names_to_check:
+
+        systemd_service = systemd_services[name]
+        status = statuses.get(systemd_service)
 
         if status is None:
             logger.error("Failed to get status information via dbus for service %s, systemctl didn't recognize this service ('NoSuchUnit')." % systemd_service)
@@ -333,10 +376,8 @@ def service_status(names=[]):
                 'configuration': "unknown",
             }
 
-            # Fun stuff™ : to obtain the enabled/disabled status for sysv services,
-            # gotta do this ... cf code of /lib/systemd/systemd-sysv-install
             if result[name]["start_on_boot"] == "generated":
-                result[name]["start_on_boot"] = "enabled" if glob("/etc/rc[S5].d/S??"+name) else "disabled"
+                result[name]["start_on_boot"] = "enabled" if name in sysv_enabled else "disabled"
             elif os.path.exists("/etc/systemd/system/multi-user.target.wants/%s.service" % name):
                 result[name]["start_on_boot"] = "enabled"
 
@@ -344,68 +385,417 @@ def service_status(names=[]):
                 result[name]['last_state_change'] = datetime.utcfromtimestamp(status["StateChangeTimestamp"] / 1000000)
 
             # 'test_status' is an optional field to test the status of the service using a custom command
-            if "test_status" in services[name]:
-                p = subprocess.Popen(services[name]["test_status"],
-                                     shell=True,
-                                     executable='/bin/bash',
-                                     stdout=subprocess.PIPE,
-                                     stderr=subprocess.STDOUT)
+            # 'test_conf' is an optional field to test the configuration of the service using a custom command
+            for test in ["test_status", "test_conf"]:
+                if test in services[name]:
+                    test_commands[(name, test)] = services[name][test]
+
+    # Run all the custom test commands concurrently
+    if cache is not None:
+        test_results = cache.get_test_results(test_commands)
+    else:
+        test_results = _run_test_commands(test_commands)
 
-                p.communicate()
+    for (name, test), (returncode, out) in test_results.items():
 
-                result[name]["status"] = "running" if p.returncode == 0 else "failed"
+        if test == "test_status":
+            result[name]["status"] = "running" if returncode == 0 else "failed"
 
-            # 'test_status' is an optional field to test the status of the service using a custom command
-            if "test_conf" in services[name]:
-                p = subprocess.Popen(services[name]["test_conf"],
-                                     shell=True,
-                                     executable='/bin/bash',
-                                     stdout=subprocess.PIPE,
-                                     stderr=subprocess.STDOUT)
-
-                out, _ = p.communicate()
-                if p.returncode == 0:
-                    result[name]["configuration"] = "valid"
-                else:
-                    result[name]["configuration"] = "broken"
-                    result[name]["configuration-details"] = out.strip().split("\n")
+        elif returncode == 0:
+            result[name]["configuration"] = "valid"
+        else:
+            result[name]["configuration"] = "broken"
+            result[name]["configuration-details"] = out.strip().split("\n")
 
     if len(names) == 1:
         return result[names[0]]
     return result
 
 
+def _get_service_status_cache():
+    """
+    Return the in-memory service status cache when running in the API
+    process, None otherwise
+    """
+
+    global service_status_cache_
+
+    if msettings.get('interface') != 'api':
+        return None
+
+    if service_status_cache_ is None:
+        try:
+            service_status_cache_ = ServiceStatusCache(SystemdSignalSource())
+        except Exception as e:
+            logger.debug("Could not subscribe to systemd signals, services statuses won't be cached: %s" % e)
+            service_status_cache_ = False
+
+    return service_status_cache_ or None
+
+
+def _get_test_fingerprint(name, test, regenconf_infos=None):
+    """
+    Return something that changes when the result of a test command may
+    change, or None if we can't tell (the result is then cached for a short
+    time only)
+
+    For test_conf, that's the state of the configuration files managed by the
+    regen-conf category of the same name, of their directories, and of
+    everything in the *.d subdirectories next to them, which is where the
+    files included by the main configuration live (e.g. app confs in
+    /etc/nginx/conf.d/<domain>.d/)
+
+    Keyword argument:
+        regenconf_infos -- The regen-conf infos, if already loaded
+
+    """
+
+    if test != "test_conf":
+        return None
+
+    if regenconf_infos is None:
+        from yunohost.regenconf import _get_regenconf_infos
+        regenconf_infos = _get_regenconf_infos()
+
+    conffiles = (regenconf_infos.get(name) or {}).get("conffiles", {})
+    if not conffiles:
+        return None
+
+    dirs = set(os.path.dirname(path) for path in conffiles.keys())
+
+    paths = set(conffiles.keys()) | dirs
+    for dir_ in dirs:
+        for included_dir in _list_included_dirs(dir_):
+            for root, dirnames, filenames in os.walk(included_dir):
+                paths.add(root)
+                paths.update(os.path.join(root, f) for f in filenames)
+
+    fingerprint = []
+    for path in sorted(paths):
+        try:
+            stat = os.stat(path)
+        except OSError:
+            fingerprint.append((path, None))
+        else:
+            fingerprint.append((path, stat.st_mtime, stat.st_size))
+
+    return tuple(fingerprint)
+
+
+def _list_included_dirs(dir_):
+    """
+    List the *.d subdirectories of a directory
+    """
+
+    try:
+        names = os.listdir(dir_)
+    except OSError:
+        return []
+
+    return [os.path.join(dir_, n) for n in names
+            if n.endswith(".d") and os.path.isdir(os.path.join(dir_, n))]
+
+
+class ServiceStatusCache(object):
+
+    """
+    In-memory table of the systemd properties of the services (and of their
+    test commands results), meant to live in the API process.
+
+    Entries are updated from the PropertiesChanged signals emitted by systemd,
+    delivered by the signal source. The signal source only has to provide:
+        - subscribe(on_properties_changed, on_reset) where
+          on_properties_changed(service, changed_properties) is to be called
+          when a unit changed (with None if the new values are unknown), and
+          on_reset() when everything should be reloaded
+          (e.g. daemon-reload, unit files enabled or disabled)
+        - process_pending() delivering the signals received since last call
+    """
+
+    def __init__(self, signal_source):
+        self.signal_source = signal_source
+        self.lock = threading.Lock()
+        self.units = {}
+        self.test_results = {}
+        signal_source.subscribe(self.on_properties_changed, self.on_reset)
+
+    def get_services_information(self, services):
+
+        self.signal_source.process_pending()
+
+        with self.lock:
+            missing = [s for s in services if s not in self.units]
+
+        if missing:
+            fetched = _get_services_information_from_systemd(missing)
+            with self.lock:
+                for service in missing:
+                    # Services unknown to systemd are cached as None
+                    self.units[service] = fetched.get(service)
+
+        with self.lock:
+            return {s: self.units[s] for s in services if self.units.get(s) is not None}
+
+    def get_test_results(self, commands):
+
+        now = time.time()
+        results = {}
+        to_run = {}
+        fingerprints = {}
+
+        # Loaded once for all the test_conf commands
+        regenconf_infos = None
+        if any(test == "test_conf" for _, test in commands.keys()):
+            from yunohost.regenconf import _get_regenconf_infos
+            regenconf_infos = _get_regenconf_infos()
+
+        for key, command in commands.items():
+            fingerprints[key] = _get_test_fingerprint(*key, regenconf_infos=regenconf_infos)
+            cached = self.test_results.get(key)
+            if cached is not None and cached["command"] == command:
+                if fingerprints[key] is not None:
+                    valid = cached["fingerprint"] == fingerprints[key]
+                else:
+                    valid = now - cached["time"] < TEST_RESULT_CACHE_DURATION
+                if valid:
+                    results[key] = cached["result"]
+                    continue
+            to_run[key] = command
+
+        for key, result in _run_test_commands(to_run).items():
+            self.test_results[key] = {"command": to_run[key],
+                                      "fingerprint": fingerprints[key],
+                                      "time": now,
+                                      "result": result}
+            results[key] = result
+
+        return results
+
+    def on_properties_changed(self, service, changed_properties):
+
+        with self.lock:
+            properties = self.units.get(service)
+            if properties is None or changed_properties is None:
+                # Either not tracked, previously unknown to systemd, or we
+                # don't know the new values : just drop it such that it gets
+                # fetched again on next read
+                self.units.pop(service, None)
+                return
+
+            for property_, value in changed_properties.items():
+                if property_ in properties:
+                    properties[property_] = value
+
+    def on_reset(self):
+
+        with self.lock:
+            self.units = {}
+
+
+class SystemdSignalSource(object):
+
+    """
+    Subscribe to systemd's signals on a dedicated dbus connection.
+
+    Signals are queued by the GLib main context and only dispatched when
+    process_pending() is called, so that we don't need a separate thread
+    running a main loop (which wouldn't play well with the API server).
+    """
+
+    def __init__(self):
+
+        import dbus
+        from dbus.mainloop.glib import DBusGMainLoop
+
+        try:
+            from gi.repository import GLib
+            self.context = GLib.MainContext.default()
+        except ImportError:
+            import gobject
+            self.context = gobject.main_context_default()
+
+        self.bus = dbus.SystemBus(mainloop=DBusGMainLoop(), private=True)
+        systemd = self.bus.get_object('org.freedesktop.systemd1', '/org/freedesktop/systemd1', introspect=False)
+        self.manager = dbus.Interface(systemd, 'org.freedesktop.systemd1.Manager')
+
+    def subscribe(self, on_properties_changed, on_reset):
+
+        def properties_changed(interface, changed, invalidated, path=None):
+            if interface != 'org.freedesktop.systemd1.Unit' or not path:
+                return
+            service = _unit_name_from_path(path)
+            if not service.endswith('.service'):
+                return
+            service = service[:-len('.service')]
+            # If values are not provided, drop everything we know about it
+            on_properties_changed(service, changed if not invalidated else None)
+
+        self.bus.add_signal_receiver(properties_changed,
+                                     signal_name='PropertiesChanged',
+                                     dbus_interface='org.freedesktop.DBus.Properties',
+                                     bus_name='org.freedesktop.systemd1',
+                                     path_keyword='path')
+        for signal_name in ['UnitFilesChanged', 'Reloading']:
+            self.bus.add_signal_receiver(lambda *args: on_reset(),
+                                         signal_name=signal_name,
+                                         dbus_interface='org.freedesktop.systemd1.Manager',
+                                         bus_name='org.freedesktop.systemd1')
+
+        # systemd only emits the signals if someone subscribed
+        self.manager.Subscribe()
+
+    def process_pending(self):
+        while self.context.pending():
+            self.context.iteration(False)
+
+
+def _unit_name_from_path(path):
+    """
+    Convert a systemd unit object path back to the unit name, e.g.
+    /org/freedesktop/systemd1/unit/nginx_2eservice -> nginx.service
+    """
+
+    name = path.rsplit('/', 1)[-1]
+    return re.sub(r'_([0-9a-f]{2})', lambda m: chr(int(m.group(1), 16)), name)
+
+
+def _get_systemd_manager():
+    """
+    Return the (cached) systemd manager interface, such that we reuse the same
+    D-Bus connection for the whole process
+    """
+
+    global systemd_manager_
+
+    import dbus
+
+    if systemd_manager_ is None:
+        bus = dbus.SystemBus()
+        # We don't need the introspection data, which costs an extra roundtrip
+        systemd = bus.get_object('org.freedesktop.systemd1', '/org/freedesktop/systemd1', introspect=False)
+        systemd_manager_ = (bus, dbus.Interface(systemd, 'org.freedesktop.systemd1.Manager'))
+
+    return systemd_manager_
+
+
+def _get_services_information_from_systemd(services):
+    """
+    Fetch the unit properties of several services at once, using a single
+    query to systemd via dbus
+
+    Returns a dict {service: properties}, services unknown to systemd being
+    left out
+    """
+
+    import dbus
+
+    services = list(services)
+    if not services:
+        return {}
+
+    bus, manager = _get_systemd_manager()
+    units = [service + '.service' for service in services]
+
+    # This returns (name, description, load_state, active_state, sub_state,
+    # followed, unit_path, job_id, job_type, job_path) for each unit
+    result = {}
+    for unit in manager.ListUnitsByNames(units):
+        name, description, load_state, active_state, sub_state, _, unit_path = unit[:7]
+        if load_state == "not-found":
+            # Service doesn't really exist
+            continue
+
+        properties = {"Description": description,
+                      "LoadState": load_state,
+                      "ActiveState": active_state,
+                      "SubState": sub_state}
+
+        unit_proxy = bus.get_object('org.freedesktop.systemd1', unit_path, introspect=False)
+        properties_interface = dbus.Interface(unit_proxy, 'org.freedesktop.DBus.Properties')
+        for property_ in ["UnitFileState", "StateChangeTimestamp"]:
+            properties[property_] = properties_interface.Get('org.freedesktop.systemd1.Unit', property_)
+
+        result[str(name)[:-len('.service')]] = properties
+
+    return result
+
+
 def _get_service_information_from_systemd(service):
     "this is the equivalent of 'systemctl status $service'"
-    import dbus
 
-    d = dbus.SystemBus()
+    return _get_services_information_from_systemd([service]).get(service)
 
-    systemd = d.get_object('org.freedesktop.systemd1', '/org/freedesktop/systemd1')
-    manager = dbus.Interface(systemd, 'org.freedesktop.systemd1.Manager')
 
-    # c.f. https://zignar.net/2014/09/08/getting-started-with-dbus-python-systemd/
-    # Very interface, much intuitive, wow
-    service_unit = manager.LoadUnit(service + '.service')
-    service_proxy = d.get_object('org.freedesktop.systemd1', str(service_unit))
-    properties_interface = dbus.Interface(service_proxy, 'org.freedesktop.DBus.Properties')
+def _run_test_commands(commands, timeout=TEST_COMMAND_TIMEOUT):
+    """
+    Run the services' custom test commands concurrently in a thread pool.
+    Commands still running after the timeout get killed and are considered
+    as failed.
 
-    properties = properties_interface.GetAll('org.freedesktop.systemd1.Unit')
+    Keyword argument:
+        commands -- A dict {key: shell command}
 
-    if properties.get("LoadState", "not-found") == "not-found":
-        # Service doesn't really exist
-        return None
-    else:
-        return properties
+    Returns a dict {key: (returncode, output)}
+    """
+
+    if not commands:
+        return {}
+
+    from multiprocessing.pool import ThreadPool
+
+    def run(command):
+        # Run in its own session (hence process group), to be able to kill
+        # the commands spawned by bash as well. This is done by setsid(1)
+        # rather than with preexec_fn, which may deadlock the forked child
+        # when the parent has several threads
+        p = subprocess.Popen(["setsid", "/bin/bash", "-c", command],
+                             stdout=subprocess.PIPE,
+                             stderr=subprocess.STDOUT)
+
+        timed_out = []
+
+        def kill():
+            timed_out.append(True)
+            try:
+                os.killpg(p.pid, signal.SIGKILL)
+            except OSError:
+                pass
+
+        timer = threading.Timer(timeout, kill)
+        timer.start()
+        try:
+            out, _ = p.communicate()
+        finally:
+            timer.cancel()
+
+        if timed_out:
+            return 1, "Command '%s' timed out after %s seconds" % (command, timeout)
 
+        return p.returncode, out
 
-def service_log(name, number=50):
+    keys = list(commands.keys())
+    pool = ThreadPool(min(len(keys), TEST_COMMANDS_MAX_PARALLEL))
+    try:
+        outputs = pool.map(run, [commands[key] for key in keys])
+    finally:
+        pool.close()
+
+    return dict(zip(keys, outputs))
+
+
+def service_log(name, number=50, since=None, until=None, priority=None,
+                before=None, after=None):
     """
     Log every log files of a service
 
     Keyword argument:
         name -- Service name to log
         number -- Number of lines to display
+        since -- Only display journal entries more recent than this date
+        until -- Only display journal entries older than this date
+        priority -- Only display journal entries with this priority or a more important one
+        before -- Display the page of journal entries before this cursor
+        after -- Display the page of journal entries after this cursor
 
     """
     services = _get_services()
@@ -425,7 +815,17 @@ def service_log(name, number=50):
     result = {}
 
     # First we always add the logs from journalctl / systemd
-    result["journalctl"] = _get_journalctl_logs(name, number).splitlines()
+    systemd_service = services[name].get("actual_systemd_service", name)
+    result["journalctl"], result["journalctl_cursors"] = \
+        _read_journal(systemd_service, number,
+                      since=_parse_journal_date(since) if since else None,
+                      until=_parse_journal_date(until) if until else None,
+                      priority=JOURNAL_PRIORITIES.index(priority) if priority else None,
+                      before=before, after=after)
+
+    # When browsing the journal pages, the other logs are not relevant
+    if before or after:
+        return result
 
     for index, log_path in enumerate(log_list):
         log_type = log_type_list[index]
@@ -566,40 +966,7 @@ def _get_services():
     Get a dict of managed services with their parameters
 
     """
-    try:
-        with open('/etc/yunohost/services.yml', 'r') as f:
-            services = yaml.load(f)
-    except:
-        return {}
-
-    # some services are marked as None to remove them from YunoHost
-    # filter this
-    for key, value in services.items():
-        if value is None:
-            del services[key]
-
-    # Dirty hack to automatically find custom SSH port ...
-    ssh_port_line = re.findall(r"\bPort *([0-9]{2,5})\b", read_file("/etc/ssh/sshd_config"))
-    if len(ssh_port_line) == 1:
-        services["ssh"]["needs_exposed_ports"] = [int(ssh_port_line[0])]
-
-    # Dirty hack to check the status of ynh-vpnclient
-    if "ynh-vpnclient" in services:
-        status_check = "systemctl is-active openvpn@client.service"
-        if "test_status" not in services["ynh-vpnclient"]:
-            services["ynh-vpnclient"]["test_status"] = status_check
-        if "log" not in services["ynh-vpnclient"]:
-            services["ynh-vpnclient"]["log"] = ["/var/log/ynh-vpnclient.log"]
-
-    # Stupid hack for postgresql which ain't an official service ... Can't
-    # really inject that info otherwise. Real service we want to check for
-    # status and log is in fact postgresql@x.y-main (x.y being the version)
-    if "postgresql" in services:
-        if "description" in services["postgresql"]:
-            del services["postgresql"]["description"]
-        services["postgresql"]["actual_systemd_service"] = "postgresql@9.6-main"
-
-    return services
+    return _get_service_registry().get()
 
 
 def _save_services(services):
@@ -611,68 +978,275 @@ def _save_services(services):
 
     """
     try:
-        with open('/etc/yunohost/services.yml', 'w') as f:
+        with open(SERVICES_CONF, 'w') as f:
             yaml.safe_dump(services, f, default_flow_style=False)
     except Exception as e:
         logger.warning('Error while saving services, exception: %s', e, exc_info=1)
         raise
+    finally:
+        _get_service_registry().invalidate()
 
 
-def _tail(file, n, filters=[]):
+def _get_service_registry():
+
+    global service_registry_
+    if service_registry_ is None:
+        service_registry_ = ServiceRegistry()
+    return service_registry_
+
+
+class ServiceRegistry(object):
+
     """
-    Reads a n lines from f with an offset of offset lines.  The return
-    value is a tuple in the form ``(lines, has_more)`` where `has_more` is
-    an indicator that is `True` if there are more lines in the file.
+    Process-level cache of the managed services
 
-    This function works even with splitted logs (gz compression, log rotate...)
+    services.yml and sshd_config are only parsed again when their mtime (or
+    size) changed since the last call. Each call returns its own deep copy
+    of the parsed snapshot, such that callers are free to modify it (e.g.
+    before calling _save_services) without altering the cached one.
     """
-    avg_line_length = 74
-    to_read = n
 
-    if filters:
-        filters = [re.compile(f) for f in filters]
+    def __init__(self):
+        self.snapshot = None
+        self.key = None
+
+    def get(self):
+
+        key = (_stat_key(SERVICES_CONF), _stat_key(SSHD_CONFIG))
+        if self.snapshot is None or key != self.key:
+            self.snapshot = self._load()
+            self.key = key
+
+        return copy.deepcopy(self.snapshot)
+
+    def invalidate(self):
+        self.snapshot = None
+
+    def _load(self):
+
+        try:
+            with open(SERVICES_CONF, 'r') as f:
+                services = yaml.load(f, Loader=SafeLoader)
+        except:
+            return {}
+
+        # some services are marked as None to remove them from YunoHost
+        # filter this
+        for key, value in services.items():
+            if value is None:
+                del services[key]
+
+        # Dirty hack to automatically find custom SSH port ...
+        ssh_port_line = re.findall(r"\bPort *([0-9]{2,5})\b", read_file(SSHD_CONFIG))
+        if len(ssh_port_line) == 1:
+            services["ssh"]["needs_exposed_ports"] = [int(ssh_port_line[0])]
 
+        # Dirty hack to check the status of ynh-vpnclient
+        if "ynh-vpnclient" in services:
+            status_check = "systemctl is-active openvpn@client.service"
+            if "test_status" not in services["ynh-vpnclient"]:
+                services["ynh-vpnclient"]["test_status"] = status_check
+            if "log" not in services["ynh-vpnclient"]:
+                services["ynh-vpnclient"]["log"] = ["/var/log/ynh-vpnclient.log"]
+
+        # Stupid hack for postgresql which ain't an official service ... Can't
+        # really inject that info otherwise. Real service we want to check for
+        # status and log is in fact postgresql@x.y-main (x.y being the version)
+        if "postgresql" in services:
+            if "description" in services["postgresql"]:
+                del services["postgresql"]["description"]
+            services["postgresql"]["actual_systemd_service"] = "postgresql@9.6-main"
+
+        return services
+
+
+def _stat_key(path):
     try:
-        if file.endswith(".gz"):
-            import gzip
-            f = gzip.open(file)
-            lines = f.read().splitlines()
-        else:
-            f = open(file)
-            pos = 1
-            lines = []
-            while len(lines) < to_read and pos > 0:
-                try:
-                    f.seek(-(avg_line_length * to_read), 2)
-                except IOError:
-                    # woops.  apparently file is smaller than what we want
-                    # to step back, go to the beginning instead
-                    f.seek(0)
-
-                pos = f.tell()
-                lines = f.read().splitlines()
-
-                for filter_ in filters:
-                    lines = [l for l in lines if not filter_.search(l)]
-
-                if len(lines) >= to_read:
-                    return lines[-to_read:]
-
-                avg_line_length *= 1.3
-        f.close()
-
-    except IOError as e:
-        logger.warning("Error while tailing file '%s': %s", file, e, exc_info=1)
-        return []
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return (stat.st_mtime, stat.st_size, stat.st_ino)
+
+
+def _tail(file, n, filters=[]):
+    """
+    Reads the last n lines of a file, skipping the lines matching any of the
+    filters.
+
+    This function works even with splitted logs (gz compression, log rotate...)
+    : the file and its rotated versions (.1, .2.gz, ...) are read backward as
+    a single stream, and only as far as needed.
+    """
 
-    if len(lines) < to_read:
-        previous_log_file = _find_previous_log_file(file)
-        if previous_log_file is not None:
-            lines = _tail(previous_log_file, to_read - len(lines)) + lines
+    filters = [re.compile(f) for f in filters]
 
+    lines = (line for line in _reverse_lines_across_rotations(file)
+             if not any(filter_.search(line) for filter_ in filters))
+
+    lines = list(itertools.islice(lines, n))
+    lines.reverse()
     return lines
 
 
+def _reverse_lines_across_rotations(file):
+    """
+    Yield the lines of a log file from the last one to the first one, then
+    continue with the previous (rotated) log files
+    """
+
+    while file is not None:
+        try:
+            for line in _reverse_lines(file):
+                yield line
+        except (IOError, OSError) as e:
+            logger.warning("Error while tailing file '%s': %s", file, e, exc_info=1)
+            return
+
+        file = _find_previous_log_file(file)
+
+
+def _reverse_lines(file):
+    """
+    Yield the lines of a file from the last one to the first one, by scanning
+    newlines backward from the end of the file
+    """
+
+    if file.endswith(".gz"):
+        for line in _reverse_lines_gzip(file):
+            yield line
+        return
+
+    with open(file, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        if size == 0:
+            return
+
+        content = mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ)
+        try:
+            end = size
+            if content[end - 1:end] == b"\n":
+                end -= 1
+            while True:
+                start = content.rfind(b"\n", 0, end) + 1
+                yield content[start:end]
+                if start == 0:
+                    break
+                end = start - 1
+        finally:
+            content.close()
+
+
+def _reverse_lines_gzip(file):
+    """
+    Yield the lines of a gzip file from the last one to the first one
+
+    Gzip streams can only be decompressed forward, so we rely on a seek index
+    of decompressor checkpoints (c.f. _get_gzip_seek_index) and decompress
+    the blocks one at a time, starting from the last one.
+    """
+
+    checkpoints = _get_gzip_seek_index(file)
+
+    with open(file, 'rb') as f:
+        # The beginning of the first line of a block is at the end of the
+        # previous block, so we carry it over
+        carry = b""
+        empty = True
+        for index in reversed(range(len(checkpoints))):
+            offset, decompressor, position = checkpoints[index]
+            if index + 1 < len(checkpoints):
+                length = checkpoints[index + 1][2] - position
+            else:
+                length = None
+
+            block = _read_gzip_block(f, offset, decompressor, length)
+            if not block:
+                continue
+
+            lines = (block + carry).split(b"\n")
+            if empty and lines[-1] == b"":
+                # Trailing newline at the very end of the file
+                lines.pop()
+            empty = False
+
+            carry = lines.pop(0) if lines else b""
+            for line in reversed(lines):
+                yield line
+
+        if not empty:
+            yield carry
+
+
+def _get_gzip_seek_index(file):
+    """
+    Return a list of (compressed offset, decompressor, decompressed offset)
+    checkpoints from which a gzip file can be decompressed, about every
+    GZIP_INDEX_BLOCK_SIZE bytes of decompressed data
+
+    Building it requires to decompress the whole file once, so the index is
+    kept in memory for the next calls (typically, in the API process).
+    """
+
+    stat = os.stat(file)
+    key = (file, stat.st_size, stat.st_mtime)
+    if key in gzip_seek_indexes_:
+        return gzip_seek_indexes_[key]
+
+    checkpoints = [(0, None, 0)]
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    position = 0
+    last_checkpoint = 0
+
+    with open(file, 'rb') as f:
+        for chunk in iter(lambda: f.read(64 * 1024), b""):
+            while chunk:
+                position += len(decompressor.decompress(chunk))
+                # A new gzip member starts (e.g. concatenated gzip files)
+                chunk = decompressor.unused_data
+                if chunk:
+                    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+
+            # We're at a chunk boundary, i.e. the decompressor consumed all
+            # the data up to this offset
+            if position - last_checkpoint >= GZIP_INDEX_BLOCK_SIZE:
+                checkpoints.append((f.tell(), decompressor.copy(), position))
+                last_checkpoint = position
+
+    if len(gzip_seek_indexes_) >= GZIP_INDEX_CACHE_SIZE:
+        gzip_seek_indexes_.clear()
+    gzip_seek_indexes_[key] = checkpoints
+
+    return checkpoints
+
+
+def _read_gzip_block(f, offset, decompressor, length=None):
+    """
+    Decompress 'length' bytes (or up to the end) from a checkpoint of the
+    gzip seek index
+    """
+
+    f.seek(offset)
+    # Decompressors are stateful, don't alter the one kept in the index
+    decompressor = decompressor.copy() if decompressor else zlib.decompressobj(16 + zlib.MAX_WBITS)
+
+    data = []
+    size = 0
+    for chunk in iter(lambda: f.read(64 * 1024), b""):
+        while chunk:
+            decompressed = decompressor.decompress(chunk)
+            data.append(decompressed)
+            size += len(decompressed)
+            chunk = decompressor.unused_data
+            if chunk:
+                decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+
+        if length is not None and size >= length:
+            break
+
+    data = b"".join(data)
+    return data[:length] if length is not None else data
+
+
 def _find_previous_log_file(file):
     """
     Find the previous log file
@@ -701,7 +1275,109 @@ def _get_journalctl_logs(service, number="all"):
     services = _get_services()
     systemd_service = services.get(service, {}).get("actual_systemd_service", service)
     try:
-        return subprocess.check_output("journalctl -xn -u {0} -n{1}".format(systemd_service, number), shell=True)
+        lines, _ = _read_journal(systemd_service, None if number == "all" else int(number))
+        return "\n".join(lines)
     except:
         import traceback
         return "error while get services logs from journalctl:\n%s" % traceback.format_exc()
+
+
+def _read_journal(unit, number=50, since=None, until=None, priority=None,
+                  before=None, after=None):
+    """
+    Read the journal entries of a systemd unit, in the same format as
+    journalctl, streaming them from the journal instead of buffering the
+    whole output of a journalctl subprocess.
+
+    By default, the last 'number' entries (optionally between the since and
+    until dates) are returned. The 'previous' and 'next' cursors returned along
+    with the lines can be given back as 'before' or 'after' to fetch the
+    previous or next page.
+
+    Returns a tuple (lines, {"previous": cursor, "next": cursor})
+    """
+
+    from systemd import journal
+
+    if not re.search(r"\.(service|socket|timer|target|mount)$", unit):
+        unit += ".service"
+
+    reader = journal.Reader()
+    try:
+        # Match the same entries as 'journalctl -u' : the logs of the unit
+        # itself and the messages of systemd about it
+        reader.add_match(_SYSTEMD_UNIT=unit)
+        reader.add_disjunction()
+        reader.add_match(UNIT=unit, _PID="1")
+        if priority is not None:
+            reader.add_conjunction()
+            reader.log_level(priority)
+
+        entries = []
+
+        def page_is_full():
+            return number is not None and len(entries) >= number
+
+        if after:
+            reader.seek_cursor(after)
+            while not page_is_full():
+                entry = reader.get_next()
+                if not entry:
+                    break
+                if entry["__CURSOR"] == after or (since and entry["__REALTIME_TIMESTAMP"] < since):
+                    continue
+                if until and entry["__REALTIME_TIMESTAMP"] > until:
+                    break
+                entries.append(entry)
+        else:
+            if before:
+                reader.seek_cursor(before)
+            elif until:
+                reader.seek_realtime(until)
+            else:
+                reader.seek_tail()
+            while not page_is_full():
+                entry = reader.get_previous()
+                if not entry:
+                    break
+                if entry["__CURSOR"] == before or (until and entry["__REALTIME_TIMESTAMP"] > until):
+                    continue
+                if since and entry["__REALTIME_TIMESTAMP"] < since:
+                    break
+                entries.append(entry)
+            entries.reverse()
+    finally:
+        reader.close()
+
+    cursors = {
+        "previous": entries[0]["__CURSOR"] if entries else before,
+        "next": entries[-1]["__CURSOR"] if entries else after,
+    }
+
+    return [_format_journal_entry(e) for e in entries], cursors
+
+
+def _format_journal_entry(entry):
+    """
+    Format a journal entry like journalctl's default ('short') output
+    """
+
+    identifier = entry.get("SYSLOG_IDENTIFIER") or entry.get("_COMM") or "unknown"
+    if "_PID" in entry:
+        identifier += "[%s]" % entry["_PID"]
+
+    return "%s %s %s: %s" % (entry["__REALTIME_TIMESTAMP"].strftime("%b %d %H:%M:%S"),
+                             entry.get("_HOSTNAME", "localhost"),
+                             identifier,
+                             entry.get("MESSAGE", ""))
+
+
+def _parse_journal_date(date):
+
+    for date_format in ["%Y-%m-%d %H:%M:%S", "%Y-%m-%d %H:%M", "%Y-%m-%d"]:
+        try:
+            return datetime.strptime(date, date_format)
+        except ValueError:
+            continue
+
+    raise YunohostError('service_log_invalid_date', date=date)
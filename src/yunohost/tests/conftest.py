@@ -29,6 +29,17 @@ def raiseYunohostError(mocker, key, **kwargs):
 
 def pytest_addoption(parser):
     parser.addoption("--yunodebug", action="store_true", default=False)
+    parser.addoption("--benchmark", action="store_true", default=False,
+                     help="Also run the benchmarks (tests marked with 'benchmark')")
+
+
+def pytest_collection_modifyitems(config, items):
+    if config.getoption("--benchmark"):
+        return
+    skip_benchmark = pytest.mark.skip(reason="benchmark, use --benchmark to run it")
+    for item in items:
+        if "benchmark" in item.keywords:
+            item.add_marker(skip_benchmark)
 
 #
 # Tweak translator to raise exceptions if string keys are not defined       #
@@ -0,0 +1,256 @@
+import os
+import json
+import time
+import random
+import tarfile
+import pytest
+
+from distutils.spawn import find_executable
+
+import yunohost.utils.archive
+from yunohost.utils.archive import COMPRESSIONS, open_archive, extract_members, extract_indexed_members, \
+    detect_compression, split_archive_extension
+
+# zstd may not be available on the test machine
+compressions = [c for c in COMPRESSIONS if c != "zstd" or find_executable("zstd")]
+
+
+def generate_tree(root, nb_files=200, file_size=100000):
+    """
+    Generate files that compress more or less like real data: a mix of random
+    bytes and of repeated words
+    """
+    rand = random.Random(42)
+    words = ["yunohost", "backup", "archive", "nginx", "postfix", "foo", "bar"]
+    for i in range(nb_files):
+        path = os.path.join(root, "dir%s" % (i % 10), "file%s" % i)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, "wb") as f:
+            f.write(os.urandom(file_size // 4))
+            f.write(" ".join(rand.choice(words) for _ in range(file_size // 8))[:file_size * 3 // 4])
+    return nb_files * file_size
+
+
+@pytest.fixture
+def tree(tmpdir):
+    root = str(tmpdir.join("tree"))
+    generate_tree(root, nb_files=20, file_size=10000)
+    return root
+
+
+@pytest.mark.parametrize("compression", compressions)
+def test_archive_roundtrip(tmpdir, tree, compression):
+    archive = str(tmpdir.join("backup" + COMPRESSIONS[compression]["extension"]))
+
+    tar = open_archive(archive, "w", compression)
+    tar.add(tree, arcname="tree")
+    tar.close()
+
+    assert detect_compression(archive) == compression
+
+    tar = open_archive(archive)
+    extracted = extract_members(tar, str(tmpdir.join("out")), lambda name: name.startswith("tree/dir1"))
+    tar.close()
+
+    assert "tree/dir1/file1" in extracted
+    assert "tree/dir2/file2" not in extracted
+    assert open(os.path.join(tree, "dir1", "file11")).read() == \
+        open(str(tmpdir.join("out", "tree", "dir1", "file11"))).read()
+
+
+@pytest.fixture
+def hardlinks(tmpdir):
+    root = str(tmpdir.join("hardlinks"))
+    os.makedirs(os.path.join(root, "data", "a"))
+    os.makedirs(os.path.join(root, "apps", "b"))
+    open(os.path.join(root, "data", "a", "f"), "w").write("foo")
+    os.link(os.path.join(root, "data", "a", "f"), os.path.join(root, "apps", "b", "f"))
+    os.link(os.path.join(root, "data", "a", "f"), os.path.join(root, "apps", "b", "g"))
+    return root
+
+
+def test_archive_hardlink_to_unselected_member(tmpdir, hardlinks):
+    archive = str(tmpdir.join("backup.tar.gz"))
+    tar = open_archive(archive, "w", "gz")
+    tar.add(os.path.join(hardlinks, "data"), arcname="data")
+    tar.add(os.path.join(hardlinks, "apps"), arcname="apps")
+    tar.close()
+
+    out = str(tmpdir.join("out"))
+    tar = open_archive(archive)
+    extracted = extract_members(tar, out, lambda name: name.startswith("apps/b"))
+    tar.close()
+
+    assert sorted(extracted) == ["apps/b", "apps/b/f", "apps/b/g"]
+    assert not os.path.exists(os.path.join(out, "data"))
+    assert open(os.path.join(out, "apps", "b", "f")).read() == "foo"
+    assert os.path.samefile(os.path.join(out, "apps", "b", "f"), os.path.join(out, "apps", "b", "g"))
+
+
+def test_archive_compression_detected_from_content(tmpdir, tree):
+    # e.g. an archive created by hand with a wrong extension
+    archive = str(tmpdir.join("backup.tar"))
+    tar = tarfile.open(archive, "w:gz")
+    tar.add(tree, arcname="tree")
+    tar.close()
+
+    tar = open_archive(archive)
+    assert len([m for m in tar if m.isfile()]) == 20
+    tar.close()
+
+
+def test_archive_stop_reading_early(tmpdir, tree):
+    archive = str(tmpdir.join("backup.tar.gz"))
+    tar = open_archive(archive, "w", "gz")
+    tar.add(tree, arcname="tree")
+    tar.close()
+
+    tar = open_archive(archive)
+    assert tar.next().name == "tree"
+    tar.close()
+
+
+def test_archive_corrupted(tmpdir, tree):
+    archive = str(tmpdir.join("backup.tar.gz"))
+    tar = open_archive(archive, "w", "gz")
+    tar.add(tree, arcname="tree")
+    tar.close()
+
+    data = open(archive, "rb").read()
+    open(archive, "wb").write(data[:len(data) // 2])
+
+    tar = open_archive(archive)
+    with pytest.raises((IOError, tarfile.TarError)):
+        try:
+            list(tar)
+        finally:
+            tar.close()
+
+
+@pytest.mark.parametrize("compression", compressions)
+def test_archive_indexed_extraction(tmpdir, tree, compression, monkeypatch):
+    monkeypatch.setattr(yunohost.utils.archive, "BLOCK_MIN_SIZE", 1000)
+    archive = str(tmpdir.join("backup" + COMPRESSIONS[compression]["extension"]))
+
+    tar = open_archive(archive, "w", compression)
+    for i in range(10):
+        tar.new_block()
+        tar.add(os.path.join(tree, "dir%s" % i), arcname="tree/dir%s" % i)
+    tar.close()
+    index = json.loads(json.dumps(tar.index))
+
+    if compression != "none":
+        assert len(index["blocks"]) == 10
+    assert index["archive_size"] == os.path.getsize(archive)
+
+    # Each block can be decompressed independently, and so can the archive
+    # as a whole
+    out = str(tmpdir.join("out"))
+    extracted = extract_indexed_members(archive, index, out,
+                                        lambda name: name.startswith(("tree/dir3", "tree/dir4", "tree/dir7")))
+    assert sorted(extracted) == ["tree/dir3", "tree/dir3/file13", "tree/dir3/file3",
+                                 "tree/dir4", "tree/dir4/file14", "tree/dir4/file4",
+                                 "tree/dir7", "tree/dir7/file17", "tree/dir7/file7"]
+    assert sorted(os.listdir(os.path.join(out, "tree"))) == ["dir3", "dir4", "dir7"]
+    assert open(os.path.join(tree, "dir7", "file17")).read() == \
+        open(os.path.join(out, "tree", "dir7", "file17")).read()
+
+    tar = open_archive(archive)
+    assert len([m for m in tar if m.isfile()]) == 20
+    tar.close()
+
+
+def test_archive_indexed_hardlink_to_unselected_member(tmpdir, hardlinks, monkeypatch):
+    monkeypatch.setattr(yunohost.utils.archive, "BLOCK_MIN_SIZE", 1)
+    archive = str(tmpdir.join("backup.tar.gz"))
+    tar = open_archive(archive, "w", "gz")
+    tar.add(os.path.join(hardlinks, "data"), arcname="data")
+    tar.new_block()
+    tar.add(os.path.join(hardlinks, "apps"), arcname="apps")
+    tar.close()
+    index = json.loads(json.dumps(tar.index))
+
+    out = str(tmpdir.join("out"))
+    extracted = extract_indexed_members(archive, index, out, lambda name: name.startswith("apps/b"))
+
+    assert sorted(extracted) == ["apps/b", "apps/b/f", "apps/b/g"]
+    assert not os.path.exists(os.path.join(out, "data"))
+    assert open(os.path.join(out, "apps", "b", "g")).read() == "foo"
+    assert os.path.samefile(os.path.join(out, "apps", "b", "f"), os.path.join(out, "apps", "b", "g"))
+
+
+def test_split_archive_extension():
+    assert split_archive_extension("foo.tar.gz") == ("foo", ".tar.gz")
+    assert split_archive_extension("foo.tar.zst") == ("foo", ".tar.zst")
+    assert split_archive_extension("foo.tar") == ("foo", ".tar")
+    assert split_archive_extension("foo.info.json") == ("foo.info.json", None)
+
+
+@pytest.mark.benchmark
+def test_archive_compression_benchmark(tmpdir):
+
+    root = str(tmpdir.join("tree"))
+    size = generate_tree(root)
+
+    def bench(write):
+        archive = str(tmpdir.join("bench"))
+        start = time.time()
+        write(archive)
+        duration = time.time() - start
+        ratio = float(os.path.getsize(archive)) / size
+        os.remove(archive)
+        return size / duration / 1024 ** 2, ratio
+
+    def in_process_gz(archive):
+        tar = tarfile.open(archive, "w:gz")
+        tar.add(root, arcname="tree")
+        tar.close()
+
+    def piped(compression):
+        def write(archive):
+            tar = open_archive(archive, "w", compression)
+            tar.add(root, arcname="tree")
+            tar.close()
+        return write
+
+    print("")
+    print("Archiving %s MB on %s cores:" % (size // 1024 ** 2, os.sysconf("SC_NPROCESSORS_ONLN")))
+    print(" - tarfile w:gz (in-process zlib): %.1f MB/s, ratio %.2f" % bench(in_process_gz))
+    for compression in compressions:
+        print(" - %s: %.1f MB/s, ratio %.2f" % ((compression,) + bench(piped(compression))))
+
+
+@pytest.mark.benchmark
+def test_archive_indexed_extraction_benchmark(tmpdir):
+
+    root = str(tmpdir.join("tree"))
+    generate_tree(root)
+    archive = str(tmpdir.join("backup.tar.gz"))
+
+    tar = open_archive(archive, "w", "gz")
+    for i in range(10):
+        tar.new_block()
+        tar.add(os.path.join(root, "dir%s" % i), arcname="dir%s" % i)
+    tar.close()
+    index = tar.index
+
+    def select(name):
+        return name.startswith("dir9")
+
+    start = time.time()
+    tar = open_archive(archive)
+    full = extract_members(tar, str(tmpdir.join("full")), select)
+    tar.close()
+    full_duration = time.time() - start
+
+    start = time.time()
+    indexed = extract_indexed_members(archive, index, str(tmpdir.join("indexed")), select)
+    indexed_duration = time.time() - start
+
+    print("")
+    print("Extracting the last 10%% of a %s MB archive:" % (os.path.getsize(archive) // 1024 ** 2))
+    print(" - streaming the whole archive: %.3fs" % full_duration)
+    print(" - seeking to the block using the index: %.3fs" % indexed_duration)
+
+    assert indexed == full
@@ -7,7 +7,8 @@ from conftest import message, raiseYunohostError
 
 from yunohost.app import app_install, app_remove, app_ssowatconf
 from yunohost.app import _is_installed
-from yunohost.backup import backup_create, backup_restore, backup_list, backup_info, backup_delete, _recursive_umount
+from yunohost.backup import backup_create, backup_restore, backup_list, backup_info, backup_delete, \
+    backup_refresh_catalog, _recursive_umount, _get_backup_catalog
 from yunohost.domain import _get_maindomain
 from yunohost.user import user_permission_list, user_create, user_list, user_delete
 from yunohost.tests.test_permission import check_LDAP_db_integrity, check_permission_for_apps
@@ -220,6 +221,33 @@ def test_backup_only_ldap(mocker):
     assert "conf_ldap" in archives_info["system"].keys()
 
 
+def test_backup_catalog(monkeypatch, mocker):
+
+    with message(mocker, "backup_created"):
+        backup_create(system=["conf_ldap"], apps=None)
+
+    archive = backup_list()["archives"][0]
+    assert archive in _get_backup_catalog()
+
+    # Listing the archives doesn't need to open them anymore
+    def fail(*args, **kwargs):
+        raise AssertionError("The archive should not be opened")
+    monkeypatch.setattr("yunohost.backup.open_archive", fail)
+    monkeypatch.setattr("yunohost.backup.extract_indexed_members", fail)
+    os.remove("/home/yunohost.backup/archives/%s.info.json" % archive)
+
+    archives_info = backup_list(with_info=True)["archives"]
+    assert archives_info[archive]["checksum"] is None
+    assert "conf_ldap" in backup_info(archive, with_details=True)["system"].keys()
+
+    with message(mocker, "backup_catalog_refreshed", archives=1, checksummed=1):
+        backup_refresh_catalog()
+    assert backup_info(archive)["checksum"].startswith("sha256:")
+
+    backup_delete(archive)
+    assert archive not in _get_backup_catalog()
+
+
 def test_backup_system_part_that_does_not_exists(mocker):
 
     # Create the backup
@@ -316,13 +344,13 @@ def test_backup_script_failure_handling(monkeypatch, mocker):
 @pytest.mark.with_backup_recommended_app_installed
 def test_backup_not_enough_free_space(monkeypatch, mocker):
 
-    def custom_disk_usage(path):
-        return 99999999999999999
+    def custom_scan_disk_usage(paths):
+        return {path: (99999999999999999, {}) for path in paths}
 
     def custom_free_space_in_directory(dirpath):
         return 0
 
-    monkeypatch.setattr("yunohost.backup.disk_usage", custom_disk_usage)
+    monkeypatch.setattr("yunohost.backup.scan_disk_usage", custom_scan_disk_usage)
     monkeypatch.setattr("yunohost.backup.free_space_in_directory",
                         custom_free_space_in_directory)
 
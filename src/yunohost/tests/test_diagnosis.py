@@ -0,0 +1,344 @@
+import os
+import json
+import time
+import logging
+import threading
+import SocketServer
+import BaseHTTPServer
+
+import pytest
+
+import yunohost.diagnosis
+from yunohost.diagnosis import _run_diagnosis_categories, Diagnoser, DiagnosisReportStore, \
+    diagnosis_history, _get_diagnosis_history
+from yunohost.utils.error import YunohostError
+from yunohost.utils.ringbuffer import RingBufferFile
+
+# Dependencies and (rough) durations of a full diagnosis run
+CATEGORIES = [("basesystem", [], 0.2),
+              ("ip", [], 0.3),
+              ("dnsrecords", ["ip"], 0.3),
+              ("ports", ["ip", "dnsrecords"], 0.2),
+              ("web", ["ip", "dnsrecords"], 0.3),
+              ("mail", ["ip"], 0.4),
+              ("services", [], 0.1),
+              ("systemresources", [], 0.2),
+              ("regenconf", [], 0.1),
+              ("security", [], 0.2)]
+
+
+class ListHandler(logging.Handler):
+
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.messages = []
+
+    def emit(self, record):
+        self.messages.append(record.getMessage())
+
+
+def run_categories(max_parallel):
+    names = [name for name, _, _ in CATEGORIES]
+    dependencies = {name: deps for name, deps, _ in CATEGORIES}
+    durations = {name: duration for name, _, duration in CATEGORIES}
+    logger = logging.getLogger("yunohost.test_diagnosis")
+    finished = []
+
+    def run(category):
+        for i in range(3):
+            logger.warning("%s %s" % (category, i))
+            time.sleep(durations[category] / 3)
+        finished.append(category)
+        return {"id": category}
+
+    start = time.time()
+    results = _run_diagnosis_categories(names, dependencies, run, max_parallel=max_parallel)
+    return results, finished, time.time() - start
+
+
+def test_run_categories_after_their_dependencies():
+    results, finished, _ = run_categories(4)
+
+    assert sorted(c for c, _, _ in results) == sorted(name for name, _, _ in CATEGORIES)
+    assert all(result == {"id": c} for c, result, _ in results)
+    for category in ["dnsrecords", "ports", "web", "mail"]:
+        assert finished.index("ip") < finished.index(category)
+    # ports and web read the cached dnsrecords report
+    for category in ["ports", "web"]:
+        assert finished.index("dnsrecords") < finished.index(category)
+
+
+def test_run_categories_logs_not_interleaved():
+    handler = ListHandler()
+    logging.getLogger().addHandler(handler)
+    try:
+        results = run_categories(4)[0]
+    finally:
+        logging.getLogger().removeHandler(handler)
+
+    assert handler.messages == ["%s %s" % (c, i) for c, _, _ in results for i in range(3)]
+    assert not handler.filters
+
+
+def test_run_categories_failing_category():
+
+    def run(category):
+        if category == "ip":
+            raise Exception("Oops")
+        return {}
+
+    threads = threading.active_count()
+    results = _run_diagnosis_categories(["ip", "web"], {"web": ["ip"]}, run)
+    assert [(c, r) for c, r, _ in results] == [("ip", None), ("web", {})]
+    assert threading.active_count() == threads
+
+
+@pytest.mark.benchmark
+def test_run_categories_benchmark():
+
+    _, _, sequential_duration = run_categories(1)
+    _, _, parallel_duration = run_categories(4)
+
+    print("")
+    print("Full diagnosis run (simulated, %.1fs of diagnosis):" % sum(d for _, _, d in CATEGORIES))
+    print(" - one category after the other: %.2fs" % sequential_duration)
+    print(" - 4 categories in parallel: %.2fs" % parallel_duration)
+
+    assert parallel_duration < sequential_duration
+
+
+@pytest.fixture
+def diagnosis_cache(tmpdir, monkeypatch):
+    monkeypatch.setattr(yunohost.diagnosis, "DIAGNOSIS_CACHE", str(tmpdir))
+    monkeypatch.setattr(yunohost.diagnosis, "diagnosis_reports_", DiagnosisReportStore())
+
+    report = {"id": "dnsrecords",
+              "cached_for": 600,
+              "items": [{"meta": {"domain": "domain%s.test" % i, "category": "basic"},
+                         "data": {"AAAA:@": "OK" if i % 2 else "MISSING"},
+                         "status": "SUCCESS"} for i in range(100)]}
+    json.dump(report, open(str(tmpdir.join("dnsrecords.json")), "w"))
+
+    reads = []
+    read_json = yunohost.diagnosis.read_json
+
+    def _read_json(path):
+        reads.append(path)
+        return read_json(path)
+
+    monkeypatch.setattr(yunohost.diagnosis, "read_json", _read_json)
+    return reads
+
+
+def test_cached_report_loaded_once_per_run(diagnosis_cache):
+    report = Diagnoser.get_cached_report("dnsrecords")
+    item = Diagnoser.get_cached_report("dnsrecords", item={"category": "basic", "domain": "domain3.test"})
+    missing = Diagnoser.get_cached_report("dnsrecords", item={"domain": "nope.test"})
+
+    assert len(report["items"]) == 100
+    assert report["timestamp"] > 0
+    assert item["data"]["AAAA:@"] == "OK"
+    assert missing == {}
+    assert len(diagnosis_cache) == 1
+
+
+def test_cached_report_reloaded_once_updated(diagnosis_cache):
+    Diagnoser.get_cached_report("dnsrecords")
+
+    class DNSRecordsDiagnoser(Diagnoser):
+        id_ = "dnsrecords"
+
+    diagnoser = DNSRecordsDiagnoser({}, {}, (None, None, None))
+    diagnoser.write_cache({"id": "dnsrecords", "cached_for": 600, "items": []})
+
+    assert Diagnoser.get_cached_report("dnsrecords")["items"] == []
+    assert len(diagnosis_cache) == 2
+
+
+def test_cached_report_outside_of_a_run(diagnosis_cache, monkeypatch):
+    monkeypatch.setattr(yunohost.diagnosis, "diagnosis_reports_", None)
+
+    Diagnoser.get_cached_report("dnsrecords")
+    Diagnoser.get_cached_report("dnsrecords")
+    assert len(diagnosis_cache) == 2
+
+
+class FooDiagnoser(Diagnoser):
+
+    id_ = "foo"
+    cache_duration = 0
+    dependencies = []
+    inputs = ["domains"]
+    runs = []
+
+    def run(self):
+        self.runs.append(time.time())
+        yield dict(meta={"test": "foo"}, status="SUCCESS", summary="foo")
+
+
+def test_cached_report_reused_while_inputs_dont_change(diagnosis_cache, monkeypatch):
+    domains = ["yolo.test"]
+    monkeypatch.setattr(yunohost.diagnosis, "_get_diagnosis_input", lambda name: domains)
+    del FooDiagnoser.runs[:]
+
+    def diagnose():
+        return FooDiagnoser({}, {}, (lambda m: None,) * 3).diagnose()
+
+    diagnose()
+    # Past the cache duration, but the inputs did not change
+    assert diagnose() == (0, {})
+    assert len(FooDiagnoser.runs) == 1
+
+    domains.append("swag.test")
+    diagnose()
+    assert len(FooDiagnoser.runs) == 2
+
+    monkeypatch.setattr(yunohost.diagnosis, "DIAGNOSIS_MAX_CACHE_DURATION", 0)
+    diagnose()
+    assert len(FooDiagnoser.runs) == 3
+
+
+def test_optional_dependency_with_issues(diagnosis_cache, monkeypatch):
+    report = json.load(open(os.path.join(yunohost.diagnosis.DIAGNOSIS_CACHE, "dnsrecords.json")))
+    report["items"][0]["status"] = "ERROR"
+    json.dump(report, open(os.path.join(yunohost.diagnosis.DIAGNOSIS_CACHE, "dnsrecords.json"), "w"))
+    monkeypatch.setattr(yunohost.diagnosis, "diagnosis_reports_", None)
+    monkeypatch.setattr(yunohost.diagnosis, "_get_diagnosis_input", lambda name: [])
+    monkeypatch.setattr(FooDiagnoser, "dependencies", ["dnsrecords"])
+    del FooDiagnoser.runs[:]
+
+    def diagnose():
+        return FooDiagnoser({"force": True}, {}, (lambda m: None,) * 3).diagnose()
+
+    assert diagnose() == (1, {})
+    assert len(FooDiagnoser.runs) == 0
+
+    monkeypatch.setattr(FooDiagnoser, "optional_dependencies", ["dnsrecords"])
+    diagnose()
+    assert len(FooDiagnoser.runs) == 1
+
+
+class StubDiagnosisServerHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    # Keep-alive, like the actual diagnosis server
+    protocol_version = "HTTP/1.1"
+
+    def do_POST(self):
+        data = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        self.server.requests.append((self.path, self.client_address))
+
+        if self.path == "/check-ports":
+            status, response = 200, {"status": "ok", "ports": {str(p): True for p in data["ports"]}}
+        else:
+            status, response = 400, {"status": "error"}
+
+        content = json.dumps(response)
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def diagnosis_server(monkeypatch):
+    class Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+        daemon_threads = True
+
+    server = Server(("127.0.0.1", 0), StubDiagnosisServerHandler)
+    server.requests = []
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+
+    monkeypatch.setattr(yunohost.diagnosis, "DIAGNOSIS_SERVER_URL", "http://127.0.0.1:%s" % server.server_address[1])
+    monkeypatch.setattr(yunohost.diagnosis, "remote_diagnosis_sessions_", {})
+
+    yield server
+
+    for session in yunohost.diagnosis.remote_diagnosis_sessions_.values():
+        session.close()
+    server.shutdown()
+    server.server_close()
+
+
+def test_remote_diagnosis_reuses_connections(diagnosis_server):
+    for _ in range(5):
+        r = Diagnoser.remote_diagnosis("check-ports", data={"ports": [22, 443]}, ipversion=4)
+        assert r == {"status": "ok", "ports": {"22": True, "443": True}}
+
+    assert len(diagnosis_server.requests) == 5
+    # All the requests went through the same connection
+    assert len(set(address for _, address in diagnosis_server.requests)) == 1
+
+
+def test_remote_diagnosis_ipversion(diagnosis_server):
+    # The stub server only listens in ipv4
+    with pytest.raises(Exception):
+        Diagnoser.remote_diagnosis("check-ports", data={"ports": [22]}, ipversion=6)
+    assert diagnosis_server.requests == []
+
+
+def test_remote_diagnosis_refused(diagnosis_server):
+    with pytest.raises(Exception) as e:
+        Diagnoser.remote_diagnosis("check-foo", data={}, ipversion=4)
+    assert "refused" in str(e.value)
+
+
+def test_ring_buffer(tmpdir):
+    path = str(tmpdir.join("ram"))
+    buffer_ = RingBufferFile(path, ["total", "available"], capacity=5)
+    assert buffer_.read() == []
+
+    for i in range(3):
+        buffer_.append(i, [1000, 100 + i])
+    assert buffer_.read() == [(0, 1000, 100), (1, 1000, 101), (2, 1000, 102)]
+
+    for i in range(3, 12):
+        buffer_.append(i, [1000, 100 + i])
+    assert [r[0] for r in buffer_.read()] == [7, 8, 9, 10, 11]
+    assert os.path.getsize(path) == buffer_._offset(5)
+
+    loaded = RingBufferFile.load(path)
+    assert loaded.fields == ["total", "available"] and loaded.capacity == 5
+    assert loaded.read() == buffer_.read()
+
+
+def test_ring_buffer_series_changed(tmpdir):
+    path = str(tmpdir.join("ram"))
+    RingBufferFile(path, ["total", "available"]).append(0, [1000, 100])
+
+    buffer_ = RingBufferFile(path, ["total", "available", "swap_used"])
+    assert buffer_.read() == []
+    buffer_.append(1, [1000, 100, 10])
+    assert buffer_.read() == [(1, 1000, 100, 10)]
+
+
+def test_diagnosis_history(tmpdir, monkeypatch):
+    monkeypatch.setattr(yunohost.diagnosis, "DIAGNOSIS_HISTORY_DIR", str(tmpdir.join("history")))
+
+    for i in range(30):
+        _get_diagnosis_history("diskusage:/var", ["total", "free"]).append(1500000000 + i, [1000, 1000 - i])
+    _get_diagnosis_history("ram", ["total", "available", "swap_used"]).append(1500000000, [2000, 1000, 0])
+
+    history = diagnosis_history()["history"]
+    assert sorted(history.keys()) == ["diskusage:/var", "ram"]
+    assert len(history["diskusage:/var"]) == 20
+    assert history["diskusage:/var"][-1]["free"] == 971
+
+    assert diagnosis_history(["ram"], number=1)["history"]["ram"][0]["available"] == 1000
+
+    with pytest.raises(YunohostError):
+        diagnosis_history(["foo"])
+
+
+def test_diagnosis_history_corrupted_series(tmpdir, monkeypatch):
+    monkeypatch.setattr(yunohost.diagnosis, "DIAGNOSIS_HISTORY_DIR", str(tmpdir.join("history")))
+
+    _get_diagnosis_history("ram", ["total", "available", "swap_used"]).append(1500000000, [2000, 1000, 0])
+    tmpdir.join("history", "foo").write("not a ring buffer")
+
+    assert list(diagnosis_history()["history"].keys()) == ["ram"]
@@ -0,0 +1,97 @@
+import os
+import time
+import subprocess
+import pytest
+
+from yunohost.utils.filesystem import disk_usage, scan_disk_usage
+
+
+def du(*paths):
+    output = subprocess.check_output(["du", "-scb"] + list(paths))
+    return int(output.strip().split("\n")[-1].split()[0])
+
+
+@pytest.fixture
+def trees(tmpdir):
+    root = str(tmpdir.join("app"))
+    os.makedirs(os.path.join(root, "a", "b", "c"))
+    os.makedirs(os.path.join(root, "d"))
+    open(os.path.join(root, "foo"), "w").write("x" * 1000)
+    open(os.path.join(root, "a", "bar"), "w").write("x" * 12345)
+    open(os.path.join(root, "a", "b", "c", "baz"), "w").write("x" * 54321)
+    # Hardlinks are only counted once, symlinks are not followed
+    os.link(os.path.join(root, "a", "bar"), os.path.join(root, "d", "bar"))
+    os.symlink(os.path.join(root, "a"), os.path.join(root, "d", "a"))
+
+    other = str(tmpdir.join("other"))
+    os.makedirs(other)
+    open(os.path.join(other, "foo"), "w").write("x" * 42)
+    os.link(os.path.join(root, "a", "b", "c", "baz"), os.path.join(other, "baz"))
+
+    return root, other
+
+
+def test_disk_usage_same_as_du(tmpdir, trees):
+    root, other = trees
+    nonexistent = str(tmpdir.join("nonexistent"))
+    # e.g. an app data dir moved to another disk
+    symlink = str(tmpdir.join("symlink"))
+    os.symlink(other, symlink)
+
+    sizes = disk_usage([root, other, os.path.join(root, "foo"), nonexistent, symlink])
+
+    assert sizes[root] == du(root)
+    assert sizes[other] == du(other)
+    assert sizes[symlink] == du(symlink) == len(other)
+    assert sizes[os.path.join(root, "foo")] == 1000
+    assert sizes[nonexistent] == 0
+
+
+def test_scan_disk_usage_hardlinks_across_trees(trees):
+    root, other = trees
+
+    usages = scan_disk_usage([root, other])
+
+    # 'baz' is in both trees, du counts it only once
+    root_size, root_linked = usages[root]
+    other_size, other_linked = usages[other]
+    assert set(other_linked) <= set(root_linked)
+
+    linked = dict(root_linked)
+    linked.update(other_linked)
+    assert root_size + other_size + sum(linked.values()) == du(root, other)
+
+
+@pytest.mark.benchmark
+def test_disk_usage_benchmark(tmpdir):
+
+    # Like the paths listed in the CSV of a backup: many small dirs and
+    # files, and a few bigger trees
+    paths = []
+    for i in range(100):
+        path = str(tmpdir.join("conf%s" % i))
+        os.makedirs(path)
+        open(os.path.join(path, "foo.conf"), "w").write("x" * i)
+        paths.append(path)
+    for i in range(3):
+        for j in range(500):
+            path = str(tmpdir.join("data%s" % i, "dir%s" % (j % 50)))
+            if not os.path.isdir(path):
+                os.makedirs(path)
+            open(os.path.join(path, "file%s" % j), "w").write("x" * j)
+        paths.append(str(tmpdir.join("data%s" % i)))
+
+    start = time.time()
+    expected = {path: du(path) for path in paths}
+    du_duration = time.time() - start
+
+    start = time.time()
+    sizes = disk_usage(paths)
+    scan_duration = time.time() - start
+
+    print("")
+    print("Computing the size of %s paths:" % len(paths))
+    print(" - one 'du -sb' per path: %.3fs" % du_duration)
+    print(" - disk_usage: %.3fs" % scan_duration)
+
+    assert sizes == expected
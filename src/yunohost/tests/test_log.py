@@ -0,0 +1,175 @@
+import gzip
+import time
+import logging
+import threading
+
+import yaml
+import pytest
+
+from yunohost.log import DataRedactor, RedactingFormatter, log_display, _read_log_lines, \
+    _follow_log_lines
+
+
+def make_record(msg):
+    return logging.LogRecord("yunohost.test", logging.INFO, __file__, 0, msg, None, None)
+
+
+def test_redact_nothing():
+    redactor = DataRedactor([])
+    assert redactor.redact("db_pwd=foobar") == "db_pwd=foobar"
+
+
+def test_redact_ignore_empty_secret():
+    redactor = DataRedactor(["", "s3cr3t"])
+    assert redactor.redact("foo s3cr3t bar") == "foo ********** bar"
+
+
+def test_redact_secret_containing_another_one():
+    redactor = DataRedactor(["pass", "password123"])
+    assert redactor.redact("password123 pass") == "********** **********"
+
+
+def test_redact_special_chars():
+    redactor = DataRedactor(["a.b*c(d"])
+    assert redactor.redact("aXbbc(d a.b*c(d") == "aXbbc(d **********"
+
+
+def test_redact_secrets_added_later():
+    data_to_redact = ["first"]
+    redactor = DataRedactor(data_to_redact)
+    assert redactor.redact("first second") == "********** second"
+
+    # The list is shared with the OperationLogger which extends it over time
+    data_to_redact.append("second")
+    assert redactor.redact("first second") == "********** **********"
+
+
+def test_redacting_formatter_identify_secrets():
+    formatter = RedactingFormatter("%(message)s", [])
+    assert formatter.format(make_record("+ db_pwd=superpassword")) == "+ db_pwd=**********"
+    assert formatter.format(make_record("mysql -p superpassword")) == "mysql -p **********"
+
+
+def write_log(tmpdir, lines, ended=True, terminated=True):
+    log_path = str(tmpdir.join("20191019-120000-app_install-foo.log"))
+    md_path = str(tmpdir.join("20191019-120000-app_install-foo.yml"))
+    open(log_path, "w").write("\n".join(lines) + ("\n" if terminated else ""))
+    metadata = {"started_at": "2019-10-19 12:00:00"}
+    if ended:
+        metadata["ended_at"] = "2019-10-19 12:01:00"
+    open(md_path, "w").write(yaml.safe_dump(metadata))
+    return log_path, md_path
+
+
+def test_read_log_lines_pages(tmpdir):
+    log_path, _ = write_log(tmpdir, ["line %s" % i for i in range(120)])
+
+    offset, pages = 0, []
+    has_more = True
+    while has_more:
+        lines, offset, has_more = _read_log_lines(log_path, offset, number=50)
+        pages.append(lines)
+
+    assert [len(page) for page in pages] == [50, 50, 20]
+    assert sum(pages, []) == ["line %s" % i for i in range(120)]
+
+
+def test_read_log_lines_filters(tmpdir):
+    log_path, _ = write_log(tmpdir, ["+ set +x", "foo", "+ local app", "bar"])
+
+    lines, _, has_more = _read_log_lines(log_path, filters=[r"set [+-]x$", r"local \w+$"])
+    assert lines == ["foo", "bar"]
+    assert not has_more
+
+
+def test_read_log_lines_incomplete_last_line(tmpdir):
+    log_path, _ = write_log(tmpdir, ["foo", "ba"], terminated=False)
+
+    # The last line is still being written
+    lines, offset, has_more = _read_log_lines(log_path)
+    assert lines == ["foo"]
+    assert offset == 4
+    assert not has_more
+
+    open(log_path, "a").write("r\n")
+    assert _read_log_lines(log_path, offset) == (["bar"], offset + 4, False)
+
+    # ... unless the log is finished
+    log_path, _ = write_log(tmpdir, ["foo", "bar"], terminated=False)
+    lines, offset, has_more = _read_log_lines(log_path, finished=True)
+    assert lines == ["foo", "bar"]
+    assert offset == len("foo\nbar")
+    assert not has_more
+
+
+def test_read_log_lines_compressed(tmpdir):
+    log_path = str(tmpdir.join("foo.log.gz"))
+    f = gzip.open(log_path, "wb")
+    f.write("foo\nbar")
+    f.close()
+
+    assert _read_log_lines(log_path, number=1) == (["foo"], 4, True)
+    assert _read_log_lines(log_path, 4) == (["bar"], 7, False)
+
+
+def test_log_display_first_page(tmpdir):
+    log_path, _ = write_log(tmpdir, ["line %s" % i for i in range(120)] + ["last"], terminated=False)
+
+    infos = log_display(log_path, number=None)
+    assert infos["logs"] == ["line %s" % i for i in range(50)]
+    assert infos["has_more"]
+
+    infos = log_display(log_path, number=100, offset=infos["next_offset"])
+    assert infos["logs"] == ["line %s" % i for i in range(50, 120)] + ["last"]
+    assert not infos["has_more"]
+
+    # Tail mode
+    assert log_display(log_path, number=2)["logs"] == ["line 119", "last"]
+
+
+def test_follow_log_lines(tmpdir):
+    log_path, md_path = write_log(tmpdir, ["foo"], ended=False)
+
+    def write():
+        for i in range(3):
+            time.sleep(0.1)
+            open(log_path, "a").write("line %s\n" % i)
+        open(log_path, "a").write("the end")
+        open(md_path, "a").write("ended_at: 2019-10-19 12:01:00\n")
+
+    writer = threading.Thread(target=write)
+    writer.start()
+    try:
+        lines = list(_follow_log_lines(md_path, log_path, 0))
+    finally:
+        writer.join()
+
+    assert lines == ["foo", "line 0", "line 1", "line 2", "the end"]
+
+
+@pytest.mark.benchmark
+def test_redaction_benchmark_100k_lines_install_log():
+
+    secrets = ["secret%sabcdef" % i for i in range(50)]
+    lines = ["+ ynh_app_setting_set --app=foo --key=bar%s --value=secret%sabcdef" % (i, i % 200)
+             for i in range(100000)]
+
+    start = time.time()
+    naive = []
+    for line in lines:
+        for data in secrets:
+            line = line.replace(data, "**********")
+        naive.append(line)
+    naive_duration = time.time() - start
+
+    redactor = DataRedactor(secrets)
+    start = time.time()
+    redacted = [redactor.redact(log_line) for log_line in lines]
+    redactor_duration = time.time() - start
+
+    print("")
+    print("Redacting 100k lines with %s secrets:" % len(secrets))
+    print(" - one str.replace per secret: %.3fs" % naive_duration)
+    print(" - compiled alternation regex: %.3fs" % redactor_duration)
+
+    assert redacted == naive
@@ -0,0 +1,123 @@
+import time
+import threading
+import SocketServer
+
+import dns.message
+import dns.rcode
+import dns.rdatatype
+import dns.rrset
+import pytest
+
+import yunohost.utils.network
+from yunohost.utils.network import dig, dig_many
+
+# Records served by the stub DNS server, as {(qname, rdtype): (ttl, [values])}
+RECORDS = {
+    ("yolo.test.", "A"): (3600, ["1.2.3.4"]),
+    ("yolo.test.", "MX"): (3600, ["10 yolo.test."]),
+    ("yolo.test.", "TXT"): (3600, ['"v=spf1 a mx -all"']),
+    ("short.test.", "A"): (1, ["5.6.7.8"]),
+}
+
+# Names for which the stub DNS server takes a while to answer
+SLOW_NAMES = {"slow%s.test." % i for i in range(10)}
+SLOW_DELAY = 0.5
+
+
+class StubDNSHandler(SocketServer.BaseRequestHandler):
+
+    def handle(self):
+        data, sock = self.request
+        request = dns.message.from_wire(data)
+        question = request.question[0]
+        qname = question.name.to_text()
+        rdtype = dns.rdatatype.to_text(question.rdtype)
+        self.server.queries.append((qname, rdtype))
+
+        response = dns.message.make_response(request)
+        if qname in SLOW_NAMES:
+            time.sleep(SLOW_DELAY)
+            response.answer.append(dns.rrset.from_text(qname, 60, "IN", "A", "9.9.9.9"))
+        elif (qname, rdtype) in RECORDS:
+            ttl, values = RECORDS[(qname, rdtype)]
+            response.answer.append(dns.rrset.from_text_list(qname, ttl, "IN", rdtype, values))
+        elif not any(name == qname for name, _ in RECORDS):
+            response.set_rcode(dns.rcode.NXDOMAIN)
+
+        sock.sendto(response.to_wire(), self.client_address)
+
+
+@pytest.fixture
+def stub_dns_server(monkeypatch):
+    server = SocketServer.ThreadingUDPServer(("127.0.0.1", 0), StubDNSHandler)
+    server.daemon_threads = True
+    server.queries = []
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+
+    get_resolver = yunohost.utils.network._get_resolver
+
+    def _get_resolver(nameservers, timeout, edns_size):
+        resolver = get_resolver(nameservers, timeout, edns_size)
+        resolver.port = server.server_address[1]
+        return resolver
+
+    monkeypatch.setattr(yunohost.utils.network, "_get_resolver", _get_resolver)
+    monkeypatch.setattr(yunohost.utils.network, "resolvers_", {})
+
+    yield server
+
+    server.shutdown()
+    server.server_close()
+
+
+def test_dig(stub_dns_server):
+    assert dig("yolo.test", "A") == ("ok", ["1.2.3.4"])
+    assert dig("yolo.test.", "MX") == ("ok", ["10 yolo.test."])
+
+    status, (error, _) = dig("nope.test", "A")
+    assert status == "nok" and error == "NXDOMAIN"
+
+    status, (error, _) = dig("yolo.test", "AAAA")
+    assert status == "nok" and error == "NoAnswer"
+
+
+def test_dig_many_dedupes_queries(stub_dns_server):
+    queries = [("yolo.test", "A"), ("yolo.test.", "A"), ("yolo.test", "TXT"), ("yolo.test", "A")]
+    results = dig_many(queries)
+
+    assert results == {("yolo.test", "A"): ("ok", ["1.2.3.4"]),
+                       ("yolo.test.", "A"): ("ok", ["1.2.3.4"]),
+                       ("yolo.test", "TXT"): ("ok", ['"v=spf1 a mx -all"'])}
+    assert sorted(stub_dns_server.queries) == [("yolo.test.", "A"), ("yolo.test.", "TXT")]
+
+
+def test_dig_answers_reused_until_ttl_expires(stub_dns_server):
+    dig("yolo.test", "A")
+    dig("short.test", "A")
+    dig("yolo.test", "A")
+    dig("short.test", "A")
+    assert len(stub_dns_server.queries) == 2
+
+    time.sleep(1.1)
+    dig("yolo.test", "A")
+    dig("short.test", "A")
+    assert stub_dns_server.queries[-1] == ("short.test.", "A")
+    assert len(stub_dns_server.queries) == 3
+
+
+def test_dig_many_concurrent(stub_dns_server):
+    start = time.time()
+    results = dig_many([(name, "A") for name in SLOW_NAMES])
+    duration = time.time() - start
+
+    assert all(result == ("ok", ["9.9.9.9"]) for result in results.values())
+    assert duration < len(SLOW_NAMES) * SLOW_DELAY / 2
+
+
+def test_dig_timeout(stub_dns_server):
+    start = time.time()
+    status, (error, _) = dig("slow0.test", "A", timeout=0.2)
+    assert status == "nok" and error == "Timeout"
+    assert time.time() - start < SLOW_DELAY
@@ -0,0 +1,314 @@
+import os
+import sys
+import time
+import types
+import hashlib
+
+import yunohost.regenconf
+from yunohost.regenconf import _calculate_hash, _file_matches_hash, _check_hash_cache, \
+    _save_hash_cache, _get_hash_cache, _get_inputs_fingerprints, _is_up_to_date, \
+    _get_regenconf_infos, _save_regenconf_infos, _update_conf_hashes, RegenConfSnapshot, \
+    _restore_regen_conf_snapshot, _recover_interrupted_regen_conf, _parse_dpkg_conffiles, \
+    manually_modified_files_compared_to_debian_default
+
+import pytest
+
+
+@pytest.fixture(autouse=True)
+def hash_cache(tmpdir, monkeypatch):
+    monkeypatch.setattr(yunohost.regenconf, "HASH_CACHE_FILE", str(tmpdir.join("cache", "hashes.json")))
+    monkeypatch.setattr(yunohost.regenconf, "hash_cache_", None)
+    monkeypatch.setattr(yunohost.regenconf, "hash_cache_dirty_", False)
+
+
+def settled_file(tmpdir, name, content):
+    path = str(tmpdir.join(name))
+    open(path, "w").write(content)
+    # Pretend the file was last modified a while ago
+    os.utime(path, (time.time() - 60, time.time() - 60))
+    return path
+
+
+def count_reads(monkeypatch):
+    reads = []
+    hash_file = yunohost.regenconf._hash_file
+
+    def _hash_file(path, algorithm):
+        reads.append(path)
+        return hash_file(path, algorithm)
+
+    monkeypatch.setattr(yunohost.regenconf, "_hash_file", _hash_file)
+    return reads
+
+
+def test_hash_unchanged_file_read_once(tmpdir, monkeypatch):
+    path = settled_file(tmpdir, "foo.conf", "foo")
+    reads = count_reads(monkeypatch)
+
+    assert _calculate_hash(path) == _calculate_hash(path)
+    assert reads == [path]
+
+
+def test_hash_changed_file_read_again(tmpdir, monkeypatch):
+    path = settled_file(tmpdir, "foo.conf", "foo")
+    reads = count_reads(monkeypatch)
+    hash_ = _calculate_hash(path)
+
+    open(path, "w").write("bar")
+    assert _calculate_hash(path) != hash_
+    assert len(reads) == 2
+
+
+def test_hash_recently_modified_file_not_cached(tmpdir, monkeypatch):
+    path = str(tmpdir.join("foo.conf"))
+    open(path, "w").write("foo")
+    reads = count_reads(monkeypatch)
+
+    _calculate_hash(path)
+    _calculate_hash(path)
+    assert len(reads) == 2
+
+
+def test_hash_missing_file(tmpdir):
+    assert _calculate_hash(str(tmpdir.join("nope.conf"))) is None
+
+
+def test_hash_legacy_md5(tmpdir):
+    path = settled_file(tmpdir, "foo.conf", "foo")
+
+    assert _calculate_hash(path, "md5") == "acbd18db4cc2f85cedef654fccc4a4d8"
+    assert _file_matches_hash(path, "acbd18db4cc2f85cedef654fccc4a4d8")
+    assert not _file_matches_hash(path, "37b51d194a7513e45b56f6524f2d51f2")
+
+
+def test_hash_algorithm_unavailable(tmpdir, monkeypatch):
+    path = settled_file(tmpdir, "foo.conf", "foo")
+    monkeypatch.setattr(yunohost.regenconf, "xxhash", None)
+
+    assert _calculate_hash(path, "xxh64") is None
+    assert not _file_matches_hash(path, "xxh64:33bf00a859c4ba3f")
+
+
+def test_hash_cache_persisted(tmpdir, monkeypatch):
+    path = settled_file(tmpdir, "foo.conf", "foo")
+    hash_ = _calculate_hash(path)
+    _save_hash_cache()
+
+    monkeypatch.setattr(yunohost.regenconf, "hash_cache_", None)
+    reads = count_reads(monkeypatch)
+
+    assert _calculate_hash(path) == hash_
+    assert reads == []
+
+
+def test_hash_cache_consistency_check(tmpdir):
+    path = settled_file(tmpdir, "foo.conf", "foo")
+    other = settled_file(tmpdir, "bar.conf", "bar")
+    _calculate_hash(path)
+    _calculate_hash(other)
+
+    # Modify the file behind the cache's back, keeping the same stat
+    stat = os.stat(path)
+    open(path, "w").write("oof")
+    os.utime(path, (stat.st_atime, stat.st_mtime))
+    signature = yunohost.regenconf._stat_signature(os.stat(path))
+    _get_hash_cache()[path][0] = signature
+
+    assert _check_hash_cache() == [path]
+    assert path not in _get_hash_cache()
+    assert other in _get_hash_cache()
+    assert _file_matches_hash(path, _calculate_hash(path, cache=False))
+
+
+@pytest.fixture
+def regenconf_inputs(tmpdir, monkeypatch):
+    templates = tmpdir.mkdir("templates")
+    templates.mkdir("nginx").join("server.tpl.conf").write("server {}")
+    hook = tmpdir.join("15-nginx")
+    hook.write("#!/bin/bash")
+    inputs = tmpdir.join("regenconf_inputs.yml")
+    inputs.write("nginx:\n    templates: [nginx]\n    domains: true\n")
+
+    monkeypatch.setattr(yunohost.regenconf, "TEMPLATES_DIR", str(templates))
+    monkeypatch.setattr(yunohost.regenconf, "REGEN_CONF_INPUTS_FILE", str(inputs))
+    monkeypatch.setattr(yunohost.regenconf, "REGEN_CONF_FILE", str(tmpdir.join("regenconf.yml")))
+    monkeypatch.setattr(yunohost.regenconf, "hook_list", lambda *a, **k: {
+        "hooks": {"nginx": [{"path": str(hook)}], "postfix": [{"path": "/foo/19-postfix"}]}})
+    domain = types.ModuleType("yunohost.domain")
+    domain._get_maindomain = lambda: "example.org"
+    monkeypatch.setitem(sys.modules, "yunohost.domain", domain)
+
+    return templates
+
+
+def test_inputs_fingerprint(regenconf_inputs):
+    fingerprints = _get_inputs_fingerprints(["nginx", "postfix"], ["example.org"])
+
+    # Categories which don't declare their inputs are always regenerated
+    assert list(fingerprints.keys()) == ["nginx"]
+    assert fingerprints == _get_inputs_fingerprints(["nginx"], ["example.org"])
+    assert fingerprints != _get_inputs_fingerprints(["nginx"], ["example.org", "example.com"])
+
+    regenconf_inputs.join("nginx", "server.tpl.conf").write("server { listen 80; }")
+    assert fingerprints != _get_inputs_fingerprints(["nginx"], ["example.org"])
+
+
+def test_up_to_date_until_conf_modified(regenconf_inputs, tmpdir):
+    conf = settled_file(tmpdir, "example.org.conf", "server {}")
+    fingerprint = _get_inputs_fingerprints(["nginx"], ["example.org"])["nginx"]
+
+    assert not _is_up_to_date(None, fingerprint)
+
+    infos = {"conffiles": {conf: _calculate_hash(conf), str(tmpdir.join("removed.conf")): None},
+             "inputs_fingerprint": fingerprint}
+    assert _is_up_to_date(infos, fingerprint)
+    assert not _is_up_to_date(infos, "another fingerprint")
+
+    # Manual modifications still have to be reported by regen-conf
+    open(conf, "w").write("server { listen 80; }")
+    assert not _is_up_to_date(infos, fingerprint)
+
+
+@pytest.fixture
+def regenconf_state(tmpdir, monkeypatch):
+    monkeypatch.setattr(yunohost.regenconf, "REGEN_CONF_FILE", str(tmpdir.join("regenconf.yml")))
+    monkeypatch.setattr(yunohost.regenconf, "BACKUP_CONF_DIR", str(tmpdir.join("backup")))
+
+    etc = tmpdir.mkdir("etc")
+    updated = settled_file(etc, "updated.conf", "old")
+    created = str(etc.join("created.conf"))
+    removed = settled_file(etc, "removed.conf", "removed")
+
+    _update_conf_hashes("foo", {updated: _calculate_hash(updated), removed: _calculate_hash(removed)})
+    infos = _get_regenconf_infos()
+
+    # A run replacing, creating and removing a conf file
+    snapshot = RegenConfSnapshot("20191019-120000-regen_conf-foo")
+    for path in [updated, created, removed]:
+        snapshot.backup("foo", path)
+    open(updated, "w").write("new")
+    open(created, "w").write("new")
+    os.remove(removed)
+    infos["foo"]["conffiles"] = {updated: _calculate_hash(updated), created: _calculate_hash(created),
+                                 removed: None}
+
+    return snapshot, infos, (updated, created, removed)
+
+
+def test_regenconf_snapshot_rollback(regenconf_state):
+    snapshot, infos, (updated, created, removed) = regenconf_state
+    saved_hashes = _get_regenconf_infos()["foo"]["conffiles"]
+    _save_regenconf_infos(infos)
+    snapshot.commit()
+
+    restored = _restore_regen_conf_snapshot(RegenConfSnapshot.load(snapshot.run))
+
+    assert sorted(restored["foo"]) == sorted([updated, created, removed])
+    assert open(updated).read() == "old"
+    assert not os.path.exists(created)
+    assert open(removed).read() == "removed"
+    assert _get_regenconf_infos()["foo"]["conffiles"] == saved_hashes
+
+
+def test_regenconf_recover_interrupted_run(regenconf_state):
+    snapshot, infos, (updated, created, removed) = regenconf_state
+
+    # The run got interrupted before committing the new hashes
+    _recover_interrupted_regen_conf()
+
+    assert open(updated).read() == "old"
+    assert not os.path.exists(created)
+    for path, hash_ in _get_regenconf_infos()["foo"]["conffiles"].items():
+        assert _file_matches_hash(path, hash_)
+
+    # Only once
+    open(updated, "w").write("new")
+    _recover_interrupted_regen_conf()
+    assert open(updated).read() == "new"
+
+
+def test_regenconf_old_snapshots_removed(regenconf_state, monkeypatch):
+    snapshot, infos, (updated, created, removed) = regenconf_state
+    snapshot.commit()
+    monkeypatch.setattr(yunohost.regenconf, "REGEN_CONF_SNAPSHOTS_KEEP", 2)
+
+    for i in range(3):
+        other = RegenConfSnapshot("20191019-12000%s-regen_conf-bar" % i)
+        other.backup("bar", updated)
+        other.commit()
+
+    _recover_interrupted_regen_conf()
+
+    assert sorted(os.listdir(yunohost.regenconf.BACKUP_CONF_DIR)) == \
+        ["20191019-120001-regen_conf-bar", "20191019-120002-regen_conf-bar"]
+
+
+def md5(content):
+    return hashlib.md5(content).hexdigest()
+
+
+@pytest.fixture
+def dpkg_status(tmpdir, monkeypatch):
+    foo = settled_file(tmpdir, "foo.conf", "foo")
+    bar = settled_file(tmpdir, "bar.conf", "bar")
+    status = str(tmpdir.join("status"))
+    open(status, "w").write("\n".join([
+        "Package: foo",
+        "Status: install ok installed",
+        "Conffiles:",
+        " %s %s" % (foo, md5("foo")),
+        " %s %s obsolete" % (bar, md5("bar")),
+        " /etc/foo/new.conf newconffile",
+        "Description: Foo",
+        " Foo is not a conffile",
+        "",
+        "Package: baz",
+        "Status: install ok installed",
+        "Conffiles:",
+        " /etc/baz.conf %s" % md5("baz"),
+        "",
+    ]))
+
+    monkeypatch.setattr(yunohost.regenconf, "DPKG_STATUS_FILE", status)
+    monkeypatch.setattr(yunohost.regenconf, "dpkg_conffiles_", None)
+    return status, foo, bar
+
+
+def test_parse_dpkg_conffiles(dpkg_status):
+    status, foo, bar = dpkg_status
+
+    assert _parse_dpkg_conffiles(status) == [(foo, md5("foo")), (bar, md5("bar")),
+                                             ("/etc/baz.conf", md5("baz"))]
+
+
+def test_debian_modified_files(dpkg_status, monkeypatch):
+    status, foo, bar = dpkg_status
+    reads = count_reads(monkeypatch)
+
+    # Missing conffiles are reported as modified, as 'md5sum -c' did
+    assert manually_modified_files_compared_to_debian_default() == ["/etc/baz.conf"]
+    assert sorted(reads) == sorted([foo, bar])
+
+    open(bar, "w").write("modified")
+    assert manually_modified_files_compared_to_debian_default() == [bar, "/etc/baz.conf"]
+    assert sorted(reads) == sorted([foo, bar, bar])
+
+
+def test_dpkg_status_parsed_again_when_changed(dpkg_status, monkeypatch):
+    status, foo, bar = dpkg_status
+    parsed = []
+    parse = yunohost.regenconf._parse_dpkg_conffiles
+
+    def _parse_dpkg_conffiles(status_file):
+        parsed.append(status_file)
+        return parse(status_file)
+
+    monkeypatch.setattr(yunohost.regenconf, "_parse_dpkg_conffiles", _parse_dpkg_conffiles)
+
+    manually_modified_files_compared_to_debian_default()
+    manually_modified_files_compared_to_debian_default()
+    assert len(parsed) == 1
+
+    open(status, "a").write("Package: qux\nStatus: install ok installed\n")
+    manually_modified_files_compared_to_debian_default()
+    assert len(parsed) == 2
@@ -0,0 +1,23 @@
+from yunohost.utils.resources import _get_app_services, _query_databases_size, human_size
+
+
+def test_app_services():
+    services = ["nginx", "nextcloud", "nextcloud-notify_push", "nextcloud__2", "synapse",
+                "synapse-coturn", "synapse_foo", "synapsefoo"]
+
+    assert _get_app_services("nextcloud", services) == ["nextcloud", "nextcloud-notify_push"]
+    assert _get_app_services("nextcloud__2", services) == ["nextcloud__2"]
+    assert _get_app_services("synapse", services) == ["synapse", "synapse-coturn", "synapse_foo"]
+
+
+def test_query_databases_size():
+    output = "mysql\t2424832\nnextcloud\t104857600\ninformation_schema\tNULL\n"
+
+    assert _query_databases_size(["printf", output]) == {"mysql": 2424832, "nextcloud": 104857600}
+    assert _query_databases_size(["/nonexistent"]) == {}
+
+
+def test_human_size():
+    assert human_size(512) == "512 B"
+    assert human_size(9.45 * 1024) == "9.4 kiB"
+    assert human_size(22.124 * 1024**2) == "22 MiB"
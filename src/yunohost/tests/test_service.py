@@ -0,0 +1,391 @@
+import os
+import sys
+import gzip
+import time
+import types
+import shutil
+import pytest
+
+from datetime import datetime, timedelta
+
+import yunohost.service
+from yunohost.service import ServiceStatusCache, _unit_name_from_path, _tail, _read_journal, _parse_journal_date, \
+    _get_services, _save_services, _get_service_registry, _get_test_fingerprint
+from yunohost.utils.error import YunohostError
+
+
+class FakeSignalSource(object):
+
+    """
+    Stand-in for SystemdSignalSource, emitting synthetic systemd signals
+    """
+
+    def __init__(self):
+        self.pending = []
+
+    def subscribe(self, on_properties_changed, on_reset):
+        self.on_properties_changed = on_properties_changed
+        self.on_reset = on_reset
+
+    def emit_properties_changed(self, service, changed_properties):
+        self.pending.append(lambda: self.on_properties_changed(service, changed_properties))
+
+    def emit_reset(self):
+        self.pending.append(lambda: self.on_reset())
+
+    def process_pending(self):
+        pending, self.pending = self.pending, []
+        for signal in pending:
+            signal()
+
+
+systemd_queries = []
+test_commands_ran = []
+
+
+def fake_get_services_information_from_systemd(services):
+    systemd_queries.append(sorted(services))
+    return {s: {"SubState": "running", "UnitFileState": "enabled", "Description": s}
+            for s in services if s != "unknown"}
+
+
+def fake_run_test_commands(commands):
+    test_commands_ran.extend(sorted(commands.keys()))
+    return {key: (0, "") for key in commands.keys()}
+
+
+@pytest.fixture
+def cache(monkeypatch):
+    del systemd_queries[:]
+    del test_commands_ran[:]
+    monkeypatch.setattr(yunohost.service, "_get_services_information_from_systemd",
+                        fake_get_services_information_from_systemd)
+    monkeypatch.setattr(yunohost.service, "_run_test_commands", fake_run_test_commands)
+    return ServiceStatusCache(FakeSignalSource())
+
+
+def test_unit_name_from_path():
+    assert _unit_name_from_path("/org/freedesktop/systemd1/unit/nginx_2eservice") == "nginx.service"
+    assert _unit_name_from_path("/org/freedesktop/systemd1/unit/postfix_40_2d_2eservice") == "postfix@-.service"
+
+
+def test_status_cache_only_queries_systemd_once(cache):
+    cache.get_services_information(["nginx", "ssh"])
+    infos = cache.get_services_information(["nginx", "ssh"])
+
+    assert infos["nginx"]["SubState"] == "running"
+    assert systemd_queries == [["nginx", "ssh"]]
+
+
+def test_status_cache_unknown_service(cache):
+    assert cache.get_services_information(["unknown"]) == {}
+    assert cache.get_services_information(["unknown"]) == {}
+    assert systemd_queries == [["unknown"]]
+
+
+def test_status_cache_updated_from_signal(cache):
+    cache.get_services_information(["nginx"])
+    cache.signal_source.emit_properties_changed("nginx", {"SubState": "dead", "ActiveState": "inactive"})
+
+    infos = cache.get_services_information(["nginx"])
+
+    assert infos["nginx"]["SubState"] == "dead"
+    # Properties we didn't fetch in the first place are not added
+    assert "ActiveState" not in infos["nginx"]
+    assert systemd_queries == [["nginx"]]
+
+
+def test_status_cache_invalidated_from_signal(cache):
+    cache.get_services_information(["nginx", "ssh"])
+    cache.signal_source.emit_properties_changed("nginx", None)
+
+    cache.get_services_information(["nginx", "ssh"])
+
+    assert systemd_queries == [["nginx", "ssh"], ["nginx"]]
+
+
+def test_status_cache_reset(cache):
+    cache.get_services_information(["nginx"])
+    cache.signal_source.emit_reset()
+
+    cache.get_services_information(["nginx"])
+
+    assert systemd_queries == [["nginx"], ["nginx"]]
+
+
+def test_status_cache_test_conf_until_conf_changes(cache, monkeypatch):
+    fingerprint = ["v1"]
+    monkeypatch.setattr(yunohost.service, "_get_test_fingerprint", lambda name, test, regenconf_infos: fingerprint[0])
+
+    commands = {("nginx", "test_conf"): "nginx -t"}
+    cache.get_test_results(commands)
+    cache.get_test_results(commands)
+    assert test_commands_ran == [("nginx", "test_conf")]
+
+    fingerprint[0] = "v2"
+    cache.get_test_results(commands)
+    assert test_commands_ran == [("nginx", "test_conf"), ("nginx", "test_conf")]
+
+
+def test_status_cache_test_status_expires(cache, monkeypatch):
+    monkeypatch.setattr(yunohost.service, "_get_test_fingerprint", lambda name, test, regenconf_infos: None)
+    monkeypatch.setattr(yunohost.service, "TEST_RESULT_CACHE_DURATION", -1)
+
+    commands = {("yunohost-firewall", "test_status"): "iptables -S"}
+    cache.get_test_results(commands)
+    cache.get_test_results(commands)
+
+    assert len(test_commands_ran) == 2
+
+
+def test_test_conf_fingerprint(tmpdir, monkeypatch):
+    conf_dir = tmpdir.mkdir("conf.d")
+    conf_dir.join("yunohost_admin.conf").write("foo")
+    conf_dir.join("domain.tld.conf").write("bar")
+    conffiles = {str(conf_dir.join("yunohost_admin.conf")): "xxh64:f00"}
+    monkeypatch.setattr("yunohost.regenconf._get_regenconf_infos",
+                        lambda: {"nginx": {"conffiles": conffiles}})
+
+    assert _get_test_fingerprint("nginx", "test_status") is None
+    assert _get_test_fingerprint("ssh", "test_conf") is None
+
+    fingerprints = [_get_test_fingerprint("nginx", "test_conf")]
+
+    # App confs, included from the domain's conf
+    app_conf = conf_dir.mkdir("domain.tld.d").join("app.conf")
+    fingerprints.append(_get_test_fingerprint("nginx", "test_conf"))
+    app_conf.write("location /app {")
+    fingerprints.append(_get_test_fingerprint("nginx", "test_conf"))
+    app_conf.write("location /app { }")
+    fingerprints.append(_get_test_fingerprint("nginx", "test_conf"))
+    app_conf.remove()
+    fingerprints.append(_get_test_fingerprint("nginx", "test_conf"))
+
+    assert len(set(fingerprints)) == len(fingerprints)
+    assert _get_test_fingerprint("nginx", "test_conf") == fingerprints[-1]
+
+
+def test_status_cache_test_conf_loads_regenconf_once(cache, monkeypatch):
+    loads = []
+
+    def _get_regenconf_infos():
+        loads.append(None)
+        return {"nginx": {"conffiles": {"/etc/nginx/nginx.conf": "xxh64:f00"}},
+                "ssh": {"conffiles": {"/etc/ssh/sshd_config": "xxh64:ba7"}}}
+
+    monkeypatch.setattr("yunohost.regenconf._get_regenconf_infos", _get_regenconf_infos)
+
+    commands = {("nginx", "test_conf"): "nginx -t",
+                ("ssh", "test_conf"): "sshd -t",
+                ("nginx", "test_status"): "true"}
+    cache.get_test_results(commands)
+    cache.get_test_results(commands)
+
+    assert len(loads) == 2
+
+
+def write_gzip(path, content):
+    f = gzip.open(path, "wb")
+    f.write(content)
+    f.close()
+
+
+def test_tail(tmpdir):
+    log = str(tmpdir.join("foo.log"))
+    open(log, "w").write("".join("line %s\n" % i for i in range(100)))
+
+    assert _tail(log, 3) == ["line 97", "line 98", "line 99"]
+    assert _tail(log, 3, filters=[r"line 9[89]"]) == ["line 95", "line 96", "line 97"]
+
+
+def test_tail_no_trailing_newline(tmpdir):
+    log = str(tmpdir.join("foo.log"))
+    open(log, "w").write("\nfoo\nbar")
+
+    assert _tail(log, 10) == ["", "foo", "bar"]
+
+
+def test_tail_gzip(tmpdir, monkeypatch):
+    # Make sure we have a few checkpoints in the seek index
+    monkeypatch.setattr(yunohost.service, "GZIP_INDEX_BLOCK_SIZE", 1000)
+    lines = ["line %s %s" % (i, os.urandom(50).encode("hex")) for i in range(10000)]
+    log = str(tmpdir.join("foo.log.gz"))
+    write_gzip(log, "\n".join(lines) + "\n")
+
+    assert _tail(log, 5) == lines[-5:]
+    assert _tail(log, 20000) == lines
+
+
+def test_tail_across_rotations(tmpdir):
+    log = str(tmpdir.join("mail.log"))
+    open(log, "w").write("current 1\ncurrent 2\n")
+    open(log + ".1", "w").write("rotated 1\nrotated 2\n")
+    write_gzip(log + ".2.gz", "compressed 1\ncompressed 2\n")
+
+    assert _tail(log, 5) == ["compressed 2", "rotated 1", "rotated 2", "current 1", "current 2"]
+    assert _tail(log, 5, filters=[r" 1$"]) == ["compressed 2", "rotated 2", "current 2"]
+
+
+class FakeJournalReader(object):
+
+    """
+    Stand-in for systemd.journal.Reader, over a list of entries of one unit
+    """
+
+    def __init__(self, entries):
+        self.entries = entries
+        self.position = len(entries)
+
+    def add_match(self, **kwargs):
+        pass
+
+    def add_disjunction(self):
+        pass
+
+    def add_conjunction(self):
+        pass
+
+    def log_level(self, level):
+        self.entries = [e for e in self.entries if e["PRIORITY"] <= level]
+        self.position = len(self.entries)
+
+    def seek_tail(self):
+        self.position = len(self.entries)
+
+    def seek_realtime(self, date):
+        self.position = len([e for e in self.entries if e["__REALTIME_TIMESTAMP"] <= date])
+
+    def seek_cursor(self, cursor):
+        self.position = [e["__CURSOR"] for e in self.entries].index(cursor)
+
+    def get_previous(self):
+        self.position -= 1
+        return self.entries[self.position] if self.position >= 0 else {}
+
+    def get_next(self):
+        if self.position >= len(self.entries):
+            return {}
+        self.position += 1
+        return self.entries[self.position - 1]
+
+    def close(self):
+        pass
+
+
+@pytest.fixture
+def journal(monkeypatch):
+    start = datetime(2019, 1, 1)
+    entries = [{"__CURSOR": "c%s" % i,
+                "__REALTIME_TIMESTAMP": start + timedelta(minutes=i),
+                "PRIORITY": 3 if i % 10 == 0 else 6,
+                "SYSLOG_IDENTIFIER": "nginx",
+                "_PID": "42",
+                "_HOSTNAME": "yunohost",
+                "MESSAGE": "message %s" % i} for i in range(100)]
+
+    module = types.ModuleType("systemd.journal")
+    module.Reader = lambda: FakeJournalReader(list(entries))
+    monkeypatch.setitem(sys.modules, "systemd", types.ModuleType("systemd"))
+    monkeypatch.setitem(sys.modules, "systemd.journal", module)
+    sys.modules["systemd"].journal = module
+
+
+def test_read_journal_last_entries(journal):
+    lines, cursors = _read_journal("nginx", 3)
+
+    assert lines == ["Jan 01 01:37:00 yunohost nginx[42]: message 97",
+                     "Jan 01 01:38:00 yunohost nginx[42]: message 98",
+                     "Jan 01 01:39:00 yunohost nginx[42]: message 99"]
+    assert cursors == {"previous": "c97", "next": "c99"}
+
+
+def test_read_journal_pages(journal):
+    _, cursors = _read_journal("nginx", 3)
+
+    lines, cursors = _read_journal("nginx", 3, before=cursors["previous"])
+    assert [l.split()[-1] for l in lines] == ["94", "95", "96"]
+
+    lines, cursors = _read_journal("nginx", 3, after=cursors["next"])
+    assert [l.split()[-1] for l in lines] == ["97", "98", "99"]
+
+    lines, cursors = _read_journal("nginx", 3, after=cursors["next"])
+    assert lines == [] and cursors["next"] == "c99"
+
+
+def test_read_journal_filters(journal):
+    lines, _ = _read_journal("nginx", 50,
+                             since=_parse_journal_date("2019-01-01 00:15"),
+                             until=_parse_journal_date("2019-01-01 00:45:00"),
+                             priority=3)
+    assert [l.split()[-1] for l in lines] == ["20", "30", "40"]
+
+
+def test_parse_journal_date_invalid():
+    with pytest.raises(YunohostError):
+        _parse_journal_date("yesterday")
+
+
+@pytest.fixture
+def services_conf(tmpdir, monkeypatch):
+    services_conf = str(tmpdir.join("services.yml"))
+    sshd_config = str(tmpdir.join("sshd_config"))
+    template = os.path.join(os.path.dirname(__file__), "../../../data/templates/yunohost/services.yml")
+    shutil.copy(template, services_conf)
+    open(sshd_config, "w").write("Port 22\n")
+
+    monkeypatch.setattr(yunohost.service, "SERVICES_CONF", services_conf)
+    monkeypatch.setattr(yunohost.service, "SSHD_CONFIG", sshd_config)
+    monkeypatch.setattr(yunohost.service, "service_registry_", None)
+
+    return services_conf, sshd_config
+
+
+def test_services_registry_snapshot_is_not_altered(services_conf):
+    services = _get_services()
+    services["nginx"]["log"] = "/foo.log"
+    del services["ssh"]
+
+    services = _get_services()
+    assert services["nginx"]["log"] != "/foo.log"
+    assert "ssh" in services
+
+
+def test_services_registry_invalidation(services_conf):
+    _, sshd_config = services_conf
+
+    assert _get_services()["ssh"]["needs_exposed_ports"] == [22]
+    open(sshd_config, "w").write("Port 2222\n")
+    assert _get_services()["ssh"]["needs_exposed_ports"] == [2222]
+
+    services = _get_services()
+    services["foo"] = {"description": "Foo"}
+    _save_services(services)
+    assert _get_services()["foo"] == {"description": "Foo"}
+
+
+@pytest.mark.benchmark
+def test_services_registry_benchmark(services_conf):
+
+    def bench(f, n=200):
+        start = time.time()
+        for _ in range(n):
+            f()
+        return (time.time() - start) / n * 1000
+
+    registry = _get_service_registry()
+
+    def uncached():
+        registry.invalidate()
+        return _get_services()
+
+    uncached_duration = bench(uncached)
+    cached_duration = bench(_get_services)
+    journalctl_duration = bench(lambda: _get_services().get("nginx", {}).get("actual_systemd_service", "nginx"))
+
+    print("")
+    print("_get_services() with %s:" % yunohost.service.SafeLoader.__name__)
+    print(" - parsing services.yml and sshd_config: %.3fms" % uncached_duration)
+    print(" - from the registry: %.3fms" % cached_duration)
+    print(" - systemd unit lookup (service_log, _get_journalctl_logs): %.3fms" % journalctl_duration)
+
+    assert cached_duration < uncached_duration
@@ -35,7 +35,8 @@ from importlib import import_module
 from moulinette import msignals, m18n
 from moulinette.utils.log import getActionLogger
 from moulinette.utils.process import check_output, call_async_output
-from moulinette.utils.filesystem import read_json, write_to_json, read_yaml, write_to_yaml
+from moulinette.utils.filesystem import read_json, write_to_json, write_to_yaml
+from yunohost.utils.filesystem import read_yaml, SafeLoader
 
 from yunohost.app import _update_apps_catalog, app_info, app_upgrade, app_ssowatconf, app_list, _initialize_apps_catalog_system
 from yunohost.domain import domain_add, domain_list
@@ -64,7 +65,7 @@ def tools_ldapinit():
     """
 
     with open('/usr/share/yunohost/yunohost-config/moulinette/ldap_scheme.yml') as f:
-        ldap_map = yaml.load(f)
+        ldap_map = yaml.load(f, Loader=SafeLoader)
 
     from yunohost.utils.ldap import _get_ldap_interface
     ldap = _get_ldap_interface()
@@ -393,8 +394,8 @@ def tools_postinstall(operation_logger, domain, password, ignore_dyndns=False,
 
 
 def tools_regen_conf(names=[], with_diff=False, force=False, dry_run=False,
-                     list_pending=False):
-    return regen_conf(names, with_diff, force, dry_run, list_pending)
+                     list_pending=False, rollback=None):
+    return regen_conf(names, with_diff, force, dry_run, list_pending, rollback=rollback)
 
 
 def tools_update(apps=False, system=False):
@@ -36,7 +36,8 @@ import copy
 
 from moulinette import m18n
 from moulinette.utils.log import getActionLogger
-from moulinette.utils.filesystem import read_json, write_to_json, read_yaml, write_to_yaml
+from moulinette.utils.filesystem import read_json, write_to_json, write_to_yaml
+from yunohost.utils.filesystem import read_yaml
 
 from yunohost.utils.error import YunohostError
 from yunohost.service import service_status
@@ -0,0 +1,525 @@
+# -*- coding: utf-8 -*-
+
+""" License
+
+    Copyright (C) 2020 YUNOHOST.ORG
+
+    This program is free software; you can redistribute it and/or modify
+    it under the terms of the GNU Affero General Public License as published
+    by the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU Affero General Public License for more details.
+
+    You should have received a copy of the GNU Affero General Public License
+    along with this program; if not, see http://www.gnu.org/licenses
+
+"""
+import os
+import copy
+import bisect
+import tarfile
+import tempfile
+import subprocess
+import multiprocessing
+from collections import OrderedDict
+from distutils.spawn import find_executable
+
+# Tar archives are compressed by piping them to an external compressor, which
+# uses all the cores of the machine (pigz, zstd -T0) and in any case runs
+# alongside the python process building the archive
+COMPRESSIONS = OrderedDict([
+    ("gz", {"extension": ".tar.gz", "magic": "\x1f\x8b",
+            "levels": (1, 9), "default_level": 6}),
+    ("zstd", {"extension": ".tar.zst", "magic": "\x28\xb5\x2f\xfd",
+              "levels": (1, 19), "default_level": 3}),
+    ("none", {"extension": ".tar", "magic": None,
+              "levels": None, "default_level": None}),
+])
+
+# Size of the chunks written to / read from the compressor
+STREAM_BUFFER_SIZE = 1024 * 1024
+
+# Archives are written in blocks which can be decompressed independently
+# (c.f. IndexedTarFile): a new block is started for each path added to the
+# archive if the current one is bigger than BLOCK_MIN_SIZE, and in any case
+# when it reaches BLOCK_MAX_SIZE (uncompressed)
+BLOCK_MIN_SIZE = 4 * 1024 * 1024
+BLOCK_MAX_SIZE = 64 * 1024 * 1024
+
+
+def archive_extensions():
+    return [c["extension"] for c in COMPRESSIONS.values()]
+
+
+def split_archive_extension(filename):
+    """
+    Split an archive filename into its name and extension, e.g.
+    'foo.tar.gz' -> ('foo', '.tar.gz'). Returns (filename, None) if it is not
+    an archive
+    """
+
+    # Longest extensions first, '.tar' being a suffix of none of the others
+    for extension in sorted(archive_extensions(), key=len, reverse=True):
+        if filename.endswith(extension):
+            return filename[:-len(extension)], extension
+    return filename, None
+
+
+def detect_compression(path):
+    """Guess the compression of an archive from its first bytes"""
+
+    with open(path, "rb") as f:
+        head = f.read(4)
+
+    for compression, infos in COMPRESSIONS.items():
+        if infos["magic"] and head.startswith(infos["magic"]):
+            return compression
+    return "none"
+
+
+def _compressor_command(compression, level=None):
+
+    if compression == "gz":
+        level = level or COMPRESSIONS["gz"]["default_level"]
+        if find_executable("pigz"):
+            return ["pigz", "-p", str(multiprocessing.cpu_count()), "-%d" % level, "-c"]
+        return ["gzip", "-%d" % level, "-c"]
+    elif compression == "zstd":
+        level = level or COMPRESSIONS["zstd"]["default_level"]
+        return ["zstd", "-T0", "-%d" % level, "-q", "-c"]
+
+
+def _decompressor_command(compression):
+
+    if compression == "gz":
+        return ["pigz" if find_executable("pigz") else "gzip", "-d", "-c"]
+    elif compression == "zstd":
+        return ["zstd", "-d", "-q", "-c"]
+
+
+class _BlockWriter(object):
+
+    """
+    File-like object writing data to an archive as a sequence of blocks, each
+    block being compressed by its own compressor process. As concatenated
+    gzip members / zstd frames form a valid gzip / zstd stream, the archive
+    can still be decompressed as a whole, but each block can also be
+    decompressed on its own, starting from its offset in the file.
+    """
+
+    def __init__(self, path, compression, level=None):
+        self.name = path
+        self.command = _compressor_command(compression, level)
+        self.output = open(path, "wb")
+        self.process = None
+        self.stderr = None
+        self.position = 0
+        # (offset in the tar stream, offset in the archive file) of each block
+        self.blocks = [(0, 0)]
+
+    def tell(self):
+        return self.position
+
+    def block_size(self):
+        return self.position - self.blocks[-1][0]
+
+    def write(self, data):
+
+        if self.command is None:
+            self.output.write(data)
+        else:
+            if self.process is None:
+                self.stderr = tempfile.TemporaryFile()
+                self.process = subprocess.Popen(self.command, stdin=subprocess.PIPE,
+                                                stdout=self.output, stderr=self.stderr,
+                                                bufsize=-1)
+            self.process.stdin.write(data)
+        self.position += len(data)
+
+    def new_block(self):
+        """Start a new block, if the current one is not empty"""
+
+        if self.command is None or not self.block_size():
+            return
+
+        self._finish_block()
+        # The compressor processes write directly to the file, whose offset
+        # is shared with us
+        self.blocks.append((self.position, os.lseek(self.output.fileno(), 0, os.SEEK_CUR)))
+
+    def close(self):
+
+        try:
+            if self.process is not None:
+                self._finish_block()
+        finally:
+            self.output.close()
+
+    def _finish_block(self):
+
+        process, self.process = self.process, None
+        process.stdin.close()
+        returncode = process.wait()
+
+        self.stderr.seek(0)
+        error = self.stderr.read().strip()
+        self.stderr.close()
+
+        if returncode != 0:
+            raise IOError("'%s' failed with code %s: %s" % (" ".join(self.command), returncode, error))
+
+
+class IndexedTarFile(tarfile.TarFile):
+
+    """
+    Tar archive written in independently decompressible blocks, keeping
+    track of the offset of each member, such that parts of the archive can be
+    read later on without decompressing it from the start (c.f. read_ranges)
+    """
+
+    def __init__(self, *args, **kwargs):
+        tarfile.TarFile.__init__(self, *args, **kwargs)
+        # (name, offset of its headers in the tar stream, size)
+        self.index_members = []
+
+    def addfile(self, tarinfo, fileobj=None):
+
+        # Blocks are only cut between members
+        if self.fileobj.block_size() >= BLOCK_MAX_SIZE:
+            self.fileobj.new_block()
+
+        self.index_members.append((tarinfo.name, self.offset, tarinfo.size))
+        tarfile.TarFile.addfile(self, tarinfo, fileobj)
+
+    def new_block(self):
+        """Start a new block if the current one is big enough"""
+
+        if self.fileobj.block_size() >= BLOCK_MIN_SIZE:
+            self.fileobj.new_block()
+
+    def close(self):
+
+        if self.closed:
+            return
+        # Where the end-of-archive marker starts
+        self.index_end = self.offset
+        try:
+            tarfile.TarFile.close(self)
+        finally:
+            self.fileobj.close()
+
+    @property
+    def index(self):
+        """Index of the archive, to be saved once it is closed"""
+
+        return {"compression": self.compression,
+                "archive_size": os.path.getsize(self.fileobj.name),
+                "blocks": self.fileobj.blocks,
+                "members": self.index_members,
+                "end": self.index_end}
+
+
+class PipedTarFile(tarfile.TarFile):
+
+    """
+    Tar archive streamed from an archive file, through a decompressor process
+    if it is compressed. Closing it waits for the process, and raises IOError
+    if it failed.
+    """
+
+    process = None
+    stderr = None
+    source = None
+
+    def close(self):
+
+        try:
+            tarfile.TarFile.close(self)
+        finally:
+            try:
+                if self.process is not None:
+                    self._close_process()
+            finally:
+                if self.source is not None:
+                    self.source.close()
+
+    def _close_process(self):
+
+        process, self.process = self.process, None
+        # Read the padding following the end of the archive, so that the
+        # decompressor can finish. If we stopped reading before the end,
+        # there is no point in letting it decompress the rest.
+        if self._loaded:
+            while process.stdout.read(STREAM_BUFFER_SIZE):
+                pass
+        elif process.poll() is None:
+            process.kill()
+        process.stdout.close()
+        returncode = process.wait()
+
+        self.stderr.seek(0)
+        error = self.stderr.read().strip()
+        self.stderr.close()
+
+        # Only report errors if we reached the end of the archive
+        if returncode != 0 and self._loaded:
+            raise IOError("'%s' failed with code %s: %s" % (process.args, returncode, error))
+
+
+def open_archive(path, mode="r", compression=None, level=None):
+    """
+    Open a tar archive for streamed reading or writing (i.e. members have to
+    be read/written in order)
+
+    When writing, the archive is an IndexedTarFile, whose index should be
+    saved along the archive once it is closed.
+
+    Keyword argument:
+        mode -- "r" or "w"
+        compression -- "gz", "zstd" or "none". When reading, it is detected
+                       from the content of the archive
+        level -- compression level, by default the one of the compressor
+
+    """
+
+    if mode == "w":
+        writer = _BlockWriter(path, compression, level)
+        try:
+            tar = IndexedTarFile(path, "w", fileobj=writer)
+        except:
+            writer.close()
+            raise
+        tar.compression = compression
+        return tar
+
+    return _open_stream(path, detect_compression(path))
+
+
+def _open_stream(path, compression, offset=0, skip=0):
+    """
+    Open a tar stream from an archive file, decompressing it from a given
+    offset, and skipping the first bytes of the decompressed data
+    """
+
+    command = _decompressor_command(compression)
+
+    f = open(path, "rb")
+    if command is None:
+        f.seek(offset + skip)
+        try:
+            tar = PipedTarFile.open(path, "r|", fileobj=f, bufsize=STREAM_BUFFER_SIZE)
+        except:
+            f.close()
+            raise
+        tar.source = f
+        return tar
+
+    stderr = tempfile.TemporaryFile()
+    # The decompressor reads the file from the offset we seek to, as it
+    # shares the file descriptor
+    f.seek(offset)
+    try:
+        process = subprocess.Popen(command, stdin=f, stdout=subprocess.PIPE,
+                                   stderr=stderr, bufsize=-1)
+    finally:
+        f.close()
+    process.args = " ".join(command)
+
+    try:
+        while skip:
+            skipped = len(process.stdout.read(min(skip, STREAM_BUFFER_SIZE)))
+            if not skipped:
+                raise tarfile.ReadError("unexpected end of data")
+            skip -= skipped
+        tar = PipedTarFile.open(path, "r|", fileobj=process.stdout, bufsize=STREAM_BUFFER_SIZE)
+    except:
+        process.kill()
+        process.stdout.close()
+        process.wait()
+        stderr.close()
+        raise
+
+    tar.process, tar.stderr = process, stderr
+    return tar
+
+
+def extract_members(tar, path, select):
+    """
+    Extract the members of a streamed archive for which select(name) is True,
+    in a single pass over the archive. As in TarFile.extractall, attributes of
+    directories are set at the end, once their content is extracted.
+
+    Hard links whose target is not selected can't be extracted in this pass,
+    as the target's content is behind in the stream: the archive is then read
+    again to extract the content of these targets in their place.
+
+    Returns the names of the extracted members
+    """
+
+    extracted = []
+    directories = []
+    links = []
+    for tarinfo in tar:
+        if not select(tarinfo.name):
+            continue
+        extracted.append(tarinfo.name)
+        if _is_dangling_link(tarinfo, path):
+            links.append(tarinfo)
+            continue
+        if tarinfo.isdir():
+            directories.append(tarinfo)
+            tarinfo = copy.copy(tarinfo)
+            tarinfo.mode = 0o700
+        tar.extract(tarinfo, path)
+
+    if links:
+        _extract_links_targets([(open_archive(tar.name), None)], path, links)
+
+    _set_directories_attributes(tar, path, directories)
+
+    return extracted
+
+
+def _is_dangling_link(tarinfo, path):
+    """Whether a member is a hard link to a file which was not extracted"""
+
+    return tarinfo.islnk() and not os.path.lexists(os.path.join(path, tarinfo.linkname))
+
+
+def _extract_links_targets(tars, path, links):
+    """
+    Extract hard links whose target was not extracted, by extracting the
+    content of the target in place of the first link to it, the other ones
+    being linked to this one
+
+    Keyword argument:
+        tars -- list of (TarFile, offset at which to stop reading it or None),
+                streaming the parts of the archive holding the targets
+        links -- TarInfo of the links to extract
+    """
+
+    links_by_target = {}
+    for link in links:
+        links_by_target.setdefault(link.linkname, []).append(link)
+
+    for tar, end in tars:
+        try:
+            for tarinfo in tar:
+                if not links_by_target:
+                    break
+                if end is not None and tarinfo.offset >= end:
+                    break
+                if tarinfo.name not in links_by_target or not tarinfo.isreg():
+                    continue
+
+                first_link = None
+                for link in links_by_target.pop(tarinfo.name):
+                    if first_link is None:
+                        member = copy.copy(tarinfo)
+                        member.name = link.name
+                        tar.extract(member, path)
+                        first_link = os.path.join(path, link.name)
+                    else:
+                        link_path = os.path.join(path, link.name)
+                        if os.path.lexists(link_path):
+                            os.unlink(link_path)
+                        os.link(first_link, link_path)
+        finally:
+            tar.close()
+
+    if links_by_target:
+        raise tarfile.ExtractError("hard link targets not found in the archive: %s"
+                                   % ", ".join(sorted(links_by_target.keys())))
+
+
+def extract_indexed_members(archive, index, path, select):
+    """
+    Extract the members of an archive for which select(name) is True, using
+    its index to only decompress the blocks holding them
+
+    Returns the names of the extracted members
+    """
+
+    extracted = []
+    directories = []
+    links = []
+    for tar, end in read_ranges(archive, index, select):
+        try:
+            for tarinfo in tar:
+                if tarinfo.offset >= end:
+                    break
+                if not select(tarinfo.name):
+                    continue
+                extracted.append(tarinfo.name)
+                # The target of the link may be in a part of the archive
+                # which was skipped
+                if _is_dangling_link(tarinfo, path):
+                    links.append(tarinfo)
+                    continue
+                if tarinfo.isdir():
+                    directories.append((tar, tarinfo))
+                    tarinfo = copy.copy(tarinfo)
+                    tarinfo.mode = 0o700
+                tar.extract(tarinfo, path)
+        finally:
+            tar.close()
+
+    if links:
+        targets = set(link.linkname for link in links)
+        _extract_links_targets(read_ranges(archive, index, lambda name: name in targets), path, links)
+
+    for tar, tarinfo in sorted(directories, key=lambda d: d[1].name, reverse=True):
+        _set_directories_attributes(tar, path, [tarinfo])
+
+    return extracted
+
+
+def read_ranges(archive, index, select):
+    """
+    Iterate over the parts of an archive holding the members for which
+    select(name) is True. Yields, for each part, a TarFile streaming the
+    archive from the first of these members, and the offset (relative to that
+    TarFile) at which the part ends.
+    """
+
+    members = index["members"]
+    ends = [offset for _, offset, _ in members[1:]] + [index["end"]]
+    block_offsets = [block[0] for block in index["blocks"]]
+
+    def block_of(offset):
+        return bisect.bisect_right(block_offsets, offset) - 1
+
+    # Group the selected members in contiguous ranges. Two ranges are merged
+    # when they are in the same block (we would have to decompress it again
+    # from its start anyway) or close enough.
+    ranges = []
+    for (name, offset, _), end in zip(members, ends):
+        if not select(name):
+            continue
+        if ranges and (offset - ranges[-1][1] < BLOCK_MIN_SIZE
+                       or block_of(offset) == block_of(ranges[-1][1])):
+            ranges[-1][1] = end
+        else:
+            ranges.append([offset, end])
+
+    for start, end in ranges:
+        if index["compression"] == "none":
+            tar = _open_stream(archive, "none", start)
+        else:
+            block_offset, file_offset = index["blocks"][block_of(start)]
+            tar = _open_stream(archive, index["compression"], file_offset, start - block_offset)
+        yield tar, end - start
+
+
+def _set_directories_attributes(tar, path, directories):
+
+    directories.sort(key=lambda tarinfo: tarinfo.name, reverse=True)
+    for tarinfo in directories:
+        dirpath = os.path.join(path, tarinfo.name)
+        tar.chown(tarinfo, dirpath)
+        tar.utime(tarinfo, dirpath)
+        tar.chmod(tarinfo, dirpath)
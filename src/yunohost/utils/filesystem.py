@@ -19,6 +19,37 @@
 
 """
 import os
+import stat
+import yaml
+
+from moulinette import m18n
+from moulinette.core import MoulinetteError
+from moulinette.utils.filesystem import read_file
+
+# The libyaml based loader is an order of magnitude faster than the pure
+# python one, but python-yaml may have been built without it
+SafeLoader = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+
+# Number of directories scanned at the same time by scan_disk_usage()
+DISK_USAGE_MAX_PARALLEL = 8
+
+
+def read_yaml(file_path):
+    """
+    Same as moulinette's read_yaml, but using the C accelerated loader when
+    available. Meant for yunohost's own yaml state files (services, firewall,
+    regenconf, apps settings...) which are read very often.
+
+    Keyword argument:
+        file_path -- Path to the yaml file to read
+
+    """
+    file_content = read_file(file_path)
+
+    try:
+        return yaml.load(file_content, Loader=SafeLoader)
+    except Exception as e:
+        raise MoulinetteError(m18n.g('corrupted_yaml', ressource=file_path, error=str(e)))
 
 
 def free_space_in_directory(dirpath):
@@ -29,3 +60,120 @@ def free_space_in_directory(dirpath):
 def space_used_by_directory(dirpath):
     stat = os.statvfs(dirpath)
     return stat.f_frsize * stat.f_blocks
+
+
+def disk_usage(paths, max_parallel=DISK_USAGE_MAX_PARALLEL):
+    """
+    Compute the apparent size of several files or directory trees, like
+    'du -sb' would do for each of them (i.e. files hardlinked several times
+    are only counted once per tree, symlinks are not followed)
+
+    Returns a dict {path: size in bytes}
+    """
+
+    return {path: size + sum(linked.values())
+            for path, (size, linked) in scan_disk_usage(paths, max_parallel).items()}
+
+
+def scan_disk_usage(paths, max_parallel=DISK_USAGE_MAX_PARALLEL):
+    """
+    Walk several files or directory trees in parallel, without following
+    symlinks, to compute their apparent size
+
+    Files with several hardlinks are accounted separately, such that the
+    caller can count them only once across trees.
+
+    Returns a dict {path: (size, {(st_dev, st_ino): size})}, the first size
+    being the one of all entries but the files with several hardlinks, which
+    are in the dict
+    """
+
+    from multiprocessing.pool import ThreadPool
+
+    paths = list(set(paths))
+    if not paths:
+        return {}
+
+    # Scan each top-level directory separately, so that a tree with a few
+    # huge subdirectories still gets scanned in parallel
+    jobs = []
+    for path in paths:
+        jobs.append((path, path, False))
+        st = _lstat(path)
+        if st is None or not stat.S_ISDIR(st.st_mode):
+            continue
+        for name in _list_dir(path):
+            entry = os.path.join(path, name)
+            st = _lstat(entry)
+            if st is not None and stat.S_ISDIR(st.st_mode):
+                jobs.append((path, entry, True))
+
+    def scan(job):
+        root, path, recursive = job
+        usage = [0, {}]
+        st = _lstat(path)
+        if st is None:
+            return root, usage
+        _account(st, usage)
+        # For the top-level directory, subdirectories are scanned by their
+        # own jobs
+        subdirs = [path] if recursive else []
+        if not recursive and stat.S_ISDIR(st.st_mode):
+            for name in _list_dir(path):
+                st = _lstat(os.path.join(path, name))
+                if st is not None and not stat.S_ISDIR(st.st_mode):
+                    _account(st, usage)
+
+        # Walk the tree with a single lstat per entry (which also tells us if
+        # it is a directory to walk through, symlinks not being followed)
+        while subdirs:
+            dirpath = subdirs.pop()
+            for name in _list_dir(dirpath):
+                entry = os.path.join(dirpath, name)
+                st = _lstat(entry)
+                if st is None:
+                    continue
+                _account(st, usage)
+                if stat.S_ISDIR(st.st_mode):
+                    subdirs.append(entry)
+        return root, usage
+
+    pool = ThreadPool(min(len(jobs), max_parallel))
+    try:
+        results = pool.map(scan, jobs)
+    finally:
+        pool.close()
+        pool.join()
+
+    sizes = dict.fromkeys(paths, 0)
+    linked = {path: {} for path in paths}
+    for root, (root_size, root_linked) in results:
+        sizes[root] += root_size
+        linked[root].update(root_linked)
+
+    return {path: (sizes[path], linked[path]) for path in paths}
+
+
+def _list_dir(path):
+
+    try:
+        return os.listdir(path)
+    except OSError:
+        return []
+
+
+def _lstat(path):
+
+    try:
+        return os.lstat(path)
+    except OSError:
+        return None
+
+
+def _account(st, usage):
+    """Add the apparent size of a file to a [size, linked] usage"""
+
+    if st.st_nlink > 1 and not stat.S_ISDIR(st.st_mode):
+        usage[1][(st.st_dev, st.st_ino)] = st.st_size
+    else:
+        usage[0] += st.st_size
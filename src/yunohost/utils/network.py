@@ -22,6 +22,7 @@ import os
 import re
 import logging
 import time
+import threading
 import dns.resolver
 
 from moulinette.utils.filesystem import read_file, write_to_file
@@ -126,16 +127,37 @@ def external_resolvers():
     return external_resolvers_
 
 
+# Lazy dev caching of the resolvers used by dig(), along with the answers they
+# got, to avoid asking the same thing again during the same yunohost operation
+resolvers_ = {}
+resolvers_lock_ = threading.Lock()
+
+# Maximum number of DNS requests waiting for an answer at the same time
+DIG_MAX_PARALLEL = 16
+
+
 def dig(qname, rdtype="A", timeout=5, resolvers="local", edns_size=1500, full_answers=False):
     """
     Do a quick DNS request and avoid the "search" trap inside /etc/resolv.conf
     """
 
-    # It's very important to do the request with a qname ended by .
-    # If we don't and the domain fail, dns resolver try a second request
-    # by concatenate the qname with the end of the "hostname"
-    if not qname.endswith("."):
-        qname += "."
+    return dig_many([(qname, rdtype)], timeout=timeout, resolvers=resolvers,
+                    edns_size=edns_size, full_answers=full_answers)[(qname, rdtype)]
+
+
+def dig_many(queries, timeout=5, resolvers="local", edns_size=1500, full_answers=False):
+    """
+    Do several DNS requests at once, concurrently
+
+    Identical requests are only done once, and answers are reused until
+    their TTL expires.
+
+    Keyword argument:
+        queries -- List of (qname, rdtype) to resolve
+        timeout -- Time to wait for each resolver to answer a request
+
+    Returns a dict {(qname, rdtype): ("ok", answers) or ("nok", (error, exception))}
+    """
 
     if resolvers == "local":
         resolvers = ["127.0.0.1"]
@@ -144,22 +166,62 @@ def dig(qname, rdtype="A", timeout=5, resolvers="local", edns_size=1500, full_an
     else:
         assert isinstance(resolvers, list)
 
-    resolver = dns.resolver.Resolver(configure=False)
-    resolver.use_edns(0, 0, edns_size)
-    resolver.nameservers = resolvers
-    resolver.timeout = timeout
-    try:
-        answers = resolver.query(qname, rdtype)
-    except (dns.resolver.NXDOMAIN,
-            dns.resolver.NoNameservers,
-            dns.resolver.NoAnswer,
-            dns.exception.Timeout) as e:
-        return ("nok", (e.__class__.__name__, e))
+    resolver = _get_resolver(resolvers, timeout, edns_size)
+
+    def query(qname_rdtype):
+        qname, rdtype = qname_rdtype
+        try:
+            return ("ok", resolver.query(qname, rdtype))
+        except (dns.resolver.NXDOMAIN,
+                dns.resolver.NoNameservers,
+                dns.resolver.NoAnswer,
+                dns.exception.Timeout) as e:
+            return ("nok", (e.__class__.__name__, e))
+
+    # It's very important to do the request with a qname ended by .
+    # If we don't and the domain fail, dns resolver try a second request
+    # by concatenate the qname with the end of the "hostname"
+    def normalize(qname, rdtype):
+        return (qname if qname.endswith(".") else qname + ".", rdtype)
+
+    unique_queries = list(set(normalize(qname, rdtype) for qname, rdtype in queries))
+
+    if len(unique_queries) > 1:
+        from multiprocessing.pool import ThreadPool
+
+        pool = ThreadPool(min(len(unique_queries), DIG_MAX_PARALLEL))
+        try:
+            results = dict(zip(unique_queries, pool.map(query, unique_queries)))
+        finally:
+            pool.close()
+    else:
+        results = {q: query(q) for q in unique_queries}
 
     if not full_answers:
-        answers = [answer.to_text() for answer in answers]
+        results = {q: (status, [answer.to_text() for answer in answers]) if status == "ok" else (status, answers)
+                   for q, (status, answers) in results.items()}
+
+    return {(qname, rdtype): results[normalize(qname, rdtype)] for qname, rdtype in queries}
+
+
+def _get_resolver(nameservers, timeout, edns_size):
+
+    key = (tuple(nameservers), timeout, edns_size)
+
+    with resolvers_lock_:
+        if key not in resolvers_:
+            resolver = dns.resolver.Resolver(configure=False)
+            resolver.use_edns(0, 0, edns_size)
+            resolver.nameservers = nameservers
+            resolver.timeout = timeout
+            # Give up once each nameserver had a chance to answer, instead
+            # of retrying for 30s
+            resolver.lifetime = timeout * len(nameservers)
+            # Thread-safe cache, honoring the TTL of the answers
+            resolver.cache = dns.resolver.Cache()
+            resolvers_[key] = resolver
 
-    return ("ok", answers)
+    return resolvers_[key]
 
 
 def _extract_inet(string, skip_netmask=False, skip_loopback=True):
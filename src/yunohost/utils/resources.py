@@ -0,0 +1,209 @@
+# -*- coding: utf-8 -*-
+
+""" License
+
+    Copyright (C) 2020 YUNOHOST.ORG
+
+    This program is free software; you can redistribute it and/or modify
+    it under the terms of the GNU Affero General Public License as published
+    by the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU Affero General Public License for more details.
+
+    You should have received a copy of the GNU Affero General Public License
+    along with this program; if not, see http://www.gnu.org/licenses
+
+"""
+import os
+import re
+import logging
+import subprocess
+
+logger = logging.getLogger('yunohost.utils.resources')
+
+APPS_DATA_DIR = "/home/yunohost.app"
+MYSQL_ROOT_PASSWORD_FILE = "/etc/yunohost/mysql"
+PSQL_ROOT_PASSWORD_FILE = "/etc/yunohost/psql"
+
+
+def apps_resources_usage(apps=None):
+    """
+    Get the resources used by each installed app:
+     - RAM used by the systemd services the app added, and by its php-fpm pool
+     - disk space used by its install dir, data dir and databases
+
+    Returns a list of dicts, from the app using the most RAM to the one using
+    the least
+    """
+
+    from yunohost.app import _installed_apps, _get_app_settings
+    from yunohost.service import _get_services
+    from yunohost.utils.filesystem import disk_usage
+
+    apps = apps if apps is not None else sorted(_installed_apps())
+    settings = {app: _get_app_settings(app) for app in apps}
+    services = _get_services()
+
+    app_services = {app: _get_app_services(app, services) for app in apps}
+    units_memory = _get_services_memory([s for ss in app_services.values() for s in ss])
+    pools_memory = _get_phpfpm_pools_memory()
+    databases_size = _get_databases_size()
+
+    dirs = {app: [d for d in [settings[app].get("final_path"), os.path.join(APPS_DATA_DIR, app)]
+                  if d and os.path.isdir(d)]
+            for app in apps}
+    dirs_size = disk_usage([d for ds in dirs.values() for d in ds])
+
+    usages = []
+    for app in apps:
+        databases = [db for db in _get_app_databases(app, settings[app]) if db in databases_size]
+        usage = {"app": app,
+                 "services": {s: units_memory[s] for s in app_services[app] if s in units_memory},
+                 "php-fpm": pools_memory.get(app, 0),
+                 "dirs": {d: dirs_size[d] for d in dirs[app]},
+                 "databases": {db: databases_size[db] for db in databases}}
+        usage["memory"] = sum(usage["services"].values()) + usage["php-fpm"]
+        usage["disk"] = sum(usage["dirs"].values()) + sum(usage["databases"].values())
+        usages.append(usage)
+
+    return sorted(usages, key=lambda u: (-u["memory"], -u["disk"], u["app"]))
+
+
+def _get_app_services(app, services):
+    """
+    Guess the services added by an app, i.e. those named after it
+    (e.g. 'synapse', 'synapse-coturn' or 'nextcloud__2-phpfpm')
+    """
+
+    # 'nextcloud__2' being another instance of nextcloud, not one of its services
+    pattern = re.compile(r"^%s($|[-@.]|_(?!_))" % re.escape(app))
+    return sorted(s for s in services if pattern.match(s))
+
+
+def _get_services_memory(services):
+    """
+    Fetch the RAM currently used by several systemd services, as accounted by
+    systemd, in a single query via dbus
+
+    Returns a dict {service: bytes}, services for which memory accounting is
+    not available being left out
+    """
+
+    if not services:
+        return {}
+
+    import dbus
+    from yunohost.service import _get_systemd_manager
+
+    bus, manager = _get_systemd_manager()
+    units = [service + '.service' for service in services]
+
+    result = {}
+    for unit in manager.ListUnitsByNames(units):
+        name, _, load_state, active_state, _, _, unit_path = unit[:7]
+        if load_state == "not-found" or active_state != "active":
+            continue
+
+        unit_proxy = bus.get_object('org.freedesktop.systemd1', unit_path, introspect=False)
+        properties_interface = dbus.Interface(unit_proxy, 'org.freedesktop.DBus.Properties')
+        memory = int(properties_interface.Get('org.freedesktop.systemd1.Service', 'MemoryCurrent'))
+
+        # (uint64) -1 means the memory is not accounted for this unit
+        if memory < 2 ** 64 - 1:
+            result[str(name)[:-len('.service')]] = memory
+
+    return result
+
+
+def _get_phpfpm_pools_memory():
+    """
+    Sum the resident memory of the processes of each php-fpm pool
+
+    N.B. : memory shared between the processes is counted several times
+
+    Returns a dict {pool: bytes}
+    """
+
+    import psutil
+
+    pools = {}
+    for process in psutil.process_iter():
+        try:
+            cmdline = " ".join(process.cmdline())
+            m = re.match(r"^php-fpm: pool (\S+)", cmdline)
+            if m:
+                pools[m.group(1)] = pools.get(m.group(1), 0) + process.memory_info().rss
+        except (psutil.NoSuchProcess, psutil.AccessDenied):
+            continue
+
+    return pools
+
+
+def _get_app_databases(app, settings):
+
+    # c.f. ynh_sanitize_dbid
+    return set([settings.get("db_name") or re.sub(r"[-.]", "_", app)])
+
+
+def _get_databases_size():
+    """
+    Get the size of every MySQL and PostgreSQL database
+
+    Returns a dict {database: bytes}
+    """
+
+    sizes = {}
+
+    if os.path.exists(MYSQL_ROOT_PASSWORD_FILE):
+        env = dict(os.environ, MYSQL_PWD=open(MYSQL_ROOT_PASSWORD_FILE).read().strip())
+        sizes.update(_query_databases_size(
+            ["mysql", "-u", "root", "--batch", "--skip-column-names", "-e",
+             "SELECT table_schema, SUM(data_length + index_length) "
+             "FROM information_schema.tables GROUP BY table_schema"], env=env))
+
+    if os.path.exists(PSQL_ROOT_PASSWORD_FILE):
+        sizes.update(_query_databases_size(
+            ["sudo", "--login", "--user=postgres", "psql", "--no-align", "--tuples-only",
+             "--field-separator=\t", "-c",
+             "SELECT datname, pg_database_size(datname) FROM pg_database WHERE NOT datistemplate"]))
+
+    return sizes
+
+
+def _query_databases_size(command, env=None):
+
+    try:
+        output = subprocess.check_output(command, env=env, stderr=subprocess.STDOUT)
+    except (OSError, subprocess.CalledProcessError) as e:
+        logger.debug("Could not get the size of the databases using '%s': %s", command[0], e)
+        return {}
+
+    sizes = {}
+    for line in output.strip().split("\n"):
+        fields = line.split("\t")
+        if len(fields) == 2 and fields[1].strip().isdigit():
+            sizes[fields[0].strip()] = int(fields[1])
+
+    return sizes
+
+
+def human_size(bytes_):
+    # Adapted from https://stackoverflow.com/a/1094933
+    for unit in ['', 'ki', 'Mi', 'Gi', 'Ti', 'Pi', 'Ei', 'Zi']:
+        if abs(bytes_) < 1024.0:
+            return "%s %sB" % (round_(bytes_), unit)
+        bytes_ /= 1024.0
+    return "%s %sB" % (round_(bytes_), 'Yi')
+
+
+def round_(n):
+    # round_(22.124) -> 22
+    # round_(9.45) -> 9.4
+    n = round(n, 1)
+    if n > 10:
+        n = int(round(n))
+    return n
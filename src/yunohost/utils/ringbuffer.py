@@ -0,0 +1,126 @@
+# -*- coding: utf-8 -*-
+
+""" License
+
+    Copyright (C) 2020 YUNOHOST.ORG
+
+    This program is free software; you can redistribute it and/or modify
+    it under the terms of the GNU Affero General Public License as published
+    by the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU Affero General Public License for more details.
+
+    You should have received a copy of the GNU Affero General Public License
+    along with this program; if not, see http://www.gnu.org/licenses
+
+"""
+import os
+import struct
+
+MAGIC = "YNHRB1"
+# Magic, number of fields, capacity, number of records ever appended
+HEADER = struct.Struct("<6sHIQ")
+# Comma-separated names of the fields, padded with null bytes
+FIELDS_SIZE = 256
+
+
+class RingBufferFile(object):
+
+    """
+    Fixed-size file holding the last records of a series of measures, each
+    record being a timestamp followed by one float per field. Once the file
+    is full, new records overwrite the oldest ones.
+    """
+
+    def __init__(self, path, fields, capacity=1024):
+        self.path = path
+        self.fields = list(fields)
+        self.capacity = capacity
+        self.record = struct.Struct("<d" + "d" * len(self.fields))
+
+    @classmethod
+    def load(cls, path):
+        """Open an existing file, whatever its fields and capacity"""
+
+        with open(path, "rb") as f:
+            header = cls._read_header(f)
+        if header is None:
+            raise ValueError("%s is not a ring buffer file" % path)
+        fields, capacity, _ = header
+        return cls(path, fields, capacity)
+
+    def append(self, timestamp, values):
+
+        assert len(values) == len(self.fields)
+
+        with open(self.path, "r+b" if os.path.exists(self.path) else "w+b") as f:
+            # Start over if the file got corrupted or if the series changed
+            count = self._read_count(f)
+            if count is None:
+                f.truncate(0)
+                count = 0
+
+            f.seek(self._offset(count % self.capacity))
+            f.write(self.record.pack(timestamp, *values))
+            self._write_header(f, count + 1)
+
+    def read(self):
+        """Get the records, from the oldest to the most recent one"""
+
+        if not os.path.exists(self.path):
+            return []
+
+        with open(self.path, "rb") as f:
+            count = self._read_count(f)
+            if count is None:
+                return []
+            f.seek(self._offset(0))
+            data = f.read(self.record.size * min(count, self.capacity))
+
+        records = [self.record.unpack_from(data, i * self.record.size)
+                   for i in range(len(data) // self.record.size)]
+
+        # Once the file is full, the oldest record is the one following the
+        # last one which was written
+        start = count % self.capacity if count > self.capacity else 0
+        return records[start:] + records[:start]
+
+    def _offset(self, slot):
+        return HEADER.size + FIELDS_SIZE + slot * self.record.size
+
+    def _read_count(self, f):
+        """Number of records ever appended, or None if the file does not
+        hold this series"""
+
+        header = self._read_header(f)
+        if header is None or header[:2] != (self.fields, self.capacity):
+            return None
+        return header[2]
+
+    @staticmethod
+    def _read_header(f):
+
+        f.seek(0)
+        data = f.read(HEADER.size + FIELDS_SIZE)
+        if len(data) < HEADER.size + FIELDS_SIZE:
+            return None
+
+        magic, nb_fields, capacity, count = HEADER.unpack_from(data)
+        fields = data[HEADER.size:].rstrip("\0").split(",")
+        if magic != MAGIC or len(fields) != nb_fields or not capacity:
+            return None
+
+        return fields, capacity, count
+
+    def _write_header(self, f, count):
+
+        fields = ",".join(self.fields)
+        assert len(fields) <= FIELDS_SIZE
+
+        f.seek(0)
+        f.write(HEADER.pack(MAGIC, len(self.fields), self.capacity, count))
+        f.write(fields.ljust(FIELDS_SIZE, "\0"))